@@ -1 +1,10 @@
-from base import build_tag
+from .base import build_tag, writer, AttrValues, CallableValues, CounterIds, FormIds, MultiDictValues, OptionCache, PooledIds, RandomIds
+from .cache import FileBackend, FormCache, MemoryBackend, fingerprint, form_fingerprints
+from .decoder import Submission, decode
+from .manifest import Manifest
+from .metrics import RenderMetrics
+
+try:
+    from .jinjapump import JinjaPump, pumpwidget, remove_pumpwidget
+except ImportError:
+    pass
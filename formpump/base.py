@@ -1,15 +1,217 @@
 "FormPump - It fills up forms"
 
-import cgi
+from binascii import hexlify
+import codecs
+from collections import deque, OrderedDict
+import itertools
 import logging
+import os
 from random import Random
+import re
 import string
+import threading
+
+try:
+    unicode = unicode
+except NameError:
+    unicode = str
+
+def escape(value):
+    """Escapes `value` for use in HTML text and attribute values.
+
+    Strings of letters and digits, which most names, ids and values are, and
+    ints are returned as they are. Objects with an __html__ method, such as
+    Markup, are already safe and are not escaped again."""
+    cls = value.__class__
+    if cls is unicode or cls is str:
+        if value.isalnum():
+            return value
+    elif cls is int:
+        return unicode(value)
+    elif hasattr(value, '__html__'):
+        # A plain string, as Markup would escape whatever is added to it.
+        return unicode(value.__html__())
+    else:
+        value = unicode(value)
+    # The same entities as markupsafe. A chain of replaces measures faster than
+    # markupsafe.escape, whose cost is mostly in building the Markup result.
+    return (value.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+            .replace(u'"', u'&#34;').replace(u"'", u'&#39;'))
+
+# Textarea values are escaped and written this many characters at a time, so
+# that a large value is never copied whole.
+CHUNK_SIZE = 65536
+
+def escape_chunks(value, size=CHUNK_SIZE):
+    """Escapes `value` in chunks of at most `size` characters of input. The
+    value may be a string, a file-like object with a read method, or an
+    iterator of strings, such as a generator; bytes are decoded as UTF-8.
+    Files and iterators are read as the chunks are, and only once."""
+    read = getattr(value, 'read', None)
+    if read is not None:
+        value = iter(lambda: read(size), value.read(0))
+    elif not (hasattr(value, '__next__') or hasattr(value, 'next')):
+        value = (value, )
+    decoder = None
+    for part in value:
+        if hasattr(part, '__html__'):
+            yield unicode(part.__html__())
+            continue
+        if isinstance(part, bytes):
+            # Sliced before decoding, so that a large value is never decoded
+            # whole.
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            for start in range(0, len(part), size):
+                text = decoder.decode(part[start:start + size])
+                if text:
+                    yield escape(text)
+            continue
+        if not isinstance(part, unicode):
+            part = unicode(part)
+        if len(part) <= size:
+            if part:
+                yield escape(part)
+        else:
+            for start in range(0, len(part), size):
+                yield escape(part[start:start + size])
+    if decoder is not None:
+        tail = decoder.decode(b'', True)
+        if tail:
+            yield escape(tail)
+
+def writer(out):
+    """The write function of an output buffer `out`: a list, which is
+    appended to, an object with a write method, such as an io stream or a Mako
+    context, or a function that takes a string. Form methods that take an
+    `out` argument write to it, in as many parts as there are, instead of
+    returning a string."""
+    if out.__class__ is list:
+        return out.append
+    write = getattr(out, 'write', None)
+    if write is not None:
+        return write
+    if callable(out):
+        return out
+    raise TypeError('Cannot write to %r' % (out, ))
+
+def _output(html, out):
+    # Returns `html`, or writes it to `out` if there is one.
+    if out is None:
+        return html
+    writer(out)(html)
+
+# Stands in for the values or errors of a form context that has none.
+_empty = {}
+
+_missing = object()
+
+def value_source(values):
+    """The values of a form context as a value source: an object whose
+    get(name, default) returns the value of one field and, where a name can
+    have several values, whose getlist(name) returns all of them. Fields are
+    only read as tags ask for them.
+
+    Dicts and MultiDicts with a getlist method (werkzeug, Django) are used as
+    they are; other values are adapted by MultiDictValues, CallableValues or
+    AttrValues."""
+    if values is None:
+        return _empty
+    if values.__class__ is dict or hasattr(values, 'getlist'):
+        return values
+    if hasattr(values, 'getall'):
+        return MultiDictValues(values)
+    if hasattr(values, 'get'):
+        return values
+    if callable(values):
+        return CallableValues(values)
+    return AttrValues(values)
+
+# Compiled field lookups, keyed on the field name: a function of a value source
+# and a default. Emptied when it grows too large, like the plans of _serialize.
+_lookups = {}
+_MAX_LOOKUPS = 2048
+
+# A list index in a dotted name. Only ASCII digits; isdigit() is also true of
+# other digits, such as superscripts, that int() does not accept.
+_index = re.compile(u'[0-9]+$')
+
+def _compile_lookup(name):
+    steps = unicode(name).split(u'.') if isinstance(name, (str, unicode)) else ()
+    if len(steps) < 2:
+        lookup = lambda values, default: values.get(name, default)
+    else:
+        first = steps[0]
+        rest = [(step, int(step) if _index.match(step) else None) for step in steps[1:]]
+
+        def lookup(values, default):
+            value = values.get(name, _missing)
+            if value is not _missing:
+                return value
+            value = values.get(first, _missing)
+            for key, index in rest:
+                if value is _missing:
+                    break
+                value = _step(value, key, index)
+            return default if value is _missing else value
+
+    if len(_lookups) >= _MAX_LOOKUPS:
+        _lookups.clear()
+    _lookups[name] = lookup
+    return lookup
+
+def _step(value, key, index):
+    # One step of a dotted name: an index into a list, or else a key of a
+    # mapping or an attribute of an object.
+    if index is not None and isinstance(value, (list, tuple)):
+        return value[index] if index < len(value) else _missing
+    if isinstance(value, dict) or hasattr(value, 'getlist'):
+        return value.get(key, _missing)
+    return getattr(value, key, _missing)
+
+class MultiDictValues(object):
+    "Values from a MultiDict whose values are listed by getall(), as in webob."
+    __slots__ = ('source', )
+
+    def __init__(self, source):
+        self.source = source
+
+    def get(self, name, default=None):
+        return self.source.get(name, default)
+
+    def getlist(self, name):
+        return self.source.getall(name)
+
+class AttrValues(object):
+    "Values from the attributes of an object, such as an ORM row."
+    __slots__ = ('source', )
+
+    def __init__(self, source):
+        self.source = source
+
+    def get(self, name, default=None):
+        return getattr(self.source, name, default)
+
+class CallableValues(object):
+    "Values from a function of the field name that returns None for no value."
+    __slots__ = ('source', )
+
+    def __init__(self, source):
+        self.source = source
+
+    def get(self, name, default=None):
+        value = self.source(name)
+        return default if value is None else value
 
 log = logging.getLogger('formpump')
 log.setLevel(logging.WARN)
 
 class Form(object):
-    def __init__(self, name, name_key, ctx_key, attrs, default_action, form_vars, form_errors):
+    __slots__ = ('base_name', 'name', 'name_key', 'ctx_key', 'attrs', 'form_vars', 'form_errors',
+                 'values', 'errors', 'inputless_labels', 'labeless_inputs', 'html_ids', 'sort_attrs')
+
+    def __init__(self, name, name_key, ctx_key, attrs, default_action, form_vars, form_errors, html_ids=None,
+                 sort_attrs=False):
         self.base_name = name
         self.name = name
         self.name_key = name_key
@@ -17,8 +219,11 @@ class Form(object):
         self.attrs = attrs
         self.form_vars = form_vars
         self.form_errors = form_errors
+        self.set_context(name)
         self.inputless_labels = {}
         self.labeless_inputs = {}
+        self.html_ids = html_ids or default_id_strategy()
+        self.sort_attrs = sort_attrs
 
         log.debug(u"Form Name: %s", self.name)
         log.debug(u"Form Vars: %s", self.form_vars)
@@ -28,28 +233,47 @@ class Form(object):
 
 
     def build_tag(self, tag, attrs, close=True, label=True):
-        if label and attrs.get('name', None) is not None and not 'id' in attrs:
-            name = attrs['name']
-            if len(self.inputless_labels.get(name,[])) != 0:
-                html_id = self.inputless_labels[name].pop(0)
-            else:
-                html_id = self.html_id()
-                self.labeless_inputs.setdefault(name, [])
-                self.labeless_inputs[name].append(html_id)
-            attrs['id'] = html_id
+        if label:
+            html_id = self._assign_label_to_tag(attrs)
+            if html_id is not None:
+                attrs['id'] = html_id
 
-	return build_tag(tag, attrs, close=close)
+        return build_tag(tag, attrs, close=close, sort=self.sort_attrs)
 
-    def context_tag(self, attrs):
-        self.name = attrs['name']
+    def set_context(self, name):
+        """Switches the form context, resolving the values and errors that
+        every tag in it looks its fields up in."""
+        self.name = name
+        self.values = value_source(self.form_vars.get(name))
+        self.errors = self.form_errors.get(name) or _empty
+
+    def field_value(self, name, default=''):
+        """The value of the field `name` in the current context. Dotted names,
+        such as address.city or items.3.qty, are looked up through nested
+        dicts, lists and objects unless the values have that name as is."""
+        lookup = _lookups.get(name)
+        if lookup is None:
+            lookup = _compile_lookup(name)
+        return lookup(self.values, default)
+
+    def field_error(self, name):
+        "The error of the field `name` in the current context, if any."
+        lookup = _lookups.get(name)
+        if lookup is None:
+            lookup = _compile_lookup(name)
+        return lookup(self.errors, None)
+
+    def context_tag(self, attrs, out=None):
+        self.set_context(attrs['name'])
+        self.html_ids = ids_for_context(self.html_ids, self.name)
         if self.ctx_key:
             attrs['name'] = self.ctx_key
             attrs.setdefault('type', 'hidden')
             attrs.setdefault('value', self.name)
 
-            return self.build_tag('input', attrs)
+            return _output(self.build_tag('input', attrs), out)
 
-        return ''
+        return _output(u'', out)
 
     def _is_match(self, value, tag_value):
         is_list = isinstance(value, (list, tuple))
@@ -59,13 +283,20 @@ class Form(object):
         else:
             return unicode(value) == unicode(tag_value)
 
-    def checkbox_tag(self, attrs):
+    def checkbox_tag(self, attrs, out=None):
         attrs['type'] = 'checkbox'
+        return _output(self.build_tag('input', self.checkbox_attrs(attrs), label=False), out)
+
+    def checkbox_attrs(self, attrs):
+        html_id = self._assign_label_to_tag(attrs)
+        if html_id is not None:
+            attrs['id'] = html_id
+
         name = attrs.get('name', None)
         attrs.setdefault('value', '1')
         true_values = ('1', 't', 'true', 'y', 'yes', 'on')
         if name is not None:
-            value = self.form_vars.get(self.name, {}).get(name, '')
+            value = self._multi_value(name)
 
             if self._is_match(value, attrs['value']) or \
                     (unicode(value).lower() in true_values and \
@@ -74,29 +305,33 @@ class Form(object):
             else:
                 attrs.pop('checked', None)
 
-            error = self.form_errors.get(self.name, {}).get(name, None)
+            error = self.field_error(name)
             if error:
                 if 'class' in attrs:
                     attrs['class'] = 'error ' + attrs['class']
                 else:
                     attrs['class'] = 'error'
 
-        return self.build_tag('input', attrs)
+        return attrs
 
-    def email_tag(self, attrs):
+    def email_tag(self, attrs, out=None):
         attrs['type'] = 'email'
-        return self.input_tag(attrs)
+        return self.input_tag(attrs, out)
+
+    def end_label_tag(self, out=None):
+        return _output(u'</label>', out)
 
-    def end_label_tag(self):
-        return '</label>'
+    def close(self):
+        "Called once the form has been rendered."
+        pass
 
-    def end_tag(self):
-        return '</form>'
+    def end_tag(self, out=None):
+        return _output(u'</form>', out)
 
-    def error_tag(self, name, attrs, error_renderers):
-        error = self.form_errors.get(self.name, {}).get(name, None)
+    def error_tag(self, name, attrs, error_renderers, out=None):
+        error = self.field_error(name)
         if not error:
-            return ''
+            return _output(u'', out)
 
         attrs.setdefault('render', 'default')
         if attrs['render'] == 'default':
@@ -108,160 +343,248 @@ class Form(object):
 
         attrs.pop('render', None)
 
-        return renderer(error, attrs)
+        return _output(renderer(error, attrs), out)
 
-    def file_tag(self, attrs):
+    def file_tag(self, attrs, out=None):
         attrs['type'] = 'file'
-        return self.input_tag(attrs)
+        return self.input_tag(attrs, out)
 
-    def hidden_tag(self, attrs):
+    def hidden_tag(self, attrs, out=None):
         attrs['type'] = 'hidden'
-        return self.input_tag(attrs)
+        return self.input_tag(attrs, out)
 
     def html_id(self):
-        source = string.letters+string.digits
-        return u''.join( [Random().sample(source, 1)[0] for x in range(0, 32)] )
+        return self.html_ids()
 
     def if_error(self, name):
-        return bool(self.form_errors.get(self.name, {}).get(name, None))
+        return bool(self.field_error(name))
 
     def if_not_error(self, name):
-        return not bool(self.form_errors.get(self.name, {}).get(name, None))
+        return not bool(self.field_error(name))
+
+    def input_tag(self, attrs, out=None):
+        return _output(self.build_tag('input', self.input_attrs(attrs), label=False), out)
 
-    def input_tag(self, attrs):
+    def input_attrs(self, attrs, input_type=None):
+        # `input_type` is the type of an input whose type attribute is
+        # rendered elsewhere, as JinjaPump does with constant attributes.
         html_id = self._assign_label_to_tag(attrs)
         if html_id is not None:
             attrs['id'] = html_id
 
         name = attrs.get('name', None)
         if name is not None:
-            attrs['value'] = self.form_vars.get(self.name, {}).get(name, attrs.get('value', ''))
-            error = self.form_errors.get(self.name, {}).get(name, None)
+            attrs['value'] = self.field_value(name, attrs.get('value', ''))
+            error = self.field_error(name)
             if error is not None:
                 if 'class' in attrs:
                     attrs['class'] = 'error ' + attrs['class']
                 else:
                     attrs['class'] = 'error'
 
-        return self.build_tag('input', attrs)
+        return attrs
 
-    def label_tag(self, attrs):
+    def label_tag(self, attrs, out=None):
+        return _output(self.build_tag('label', self.label_attrs(attrs), close=False, label=False), out)
+
+    def label_attrs(self, attrs):
         label_for = attrs.pop('name', None)
         for_id = self._assign_tag_to_label(label_for, attrs)
         if for_id is not None:
             attrs['for'] = for_id
 
-        return self.build_tag('label', attrs, close=False)
+        return attrs
 
-    def password_tag(self, attrs):
+    def password_tag(self, attrs, out=None):
         attrs['type'] = 'password'
-        return self.input_tag(attrs)
+        return self.input_tag(attrs, out)
 
-    def quick_select_tag(self, attrs):
-        options = list(attrs.pop('options', []))[:]
+    def quick_select_tag(self, attrs, option_cache=None, out=None):
+        options = attrs.pop('options', [])
         prompt = attrs.pop('prompt', None)
+        cache_key = attrs.pop('cache_key', None)
         name = attrs.get('name', None)
-        error = self.form_errors.get(self.name, {}).get(name, None)
+        error = self.field_error(name)
         if error is not None:
             if 'class' in attrs:
                 attrs['class'] = 'error ' + attrs['class']
             else:
                 attrs['class'] = 'error'
 
-        ret = self.build_tag('select', attrs, close=False)
+        ret = [] if out is None else None
+        write = ret.append if out is None else writer(out)
+        write(self.build_tag('select', attrs, close=False))
+        selected = self._selected_values(self._multi_value(name))
         if prompt:
-            options.insert(0, (None, prompt))
+            write(self._option_tag(None, prompt, selected))
+        if option_cache is not None:
+            option_cache.get(options, cache_key).write(selected, write)
+        else:
+            for opt in options:
+                write(self._option_tag(opt[0], opt[1], selected))
+        write(u'</select>')
 
-        value = self.form_vars.get(self.name, {}).get(name, '')
+        if ret is not None:
+            return u''.join(ret)
 
-        for opt in options:
-            attrs = {'value': opt[0]}
-            if self._is_match(value, opt[0]):
-                attrs['selected'] = 'selected'
-            ret += self.build_tag('option', attrs, close=False) + cgi.escape(opt[1]) + '</option>'
+    def _option_tag(self, value, label, selected):
+        key = unicode(value)
+        if key in selected:
+            start = u'<option selected="selected" value="'
+        else:
+            start = u'<option value="'
+        return u'{}{}">{}</option>'.format(start, escape(key if value is not None else u''), escape(label))
+
+    def _multi_value(self, name):
+        # The value of a field that can take several, such as a checkbox group
+        # or a multiple select: a list where the value source has several.
+        getlist = getattr(self.values, 'getlist', None)
+        if getlist is None:
+            return self.field_value(name)
+        values = getlist(name)
+        if len(values) == 1:
+            return values[0]
+        return values or self.field_value(name)
+
+    def _selected_values(self, value):
+        # The selected values of a field as a set of strings, so that matching
+        # each option is a single lookup, however many values are selected.
+        if isinstance(value, (list, tuple)):
+            return set([unicode(x) for x in value])
+        return set([unicode(value)])
+
+    def radio_tag(self, attrs, out=None):
+        attrs['type'] = 'radio'
+        return _output(self.build_tag('input', self.radio_attrs(attrs), label=False), out)
 
-        return ret + '</select>'
+    def radio_attrs(self, attrs):
+        html_id = self._assign_label_to_tag(attrs)
+        if html_id is not None:
+            attrs['id'] = html_id
 
-    def radio_tag(self, attrs):
-        attrs['type'] = 'radio'
         name = attrs.get('name', None)
         if name is not None:
-            value = self.form_vars.get(self.name, {}).get(name, '')
+            value = self.field_value(name)
             if self._is_match(value, attrs.get('value', None)):
                 attrs['checked'] = 'checked'
             else:
                 attrs.pop('checked', None)
 
-            error = self.form_errors.get(self.name, {}).get(name, None)
+            error = self.field_error(name)
             if error:
                 if 'class' in attrs:
                     attrs['class'] = 'error ' + attrs['class']
                 else:
                     attrs['class'] = 'error'
 
-        return self.build_tag('input', attrs)
+        return attrs
 
-    def submit_tag(self, attrs):
+    def submit_tag(self, attrs, out=None):
         attrs['type'] = 'submit'
-        return self.input_tag(attrs)
+        return self.input_tag(attrs, out)
 
-    def start_tag(self):
+    def start_tag(self, out=None):
         ret = self.build_tag('form', self.attrs, close=False)
 
         if self.base_name is not None and self.name_key is not None:
-            return ret + self.build_tag('input', {'type': 'hidden',
-                                                  'name': self.name_key,
-                                                  'value': self.base_name}, label=False)
-        return ret
-
-    def text_tag(self, attrs):
+            name = self.build_tag('input', {'type': 'hidden',
+                                            'name': self.name_key,
+                                            'value': self.base_name}, label=False)
+            if out is None:
+                return ret + name
+            write = writer(out)
+            write(ret)
+            write(name)
+            return None
+        return _output(ret, out)
+
+    def text_tag(self, attrs, out=None):
         attrs['type'] = 'text'
-        return self.input_tag(attrs)
-
-    def textarea_tag(self, attrs):
+        return self.input_tag(attrs, out)
+
+    def textarea_tag(self, attrs, out=None):
+        if out is not None:
+            return self.write_textarea(writer(out), attrs)
+        attrs = self.textarea_attrs(attrs)
+        return u'{}{}</textarea>'.format(self.build_tag('textarea', attrs, close=False, label=False),
+                                         self.textarea_value(attrs.get('name', None)))
+
+    def write_textarea(self, write, attrs):
+        """Writes a textarea with write(), its value in escaped chunks, so
+        that a large value, or a file or iterator, is never held whole."""
+        attrs = self.textarea_attrs(attrs)
+        write(self.build_tag('textarea', attrs, close=False, label=False))
+        for chunk in self.textarea_chunks(attrs.get('name', None)):
+            write(chunk)
+        write(u'</textarea>')
+
+    def textarea_attrs(self, attrs):
         html_id = self._assign_label_to_tag(attrs)
         if html_id is not None:
             attrs['id'] = html_id
 
         name = attrs.get('name', None)
-        value = ''
         if name is not None:
-            value = self.form_vars.get(self.name, {}).get(name, '')
-            error = self.form_errors.get(self.name, {}).get(name, None)
+            error = self.field_error(name)
             if error is not None:
                 if 'class' in attrs:
                     attrs['class'] = 'error ' + attrs['class']
                 else:
                     attrs['class'] = 'error'
 
-        return u'{}{}</textarea>'.format(self.build_tag('textarea', attrs, close=False), cgi.escape(value or ''))
+        return attrs
+
+    def textarea_value(self, name):
+        return u''.join(self.textarea_chunks(name))
+
+    def textarea_chunks(self, name):
+        "The escaped value of a textarea, in chunks of at most CHUNK_SIZE characters."
+        value = None
+        if name is not None:
+            value = self.field_value(name)
+        if not value:
+            return ()
+        return escape_chunks(value)
 
 
     def _assign_label_to_tag(self, attrs):
-        if attrs.get('name', None) is not None and not 'id' in attrs:
-            name = attrs['name']
-            if len(self.inputless_labels.get(name,[])) != 0:
-                html_id = self.inputless_labels[name].pop(0)
-            else:
-                html_id = self.html_id()
-                self.labeless_inputs.setdefault(name, [])
-                self.labeless_inputs[name].append(html_id)
-            return html_id
+        name = attrs.get('name', None)
+        if name is not None and not 'id' in attrs:
+            return self._pair_id(name, self.inputless_labels, self.labeless_inputs)
 
         return None
 
     def _assign_tag_to_label(self, label_for, attrs):
         if label_for is not None and not 'id' in attrs :
-            if len(self.labeless_inputs.get(label_for, [])) != 0:
-                for_id = self.labeless_inputs[label_for].pop(0)
-            else:
-                for_id = self.html_id()
-                self.inputless_labels.setdefault(label_for, [])
-                self.inputless_labels[label_for].append(for_id)
-            return for_id
+            return self._pair_id(label_for, self.labeless_inputs, self.inputless_labels)
 
         return None
 
+    def _pair_id(self, name, waiting, pending):
+        # Takes the oldest id waiting for a partner under `name`, or makes up
+        # a new one and leaves it pending for the next tag of the other kind.
+        # A lone pending id is stored as is; a deque is only used once several
+        # tags with the same name are waiting.
+        queue = waiting.get(name)
+        if queue is not None:
+            if queue.__class__ is not deque:
+                del waiting[name]
+                return queue
+            html_id = queue.popleft()
+            if not queue:
+                del waiting[name]
+            return html_id
+
+        html_id = self.html_id()
+        queue = pending.get(name)
+        if queue is None:
+            pending[name] = html_id
+        elif queue.__class__ is deque:
+            queue.append(html_id)
+        else:
+            pending[name] = deque((queue, html_id))
+        return html_id
+
     def _default_error(self, message, attrs):
         if 'class' in attrs:
             attrs['class'] = 'error ' + attrs['class']
@@ -270,16 +593,283 @@ class Form(object):
         return self.build_tag('span', attrs, close=False, label=False) + unicode(message) + '</span>'
 
 class StubForm(Form):
-    def __init__(self):
-        Form.__init__(self, '', '', '', {}, '', {}, {})
-
-def build_tag(tag, attrs, close=False):
-    tag = '<' + cgi.escape(tag)
-    for k,v in attrs.items():
+    __slots__ = ()
+
+    def __init__(self, html_ids=None, sort_attrs=False):
+        Form.__init__(self, '', '', '', {}, '', {}, {}, html_ids=html_ids, sort_attrs=sort_attrs)
+
+class RepeatForm(Form):
+    """A form that is rendered once per record and filled straight from it.
+    The start tag is built once; each row only resets the form state."""
+    __slots__ = ('start',)
+
+    def __init__(self, *args, **kwargs):
+        Form.__init__(self, *args, **kwargs)
+        self.start = self.start_tag()
+
+    def row_tag(self, record, ctx=None, out=None):
+        self.inputless_labels.clear()
+        self.labeless_inputs.clear()
+        self.name = self.base_name if ctx is None else ctx
+        self.values = value_source(record)
+        self.errors = self.form_errors.get(self.name) or _empty
+
+        if ctx is not None:
+            self.html_ids = ids_for_context(self.html_ids, ctx)
+            if self.ctx_key:
+                ctx_input = build_tag('input', {'type': 'hidden',
+                                                'name': self.ctx_key,
+                                                'value': ctx}, close=True, sort=self.sort_attrs)
+                if out is None:
+                    return self.start + ctx_input
+                write = writer(out)
+                write(self.start)
+                write(ctx_input)
+                return None
+        return _output(self.start, out)
+
+class OptionCache(object):
+    """An LRU cache of the pre-rendered <option> markup of quickselects.
+
+    Entries are keyed by the quickselect's `cache_key` attribute or, without
+    one, by the identity of its options sequence; an entry is not refreshed if
+    that sequence is later changed in place. Rendering a cached entry only
+    patches in the selected markers."""
+    def __init__(self, size=128):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, options, cache_key=None):
+        key = ('id', id(options)) if cache_key is None else ('key', cache_key)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (cache_key is not None or entry.options is options):
+                self.hits += 1
+                self._entries[key] = entry
+                return entry
+
+            self.misses += 1
+
+        entry = _RenderedOptions(options)
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries),
+                    'size': self.size}
+
+class _RenderedOptions(object):
+    __slots__ = ('options', 'parts', 'html', 'index')
+
+    def __init__(self, options):
+        self.options = options
+        self.parts = []
+        self.index = {}
+        for i, opt in enumerate(options):
+            key = unicode(opt[0])
+            self.parts.append(u'<option value="{}">{}</option>'.format(escape(key if opt[0] is not None else u''),
+                                                                       escape(opt[1])))
+            self.index.setdefault(key, []).append(i)
+        self.html = u''.join(self.parts)
+
+    def render(self, selected):
+        ret = []
+        self.write(selected, ret.append)
+        return u''.join(ret)
+
+    def write(self, selected, write):
+        positions = sorted(i for key in selected for i in self.index.get(key, ()))
+        if not positions:
+            write(self.html)
+            return
+
+        # The unselected options are written part by part, as they were
+        # rendered, rather than joined into a new string first.
+        parts = self.parts
+        start = 0
+        for i in positions:
+            for part in parts[start:i]:
+                write(part)
+            write(u'<option selected="selected"' + parts[i][7:])
+            start = i + 1
+        for part in parts[start:]:
+            write(part)
+
+# Id strategies. Calling a strategy starts a new render and returns the
+# function that hands out that render's ids.
+_render_serial = itertools.count(1)
+
+class CounterIds(object):
+    "Sequential ids: fp-<render>-<n>."
+    def __init__(self, prefix='fp'):
+        self.prefix = prefix
+
+    def __call__(self):
+        base = u'{}-{}-'.format(self.prefix, next(_render_serial))
+        counter = itertools.count(1)
+        return lambda: base + unicode(next(counter))
+
+class PooledIds(object):
+    "Unguessable ids: os.urandom is read once per render and suffixed with a counter."
+    def __init__(self, prefix='fp', entropy=8):
+        self.prefix = prefix
+        self.entropy = entropy
+
+    def __call__(self):
+        base = u'{}-{}-'.format(self.prefix, hexlify(os.urandom(self.entropy)).decode('ascii'))
+        counter = itertools.count(1)
+        return lambda: base + unicode(next(counter))
+
+class RandomIds(object):
+    "The original scheme: 32 random letters and digits per id."
+    source = string.ascii_letters + string.digits
+
+    def __init__(self, length=32):
+        self.length = length
+
+    def __call__(self):
+        choice = Random().choice
+        source = self.source
+        length = range(self.length)
+        return lambda: u''.join([choice(source) for x in length])
+
+class FormIds(object):
+    """Stable ids: fp-<context>-<n>, numbered in order within each form
+    context. A form gets the same ids on every render, as cached forms and
+    deterministic output need. Forms and contexts are also counted in each
+    render, so that the second form with a name gets ids of its own, such as
+    fp-login.2-1, and ids stay unique within the page."""
+    stable = True
+
+    def __init__(self, prefix='fp'):
+        self.prefix = prefix
+
+    def __call__(self):
+        return _ContextIds(self.prefix, None, {})
+
+    def form_ids(self, name):
+        return _ContextIds(self.prefix, name, {})
+
+class _ContextIds(object):
+    """The ids of one form context of a FormIds strategy. `seen` counts the
+    contexts of the render by their part of the id."""
+    __slots__ = ('prefix', 'base', 'counter', 'seen')
+
+    def __init__(self, prefix, name, seen):
+        self.prefix = prefix
+        self.seen = seen
+        if name:
+            base = u'{}-{}'.format(prefix, _id_unsafe.sub(u'-', unicode(name)))
+        else:
+            base = prefix
+        # Names are made of letters, digits, _ and -, so the occurrence
+        # after the dot can't be confused with another name.
+        n = seen[base] = seen.get(base, 0) + 1
+        if n > 1:
+            base = u'{}.{}'.format(base, n)
+        self.base = base + u'-'
+        self.counter = itertools.count(1)
+
+    def __call__(self):
+        return self.base + unicode(next(self.counter))
+
+    def context(self, name):
+        return _ContextIds(self.prefix, name, self.seen)
+
+_id_unsafe = re.compile(r'[^\w-]', re.UNICODE)
+
+# Used by deterministic renders whose id strategy is not stable.
+deterministic_ids = FormIds()
+
+def ids_for_form(strategy, name, html_ids=None):
+    """The id function of the form `name`: its own with a stable strategy,
+    counted among the forms of the render that `html_ids` belongs to,
+    otherwise `html_ids`, the function of the current render, or a new one."""
+    if getattr(strategy, 'stable', False):
+        context = getattr(html_ids, 'context', None)
+        return context(name) if context is not None else strategy.form_ids(name)
+    return html_ids or strategy()
+
+def ids_for_context(html_ids, name):
+    "The id function for a form that switches to the context `name`."
+    context = getattr(html_ids, 'context', None)
+    return context(name) if context is not None else html_ids
+
+def render_strategy(strategy, deterministic):
+    "The id strategy of a render: `strategy`, unless that would not be deterministic."
+    if deterministic and not getattr(strategy, 'stable', False):
+        return deterministic_ids
+    return strategy
+
+default_id_strategy = CounterIds()
+
+# Attributes that Form reads or rewrites while rendering a named tag. These are
+# always evaluated at render time; everything else that is constant can be
+# serialized once, when a template is compiled.
+runtime_attrs = frozenset(['name', 'id', 'value', 'class', 'checked'])
+
+# Serialization plans, keyed on (tag, attribute keys). A plan holds the
+# pre-escaped markup that goes before each value, plus the markup that follows
+# the last one, so rendering a known shape only has to escape values. Like the
+# re module's cache, it is simply emptied when it grows too large.
+_plans = {}
+_MAX_PLANS = 512
+
+def _build_plan(tag, keys):
+    segments = []
+    prev = u'<' + escape(tag) if tag is not None else u''
+    for k in keys:
         if k.endswith('_'):
             k = k[:-1]
-        tag += u' {}="{}"'.format(cgi.escape(k.replace('_', '-')), cgi.escape(unicode(v if v is not None else '')))
-
+        segments.append(u'{} {}="'.format(prev, escape(k.replace('_', '-'))))
+        prev = u'"'
+
+    plan = (segments, prev)
+    if len(_plans) >= _MAX_PLANS:
+        _plans.clear()
+    _plans[(tag, keys)] = plan
+    return plan
+
+def _serialize(tag, attrs, sort=False):
+    if sort:
+        items = sorted(attrs.items())
+        keys = tuple([k for k, v in items])
+        values = [v for k, v in items]
+    else:
+        keys = tuple(attrs)
+        values = attrs.values()
+    plan = _plans.get((tag, keys))
+    if plan is None:
+        plan = _build_plan(tag, keys)
+
+    segments, end = plan
+    ret = []
+    for segment, v in zip(segments, values):
+        ret.append(segment)
+        ret.append(escape(v if v is not None else u''))
+    ret.append(end)
+    return u''.join(ret)
+
+def build_attrs(attrs, sort=False):
+    return _serialize(None, attrs, sort)
+
+def build_tag(tag, attrs, close=False, sort=False):
+    """Renders a start tag. With `sort`, attributes are written in order of
+    their names rather than in the order of `attrs`."""
     if close:
-        return tag +' />'
-    return tag + '>'
+        return _serialize(tag, attrs, sort) + u' />'
+    return _serialize(tag, attrs, sort) + u'>'
@@ -0,0 +1,6 @@
+"""Benchmarks for FormPump.
+
+`python -m formpump.bench` renders the same forms through every installed
+engine (see scenarios.py). The other modules are micro-benchmarks of single
+parts of formpump.base, each run as `python -m formpump.bench.<module>`.
+"""
@@ -0,0 +1,105 @@
+"""Renders the scenarios in formpump.bench.scenarios through every installed
+engine, and reports renders/sec and the overhead per FormPump tag against the
+same form written by hand:
+
+    python -m formpump.bench
+    python -m formpump.bench --engine mako --scenario filled --json results.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+from .scenarios import SCENARIOS
+
+def jinja_engine():
+    import jinja2
+    import formpump
+    env = jinja2.Environment(extensions=[formpump.JinjaPump])
+    return jinja2.__version__, lambda source: env.from_string(source).render
+
+def mako_engine():
+    import mako
+    from mako.template import Template
+    return mako.__version__, lambda source: Template(source).render
+
+def mako_inline_engine():
+    import mako
+    from mako.template import Template
+    from formpump.makopump import inline_tags
+    return mako.__version__, lambda source: Template(source, preprocessor=inline_tags).render
+
+ENGINES = [('jinja', jinja_engine), ('mako', mako_engine), ('mako-inline', mako_inline_engine)]
+
+def measure(render, context, number, repeat):
+    "The best time of a single render, in seconds."
+    return min(timeit.repeat(lambda: render(**context), repeat=repeat, number=number)) / number
+
+def run(engines, scenarios, number=20, repeat=3):
+    results = []
+    for engine, (version, compile_template) in engines:
+        for scenario in scenarios:
+            context = scenario.context()
+            pump, html = [compile_template(source) for source in scenario.templates[engine]]
+            pump_time = measure(pump, context, number, repeat)
+            html_time = measure(html, context, number, repeat)
+            tags = scenario.tags(context)
+            results.append({'engine': engine,
+                            'engine_version': version,
+                            'scenario': scenario.name,
+                            'tags': tags,
+                            'renders_per_sec': 1 / pump_time,
+                            'html_renders_per_sec': 1 / html_time,
+                            'tag_overhead_us': (pump_time - html_time) / tags * 1e6})
+    return results
+
+def report(results, out):
+    out.write('%-11s %-12s %6s %12s %12s %14s\n' % ('engine', 'scenario', 'tags', 'renders/s',
+                                                   'html r/s', 'us/tag extra'))
+    for result in results:
+        out.write('%(engine)-11s %(scenario)-12s %(tags)6d %(renders_per_sec)12.1f '
+                  '%(html_renders_per_sec)12.1f %(tag_overhead_us)14.2f\n' % result)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m formpump.bench', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--engine', action='append', choices=[name for name, factory in ENGINES],
+                        help='only benchmark this engine; may be repeated')
+    parser.add_argument('--scenario', action='append', choices=[s.name for s in SCENARIOS],
+                        help='only run this scenario; may be repeated')
+    parser.add_argument('--number', type=int, default=20, help='renders per timing (default: 20)')
+    parser.add_argument('--repeat', type=int, default=3, help='timings per scenario (default: 3)')
+    parser.add_argument('--json', metavar='PATH', help="write the results as JSON to PATH, or '-' for stdout")
+    args = parser.parse_args(argv)
+
+    engines = []
+    for name, factory in ENGINES:
+        if args.engine and name not in args.engine:
+            continue
+        try:
+            engines.append((name, factory()))
+        except ImportError as e:
+            sys.stderr.write('skipping %s: %s\n' % (name, e))
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    results = run(engines, scenarios, args.number, args.repeat)
+
+    if args.json == '-':
+        out = sys.stdout
+    else:
+        report(results, sys.stdout)
+        out = open(args.json, 'w') if args.json else None
+
+    if out is not None:
+        json.dump({'python': platform.python_version(),
+                   'implementation': platform.python_implementation(),
+                   'number': args.number,
+                   'repeat': args.repeat,
+                   'results': results}, out, indent=2, sort_keys=True)
+        out.write('\n')
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
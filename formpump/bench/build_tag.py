@@ -0,0 +1,56 @@
+"""Micro-benchmark for base.build_tag on a 500-field form.
+
+Compares the per-tag cost of the cached serialization plans against the
+original implementation, which escaped every key on every call:
+
+    python -m formpump.bench.build_tag
+"""
+
+import timeit
+
+from formpump.base import build_tag, escape, unicode
+
+FIELDS = 500
+REPEAT = 5
+NUMBER = 20
+
+def legacy_build_tag(tag, attrs, close=False):
+    tag = '<' + escape(tag)
+    for k,v in attrs.items():
+        if k.endswith('_'):
+            k = k[:-1]
+        tag += u' {}="{}"'.format(escape(k.replace('_', '-')), escape(unicode(v if v is not None else '')))
+
+    if close:
+        return tag +' />'
+    return tag + '>'
+
+def form_tags():
+    tags = []
+    for i in range(FIELDS):
+        name = 'field_%d' % i
+        html_id = 'fp-1-%d' % i
+        tags.append(('label', {'for': html_id}, False))
+        tags.append(('input', {'type': 'text', 'name': name, 'value': 'value %d' % i,
+                               'id': html_id, 'class_': 'wide', 'data_row': i}, True))
+        tags.append(('option', {'value': i, 'selected': 'selected'}, False))
+    return tags
+
+def render(func, tags):
+    for tag, attrs, close in tags:
+        func(tag, attrs, close=close)
+
+def main():
+    tags = form_tags()
+    for tag, attrs, close in tags:
+        assert legacy_build_tag(tag, attrs, close) == build_tag(tag, attrs, close)
+
+    print('%d tags per render (%d fields)' % (len(tags), FIELDS))
+    for label, func in (('before', legacy_build_tag), ('after', build_tag)):
+        best = min(timeit.repeat(lambda: render(func, tags), repeat=REPEAT, number=NUMBER))
+        print('%-7s %8.3f ms/form %8.3f us/tag' % (label,
+                                                     best / NUMBER * 1e3,
+                                                     best / NUMBER / len(tags) * 1e6))
+
+if __name__ == '__main__':
+    main()
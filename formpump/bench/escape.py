@@ -0,0 +1,62 @@
+"""Benchmark for escaping on an attribute-heavy form.
+
+Renders a form of text inputs, checkboxes and textareas with many attributes
+each, escaping with base.escape and with the original
+cgi.escape(unicode(v)):
+
+    python -m formpump.bench.escape
+"""
+
+import timeit
+
+from formpump import base
+from formpump.base import Form, unicode
+
+try:
+    from cgi import escape as cgi_escape
+except ImportError:
+    from html import escape as _html_escape
+
+    def cgi_escape(s):
+        return _html_escape(s, False)
+
+FIELDS = 300
+REPEAT = 5
+NUMBER = 10
+
+def legacy_escape(value):
+    return cgi_escape(unicode(value))
+
+def form_values():
+    values = {}
+    for i in range(FIELDS):
+        values['name_%d' % i] = 'Value %d' % i
+        values['note_%d' % i] = 'A <longer> note & more for field %d' % i
+        values['flag_%d' % i] = 'on'
+    return values
+
+def render(values):
+    form = Form('test', None, None, {'action': '', 'method': 'post'}, '', {'test': values}, {})
+    ret = [form.start_tag()]
+    for i in range(FIELDS):
+        ret.append(form.text_tag({'name': 'name_%d' % i, 'class_': 'wide', 'data_row': i,
+                                  'placeholder': 'Name', 'maxlength': 80, 'autocomplete': 'off'}))
+        ret.append(form.checkbox_tag({'name': 'flag_%d' % i, 'value': 'on', 'data_row': i}))
+        ret.append(form.textarea_tag({'name': 'note_%d' % i, 'rows': 3, 'cols': 40, 'data_row': i}))
+    ret.append(form.end_tag())
+    return u''.join(ret)
+
+def main():
+    values = form_values()
+    escape = base.escape
+    print('%d fields, 3 tags each' % FIELDS)
+    for label, func in (('before', legacy_escape), ('after', escape)):
+        base.escape = func
+        try:
+            best = min(timeit.repeat(lambda: render(values), repeat=REPEAT, number=NUMBER))
+        finally:
+            base.escape = escape
+        print('%-7s %8.3f ms/form' % (label, best / NUMBER * 1e3))
+
+if __name__ == '__main__':
+    main()
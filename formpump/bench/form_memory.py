@@ -0,0 +1,65 @@
+"""Memory benchmark for Form on a page with 10,000 form blocks.
+
+Each form gets one labelled input and one input still waiting for its label,
+and all of them are kept alive, as they would be while a page holding that
+many forms is being assembled. The slotted Form is compared against the same
+class without __slots__, which is how Form used to be stored:
+
+    python -m formpump.bench.form_memory
+"""
+
+import gc
+import sys
+
+from formpump.base import Form, CounterIds
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FORMS = 10000
+
+DictForm = type('DictForm', (object,),
+                dict((k, v) for k, v in vars(Form).items()
+                     if k not in Form.__slots__ and k not in ('__slots__', '__dict__', '__weakref__')))
+
+def build_page(cls):
+    html_ids = CounterIds()()
+    forms = []
+    for i in range(FORMS):
+        form = cls('form', None, None, {}, '', {}, {}, html_ids=html_ids)
+        form.label_tag({'name': 'a'})
+        form.text_tag({'name': 'a'})
+        form.text_tag({'name': 'b'})
+        forms.append(form)
+    return forms
+
+def footprint(cls):
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        forms = build_page(cls)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size
+
+    # Without tracemalloc, only count the objects that make up each form.
+    forms = build_page(cls)
+    size = 0
+    for form in forms:
+        size += sys.getsizeof(form) + sys.getsizeof(getattr(form, '__dict__', {}))
+        for pending in (form.inputless_labels, form.labeless_inputs):
+            size += sys.getsizeof(pending) + sum(sys.getsizeof(ids) for ids in pending.values())
+    return size
+
+def main():
+    if tracemalloc is None:
+        print('tracemalloc is unavailable; counting form objects only')
+    print('%d forms per page' % FORMS)
+    for label, cls in (('dict', DictForm), ('slots', Form)):
+        size = footprint(cls)
+        print('%-6s %8.1f KiB/page %6d bytes/form' % (label, size / 1024.0, size // FORMS))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Benchmark for Form.quick_select_tag with large option lists.
+
+Compares the set-based, linear-time implementation against the original one,
+which rebuilt the list of selected values for every option and grew its
+output with +=, and against rendering through an OptionCache:
+
+    python -m formpump.bench.quick_select
+"""
+
+import timeit
+
+from formpump.base import Form, OptionCache, escape
+
+OPTIONS = [(i, 'Option %d' % i) for i in range(5000)]
+NUMBER = 5
+
+def legacy_quick_select_tag(form, attrs):
+    options = list(attrs.pop('options', []))[:]
+    prompt = attrs.pop('prompt', None)
+    name = attrs.get('name', None)
+
+    ret = form.build_tag('select', attrs, close=False)
+    if prompt:
+        options.insert(0, (None, prompt))
+
+    value = form.values.get(name, '')
+
+    for opt in options:
+        attrs = {'value': opt[0]}
+        if form._is_match(value, opt[0]):
+            attrs['selected'] = 'selected'
+        ret += form.build_tag('option', attrs, close=False) + escape(opt[1]) + '</option>'
+
+    return ret + '</select>'
+
+def quick_select_tag(form, attrs):
+    return form.quick_select_tag(attrs)
+
+option_cache = OptionCache()
+
+def cached_quick_select_tag(form, attrs):
+    return form.quick_select_tag(attrs, option_cache)
+
+def render(func, value):
+    form = Form('test', None, None, {}, '', {'test': {'var': value}}, {})
+    return func(form, {'name': 'var', 'id': 'var', 'options': OPTIONS})
+
+def main():
+    cases = (('single', 2500),
+             ('multi', [i * 16 for i in range(300)]))
+    for case, value in cases:
+        print('%s-select, %d options' % (case, len(OPTIONS)))
+        for label, func in (('before', legacy_quick_select_tag), ('after', quick_select_tag),
+                            ('cached', cached_quick_select_tag)):
+            best = min(timeit.repeat(lambda: render(func, value), repeat=3, number=NUMBER))
+            print('  %-7s %8.2f ms/select' % (label, best / NUMBER * 1e3))
+    print('option cache: %(hits)d hits, %(misses)d misses' % option_cache.stats())
+
+if __name__ == '__main__':
+    main()
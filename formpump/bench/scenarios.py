@@ -0,0 +1,179 @@
+"""The forms rendered by `python -m formpump.bench`.
+
+Each scenario is written four times: with FormPump tags and by hand, for both
+Jinja2 and Mako. The hand-written templates produce the same markup (minus the
+generated ids) with plain, escaped expressions, and are the baseline the
+FormPump overhead is measured against.
+"""
+
+_MAKO_NAMESPACE = u'<%namespace name="fp" module="formpump.makopump" />\n'
+
+class Scenario(object):
+    "A form rendered by every engine, with FormPump tags and by hand."
+    def __init__(self, name, description, context, tags, jinja, jinja_html, mako, mako_html):
+        self.name = name
+        self.description = description
+        # Builds the template variables; called once per benchmark run.
+        self.context = context
+        # The number of FormPump tags each render evaluates.
+        self.tags = tags
+        self.templates = {'jinja': (jinja, jinja_html),
+                          'mako': (_MAKO_NAMESPACE + mako, mako_html)}
+        # The same Mako templates, compiled with makopump.inline_tags.
+        self.templates['mako-inline'] = self.templates['mako']
+
+def _fields(count):
+    return ['field_%d' % i for i in range(count)]
+
+def _blank():
+    return {'fields': _fields(10)}
+
+def _filled():
+    fields = _fields(300)
+    values = dict((f, u'Value <%d> & more' % i) for i, f in enumerate(fields))
+    return {'fields': fields,
+            'values': values,
+            'form_vars': {'filled': values}}
+
+def _quickselect():
+    options = [(i, u'Option %d' % i) for i in range(1000)]
+    selects = _fields(5)
+    values = dict((s, i * 100) for i, s in enumerate(selects))
+    return {'selects': selects,
+            'options': options,
+            'values': values,
+            'form_vars': {'quickselect': values}}
+
+def _choices():
+    groups = _fields(50)
+    choices = ['a', 'b', 'c', 'd', 'e']
+    values = dict((g, choices[i % len(choices)]) for i, g in enumerate(groups))
+    checked = dict(('check_%s' % g, i % 2 == 0) for i, g in enumerate(groups))
+    form_vars = dict(values)
+    form_vars.update(checked)
+    return {'groups': groups,
+            'choices': choices,
+            'values': values,
+            'checked': checked,
+            'form_vars': {'choices': form_vars}}
+
+def _form_ctx():
+    people = [{'id': i, 'name': u'Person <%d>' % i, 'phone': u'555-%04d' % i} for i in range(100)]
+    return {'people': people,
+            'form_vars': dict(('person.%d' % p['id'], p) for p in people)}
+
+def _errors():
+    fields = _fields(100)
+    return {'fields': fields,
+            'values': dict((f, u'bad value') for f in fields),
+            'errors': dict((f, u'%s is <required>' % f) for f in fields),
+            'form_vars': {'errors': dict((f, u'bad value') for f in fields)},
+            'form_errors': {'errors': dict((f, u'%s is <required>' % f) for f in fields)}}
+
+SCENARIOS = [
+    Scenario('blank', 'a blank form of 10 labelled text inputs', _blank,
+             lambda ctx: 2 * len(ctx['fields']) + 1,
+             u'{% form "blank" %}{% for f in fields %}'
+             u'{% label name=f %}{{ f }}{% endlabel %}{% text name=f %}'
+             u'{% endfor %}{% endform %}',
+             u'<form action="" method="post">{% for f in fields %}'
+             u'<label for="{{ f|e }}">{{ f }}</label><input type="text" name="{{ f|e }}" value="" id="{{ f|e }}" />'
+             u'{% endfor %}</form>',
+             u'<%fp:form name="blank">\n% for f in fields:\n'
+             u'<%fp:label name="${f}">${f}</%fp:label><%fp:text name="${f}" />\n'
+             u'% endfor\n</%fp:form>',
+             u'<form action="" method="post">\n% for f in fields:\n'
+             u'<label for="${f | h}">${f}</label><input type="text" name="${f | h}" value="" id="${f | h}" />\n'
+             u'% endfor\n</form>'),
+
+    Scenario('filled', 'a filled form of 300 text inputs', _filled,
+             lambda ctx: len(ctx['fields']) + 1,
+             u'{% form "filled" %}{% for f in fields %}{% text name=f %}{% endfor %}{% endform %}',
+             u'<form action="" method="post">{% for f in fields %}'
+             u'<input type="text" name="{{ f|e }}" value="{{ values[f]|e }}" />'
+             u'{% endfor %}</form>',
+             u'<%fp:form name="filled">\n% for f in fields:\n'
+             u'<%fp:text name="${f}" />\n'
+             u'% endfor\n</%fp:form>',
+             u'<form action="" method="post">\n% for f in fields:\n'
+             u'<input type="text" name="${f | h}" value="${values[f] | h}" />\n'
+             u'% endfor\n</form>'),
+
+    Scenario('quickselect', '5 quickselects of 1000 options', _quickselect,
+             lambda ctx: len(ctx['selects']) + 1,
+             u'{% form "quickselect" %}{% for s in selects %}'
+             u'{% quickselect name=s options=options %}'
+             u'{% endfor %}{% endform %}',
+             u'<form action="" method="post">{% for s in selects %}<select name="{{ s|e }}">'
+             u'{% for value, label in options %}'
+             u'<option{% if value == values[s] %} selected="selected"{% endif %} value="{{ value|e }}">{{ label|e }}</option>'
+             u'{% endfor %}</select>{% endfor %}</form>',
+             u'<%fp:form name="quickselect">\n% for s in selects:\n'
+             u'<%fp:quickselect name="${s}" options="${options}" />\n'
+             u'% endfor\n</%fp:form>',
+             u'<form action="" method="post">\n% for s in selects:\n<select name="${s | h}">\n'
+             u'% for value, label in options:\n'
+             u'<option${\' selected="selected"\' if value == values[s] else \'\'} value="${value | h}">${label | h}</option>\n'
+             u'% endfor\n</select>\n% endfor\n</form>'),
+
+    Scenario('choices', '50 groups of 5 radios and a checkbox', _choices,
+             lambda ctx: len(ctx['groups']) * (len(ctx['choices']) + 1) + 1,
+             u'{% form "choices" %}{% for g in groups %}'
+             u'{% for c in choices %}{% radio name=g value=c %}{% endfor %}'
+             u'{% checkbox name="check_" ~ g %}'
+             u'{% endfor %}{% endform %}',
+             u'<form action="" method="post">{% for g in groups %}'
+             u'{% for c in choices %}<input type="radio" name="{{ g|e }}" value="{{ c|e }}"'
+             u'{% if values[g] == c %} checked="checked"{% endif %} />{% endfor %}'
+             u'<input type="checkbox" name="check_{{ g|e }}" value="1"'
+             u'{% if checked["check_" ~ g] %} checked="checked"{% endif %} />'
+             u'{% endfor %}</form>',
+             u'<%fp:form name="choices">\n% for g in groups:\n'
+             u'% for c in choices:\n<%fp:radio name="${g}" value="${c}" />\n% endfor\n'
+             u'<%fp:checkbox name="check_${g}" />\n'
+             u'% endfor\n</%fp:form>',
+             u'<form action="" method="post">\n% for g in groups:\n'
+             u'% for c in choices:\n<input type="radio" name="${g | h}" value="${c | h}"'
+             u'${\' checked="checked"\' if values[g] == c else \'\'} />\n% endfor\n'
+             u'<input type="checkbox" name="check_${g | h}" value="1"'
+             u'${\' checked="checked"\' if checked["check_" + g] else \'\'} />\n'
+             u'% endfor\n</form>'),
+
+    Scenario('form_ctx', '100 forms switching form_ctx per person', _form_ctx,
+             lambda ctx: 5 * len(ctx['people']),
+             u'{% for person in people %}{% form "person" %}'
+             u'{% form_ctx "person.%d" % person.id %}{% hidden "id" %}'
+             u'{% label "phone" %}{{ person.name }}{% endlabel %}{% text "phone" %}'
+             u'{% endform %}{% endfor %}',
+             u'{% for person in people %}<form action="" method="post">'
+             u'<input type="hidden" name="id" value="{{ person.id|e }}" />'
+             u'<label for="phone-{{ person.id }}">{{ person.name }}</label>'
+             u'<input type="text" name="phone" value="{{ person.phone|e }}" id="phone-{{ person.id }}" />'
+             u'</form>{% endfor %}',
+             u'% for person in people:\n<%fp:form name="person">'
+             u'<%fp:form_ctx name="${\'person.%d\' % person[\'id\']}" /><%fp:hidden name="id" />'
+             u'<%fp:label name="phone">${person[\'name\']}</%fp:label><%fp:text name="phone" />'
+             u'</%fp:form>\n% endfor\n',
+             u'% for person in people:\n<form action="" method="post">'
+             u'<input type="hidden" name="id" value="${person[\'id\'] | h}" />'
+             u'<label for="phone-${person[\'id\']}">${person[\'name\']}</label>'
+             u'<input type="text" name="phone" value="${person[\'phone\'] | h}" id="phone-${person[\'id\']}" />'
+             u'</form>\n% endfor\n'),
+
+    Scenario('errors', 'a form of 100 inputs that all have errors', _errors,
+             lambda ctx: 2 * len(ctx['fields']) + 1,
+             u'{% form "errors" %}{% for f in fields %}'
+             u'{% error name=f %}{% text name=f %}'
+             u'{% endfor %}{% endform %}',
+             u'<form action="" method="post">{% for f in fields %}'
+             u'<span class="error" name="{{ f|e }}">{{ errors[f] }}</span>'
+             u'<input class="error" type="text" name="{{ f|e }}" value="{{ values[f]|e }}" />'
+             u'{% endfor %}</form>',
+             u'<%fp:form name="errors">\n% for f in fields:\n'
+             u'<%fp:error name="${f}" /><%fp:text name="${f}" />\n'
+             u'% endfor\n</%fp:form>',
+             u'<form action="" method="post">\n% for f in fields:\n'
+             u'<span class="error">${errors[f]}</span>'
+             u'<input class="error" type="text" name="${f | h}" value="${values[f] | h}" />\n'
+             u'% endfor\n</form>'),
+    ]
@@ -0,0 +1,197 @@
+"Caching of whole rendered forms, and fingerprints of what forms render from."
+
+from collections import OrderedDict
+import errno
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from .base import AttrValues, CallableValues, MultiDictValues, unicode
+
+class FormCache(object):
+    """Caches the output of form blocks that ask for it with a `cache`
+    attribute, such as {% form "login" cache=True %}.
+
+    A form is keyed by its template, name and attributes, the FormPump settings
+    and its values and errors, plus the value of `cache`. Anything else the
+    block depends on must go into `cache`. Caching needs a stable id strategy,
+    such as FormIds, so that a cached form keeps its ids from render to render.
+    """
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, template_key, name, attrs, values, errors, cache, settings):
+        return _digest((template_key, name, attrs, values, errors, cache, settings))
+
+    def get(self, key):
+        html = self.backend.get(key)
+        with self._lock:
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return html
+
+    def set(self, key, html):
+        self.backend.set(key, unicode(html))
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.0}
+
+def check_strategy(strategy):
+    if not getattr(strategy, 'stable', False):
+        raise ValueError('Caching forms needs a stable id strategy, such as formpump.FormIds(); got %r' % (strategy, ))
+
+def cache_settings(strategy, name_key, ctx_key, default_action, error_renderers, deterministic=False):
+    "The settings that change how a form renders, as part of its cache key."
+    return (type(strategy).__name__, getattr(strategy, 'prefix', None), name_key, ctx_key,
+            default_action() if callable(default_action) else default_action,
+            sorted(error_renderers), deterministic)
+
+def form_fingerprints(form_vars, form_errors=None):
+    """A digest of the values and errors of each form context in `form_vars`
+    and `form_errors`, by name. In deterministic mode, a form renders the same
+    way for as long as its fingerprint and the template stay the same."""
+    form_errors = form_errors or {}
+    return dict((name, _digest((name, form_vars.get(name), form_errors.get(name))))
+                for name in set(form_vars) | set(form_errors))
+
+def fingerprint(form_vars, form_errors=None, extra=None):
+    """A single digest of everything in `form_vars` and `form_errors`, plus
+    `extra` (such as the template version or anything else the page shows), to
+    answer conditional requests with, e.g. as an ETag, without rendering."""
+    return _digest((form_vars, form_errors or {}, extra))
+
+def _digest(value):
+    return hashlib.sha1(_canonical(value).encode('utf-8')).hexdigest()
+
+def _canonical(value):
+    # An unambiguous string for the key of a form. Values are rendered as
+    # unicode, so that is what is compared; safe markup renders differently
+    # from the same string, so it is marked.
+    if value is None:
+        return u'~'
+    if isinstance(value, MultiDictValues):
+        value = value.source
+    getlist = getattr(value, 'getlist', None) or getattr(value, 'getall', None)
+    if getlist is not None:
+        return u'{%s}' % u','.join(sorted(u'%s:%s' % (_canonical(k), _canonical(getlist(k))) for k in set(value.keys())))
+    if isinstance(value, (AttrValues, CallableValues)):
+        raise TypeError('%s values are read lazily and cannot be digested; pass a dict, or a version of them as `cache`'
+                        % type(value).__name__)
+    if isinstance(value, dict):
+        return u'{%s}' % u','.join(sorted(u'%s:%s' % (_canonical(k), _canonical(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_canonical(v) for v in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort()
+        return u'[%s]' % u','.join(items)
+    if hasattr(value, '__html__'):
+        return u'!' + repr(unicode(value.__html__()))
+    return repr(unicode(value))
+
+class MemoryBackend(object):
+    "An in-process LRU of `size` forms."
+    def __init__(self, size=256):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.pop(key, None)
+            if html is not None:
+                self._entries[key] = html
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = html
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class FileBackend(object):
+    """Stores each form as a file in `directory`, so that pre-forked workers
+    share one cache. Files are replaced atomically. Once there are more than
+    `size` forms, the ones read or written longest ago are removed; clear()
+    empties the directory."""
+    def __init__(self, directory, size=1024):
+        self.directory = directory
+        self.size = size
+        # The directory is only listed every tenth of `size` writes, so it can
+        # hold that many forms more than `size` in between.
+        self._sweep_every = max(1, size // 10)
+        self._writes = 0
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with io.open(path, encoding='utf-8', newline='') as f:
+                html = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            # Reading a form makes it the most recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return html
+
+    def set(self, key, html):
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with io.open(fd, 'w', encoding='utf-8', newline='') as f:
+                f.write(html)
+            getattr(os, 'replace', os.rename)(path, os.path.join(self.directory, key))
+        except Exception:
+            os.unlink(path)
+            raise
+        self._writes += 1
+        if self._writes >= self._sweep_every:
+            self._writes = 0
+            self._evict()
+
+    def _evict(self):
+        names = [name for name in os.listdir(self.directory) if not name.startswith('.')]
+        if len(names) <= self.size:
+            return
+        entries = []
+        for name in names:
+            try:
+                entries.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+            except OSError:
+                # Removed by another process meanwhile.
+                pass
+        entries.sort()
+        for mtime, name in entries[:len(entries) - self.size]:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if not name.startswith('.'):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
@@ -0,0 +1,101 @@
+"Decoding of submitted forms, by the inputs that name them."
+
+try:
+    from urllib.parse import unquote_plus as _unquote_plus
+
+    def _unquote(value, encoding):
+        return _unquote_plus(value, encoding=encoding)
+except ImportError:
+    from urllib import unquote_plus as _unquote_plus
+
+    def _unquote(value, encoding):
+        return _unquote_plus(value.encode(encoding)).decode(encoding)
+
+from .base import unicode
+
+class Submission(object):
+    """A submitted form: its `name` and form context `ctx`, from the
+    form_name_key and form_ctx_key inputs, and the `values` of its other
+    inputs, with a list for each name that was submitted more than once."""
+    __slots__ = ('name', 'ctx', 'values')
+
+    def __init__(self, name, ctx, values):
+        self.name = name
+        self.ctx = ctx
+        self.values = values
+
+    @property
+    def context(self):
+        "The form context the values belong to: `ctx`, or else `name`."
+        return self.ctx if self.ctx is not None else self.name
+
+    @property
+    def form_vars(self):
+        "The values as form_vars, to render the form again with."
+        return {self.context: self.values}
+
+    def __repr__(self):
+        return 'Submission(%r, %r, %r)' % (self.name, self.ctx, self.values)
+
+def decode(data, name_key=None, ctx_key=None, encoding='utf-8'):
+    """Decodes the submitted form in `data`: a MultiDict (werkzeug, webob or
+    Django), a dict, a sequence of pairs or an urlencoded body, as bytes or a
+    string. `name_key` and `ctx_key` are the keys the forms were rendered
+    with. The data is read once, in order."""
+    name = ctx = None
+    values = {}
+    for k, v in _pairs(data, encoding):
+        if k == name_key:
+            name = v
+        elif k == ctx_key:
+            ctx = v
+        else:
+            current = values.get(k, values)
+            if current is values:
+                values[k] = v
+            elif current.__class__ is list:
+                current.append(v)
+            else:
+                values[k] = [current, v]
+    return Submission(name, ctx, values)
+
+def _pairs(data, encoding):
+    if isinstance(data, bytes):
+        data = data.decode(encoding)
+    if isinstance(data, unicode):
+        return _parse(data, encoding)
+    items = getattr(data, 'items', None)
+    if hasattr(data, 'getlist'):
+        if hasattr(data, 'lists'):
+            # Django's QueryDict, and werkzeug's MultiDict.
+            return ((k, v) for k, vs in data.lists() for v in vs)
+        return _lists(data)
+    if items is not None:
+        # dicts, and webob's MultiDict, whose items are every pair.
+        return items()
+    return data
+
+def _lists(data):
+    seen = set()
+    for k in data.keys():
+        if k not in seen:
+            seen.add(k)
+            for v in data.getlist(k):
+                yield k, v
+
+def _parse(body, encoding):
+    start = 0
+    end = len(body)
+    while start < end:
+        stop = body.find(u'&', start)
+        if stop == -1:
+            stop = end
+        pair = body[start:stop]
+        start = stop + 1
+        if not pair:
+            continue
+        k, sep, v = pair.partition(u'=')
+        if u'%' in pair or u'+' in pair:
+            k = _unquote(k, encoding)
+            v = _unquote(v, encoding)
+        yield k, v
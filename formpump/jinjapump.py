@@ -1,36 +1,216 @@
 "FormPump - It fills up forms"
 
-from jinja2 import Environment, environmentfunction, nodes
+import hashlib
+import threading
+import weakref
+
+from jinja2 import contextfunction, nodes
+from jinja2.runtime import Context
 from jinja2.utils import Markup
 from jinja2.ext import Extension
-
-from base import Form, StubForm
-
-def pumpwidget(func):
-    @environmentfunction
+from jinja2.lexer import Token
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+from .base import (Form, RepeatForm, StubForm, build_attrs, default_id_strategy, ids_for_form, render_strategy,
+                   runtime_attrs)
+from .cache import cache_settings, check_strategy
+from .decoder import decode
+from .manifest import Manifest
+
+# The context variable that holds the form state of a render.
+_state_key = '_formpump'
+
+# The JinjaPump extension of each environment, found once per environment.
+_pumps = weakref.WeakKeyDictionary()
+
+# Widgets registered by name, and the environments they are installed in.
+_widgets = {}
+_environments = weakref.WeakSet()
+
+# The state of the templates parsed in this thread: the Manifest they are
+# scanned into, if any, and how many cached forms are open.
+_scanning = threading.local()
+
+# The render states in progress in this thread (or asyncio task), innermost
+# last. A macro imported without context runs in a module context that every
+# render shares, so it looks up the state of the render that called it here.
+# The states of renders are held by weak references, which lets go of renders
+# that are abandoned half way.
+if ContextVar is not None:
+    _active = ContextVar('formpump_active', default=())
+
+    def _get_active():
+        return _active.get()
+
+    def _set_active(refs):
+        _active.set(refs)
+else:
+    _active = threading.local()
+
+    def _get_active():
+        return getattr(_active, 'refs', ())
+
+    def _set_active(refs):
+        _active.refs = refs
+
+# The types of the tokens a template, rather than an expression, can start with.
+_template_starts = frozenset(['data', 'block_begin', 'variable_begin'])
+
+def _push_state(state, strong=False):
+    ref = (lambda: state) if strong else weakref.ref(state)
+    _set_active(tuple(r for r in _get_active() if r() is not None) + (ref,))
+
+def _pop_state(state):
+    refs = _get_active()
+    for i in range(len(refs) - 1, -1, -1):
+        if refs[i]() is state:
+            _set_active(tuple(r for r in refs[:i] + refs[i + 1:] if r() is not None))
+            return
+
+def _active_state():
+    for ref in reversed(_get_active()):
+        state = ref()
+        if state is not None:
+            return state
+    return None
+
+def find_pump(environment):
+    "Returns the JinjaPump extension of `environment`."
+    jinjapump = _pumps.get(environment)
+    if jinjapump is None:
+        for ext in environment.extensions.values():
+            if isinstance(ext, JinjaPump):
+                jinjapump = _pumps[environment] = ext
+                break
+        else:
+            raise Exception('Could not find JinjaPump in extensions')
+    return jinjapump
+
+def pumpwidget(func=None, name=None):
+    """Turns `func` into a template function that is passed a BoundPump in place
+    of the context. Given a `name`, as in @pumpwidget(name='date_picker'), the
+    widget is also registered as a global of every JinjaPump environment."""
+    if func is None:
+        return lambda func: pumpwidget(func, name)
+
+    if name is not None:
+        _widgets[name] = func
+        for environment in list(_environments):
+            find_pump(environment).install_widget(name, func)
+
+    @contextfunction
     def wrap(*args, **kwargs):
         args = list(args)
-        env_index = 0
-        if len(args) > 1 and not isinstance(args[env_index], Environment):
-            env_index = 1
-        env = args[env_index]
-        
-        jinjapump = None
-
-        for ext in env.extensions.values():
-            if  isinstance(ext, JinjaPump):
-                jinjapump = ext
-                break
-            if jinjapump is None:
-                raise Exception('Could not find JinjaPump in extensions')
-        args[env_index] = jinjapump
+        ctx_index = 0
+        if len(args) > 1 and not isinstance(args[ctx_index], Context):
+            ctx_index = 1
+        context = args[ctx_index]
+        args[ctx_index] = BoundPump(find_pump(context.environment), context)
         return func(*args, **kwargs)
-    
+    wrap.pumpwidget = func
+
     return wrap
 
+def remove_pumpwidget(name):
+    func = _widgets.pop(name, None)
+    if func is None:
+        return
+    for environment in list(_environments):
+        widget = environment.globals.get(name)
+        if getattr(widget, 'pumpwidget', None) is func:
+            del environment.globals[name]
+
+def _check_cached(parser, tag):
+    # A form or form context inside a cached form would render values that
+    # are not part of its key.
+    if getattr(_scanning, 'cached', 0):
+        parser.fail('%s cannot be used inside a cached form' % tag.value, tag.lineno)
+
+def _check_caching(state, tag):
+    # The same, at render time, for tags that an include or a macro puts
+    # inside a cached form.
+    if state.caching:
+        raise ValueError('%s cannot be used inside a cached form' % tag)
+
+def _const(node):
+    # The value of a constant node; None for no node, or one that is evaluated
+    # at render time.
+    return node.value if isinstance(node, nodes.Const) else None
+
+def _is_dynamic(node):
+    return node is not None and not isinstance(node, nodes.Const)
+
+def _source(node):
+    # The dotted name of the variable that `node` reads, such as countries or
+    # form.countries, if it simply reads one.
+    if isinstance(node, nodes.Name):
+        return node.name
+    if isinstance(node, nodes.Getattr):
+        base = _source(node.node)
+        return base and base + '.' + node.attr
+    if isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const):
+        base = _source(node.node)
+        return base and '%s.%s' % (base, node.arg.value)
+    return None
+
+class RenderState(object):
+    "The stack of forms open in a single render."
+    def __init__(self, strategy, sort_attrs=False):
+        self.strategy = strategy
+        self.html_ids = strategy()
+        self.forms = [StubForm(self.html_ids, sort_attrs)]
+        # The keys of the cached forms being rendered, None where the cache is
+        # off, and the ids of the next form, where its key needed them.
+        self.cache_keys = []
+        self.next_ids = None
+        # How many forms are being rendered for the cache.
+        self.caching = 0
+        # False for a state made outside of any render.
+        self.rendering = False
+
+    @property
+    def form(self):
+        return self.forms[-1]
+
+    def form_ids(self, name):
+        return ids_for_form(self.strategy, name, self.html_ids)
+
+class BoundPump(object):
+    "A JinjaPump bound to the context of one render, as passed to pumpwidgets."
+    def __init__(self, jinjapump, context):
+        self.jinjapump = jinjapump
+        self.context = context
+        self.environment = jinjapump.environment
+
+    @property
+    def form(self):
+        return self.jinjapump.get_form(self.context)
+
+    def checkbox_tag(self, attrs):
+        return self.jinjapump.checkbox_tag(self.context, attrs)
+
+    def field_error_tag(self, name, attrs):
+        return self.jinjapump.field_error_tag(self.context, name, attrs)
+
+    def input_tag(self, attrs):
+        return self.jinjapump.input_tag(self.context, attrs)
+
+    def quick_select_tag(self, attrs):
+        return self.jinjapump.quick_select_tag(self.context, attrs)
+
+    def radio_tag(self, attrs):
+        return self.jinjapump.radio_tag(self.context, attrs)
+
+    def text_area_tag(self, attrs):
+        return self.jinjapump.text_area_tag(self.context, attrs)
+
 class JinjaPump(Extension):
     # a set of names that trigger the extension.
-    tags = set(['checkbox', 'email', 'error', 'file', 'form', 'form_ctx', 'hidden', 'iferror', 'ifnoterror', 'label', 'password', 'quickselect', 'radio', 'submit', 'text', 'textarea'])
+    tags = set(['_formpump_begin', '_formpump_end', 'checkbox', 'email', 'error', 'file', 'form', 'form_ctx', 'formrepeat', 'hidden', 'iferror', 'ifnoterror', 'label', 'password', 'quickselect', 'radio', 'submit', 'text', 'textarea'])
 
     def __init__(self, environment):
         Extension.__init__(self, environment)
@@ -41,8 +221,119 @@ class JinjaPump(Extension):
             error_dict_name     = 'form_errors',
             form_name_key       = None,
             form_ctx_key        = None,
+            html_id_strategy    = default_id_strategy,
+            option_cache        = None,
+            formpump_metrics    = None,
+            form_cache          = None,
+            deterministic       = False,
             )
-        self.form = StubForm()
+        _pumps[environment] = self
+        _environments.add(environment)
+        for name, func in list(_widgets.items()):
+            self.install_widget(name, func)
+
+    def install_widget(self, name, func):
+        """Installs the pumpwidget `func` as the global `name`, bound to this
+        extension, unless a global that is not a widget has that name."""
+        jinjapump = self
+
+        @contextfunction
+        def widget(context, *args, **kwargs):
+            return func(BoundPump(jinjapump, context), *args, **kwargs)
+        widget.pumpwidget = func
+
+        current = self.environment.globals.get(name)
+        if current is None or hasattr(current, 'pumpwidget'):
+            self.environment.globals[name] = widget
+
+    def decode(self, data, encoding='utf-8'):
+        """Decodes a form submitted from this environment's templates; see
+        formpump.decoder.decode()."""
+        return decode(data, self.environment.form_name_key, self.environment.form_ctx_key, encoding)
+
+    def manifest(self, name=None, source=None):
+        """Parses the template `name`, or else the template source `source`,
+        and returns a Manifest of its forms and fields."""
+        if source is None:
+            source = self.environment.loader.get_source(self.environment, name)[0]
+        manifest = Manifest(name)
+        previous = getattr(_scanning, 'manifest', None)
+        _scanning.manifest = manifest
+        try:
+            self.environment.parse(source, name)
+        finally:
+            _scanning.manifest = previous
+        return manifest
+
+    def _scan_field(self, tag, name, lineno, options=None):
+        manifest = getattr(_scanning, 'manifest', None)
+        if manifest is not None:
+            manifest.add_field(_const(name), tag.value, _is_dynamic(name), lineno, _source(options))
+
+    def new_state(self):
+        env = self.environment
+        return RenderState(render_strategy(env.html_id_strategy, env.deterministic), env.deterministic)
+
+    def get_state(self, context):
+        """Returns the form state of the render that `context` belongs to, or
+        of the innermost render in progress if `context` is a module context."""
+        state = context.get(_state_key)
+        if state is not None:
+            return state
+        # Outside of any render, a new state is used and thrown away.
+        return _active_state() or self.new_state()
+
+    def _hold(self, state):
+        # Outside of any render, a state is kept active while its forms are open.
+        if not state.rendering:
+            _push_state(state, strong=True)
+
+    def _release(self, state):
+        if not state.rendering:
+            _pop_state(state)
+
+    def filter_stream(self, stream):
+        # Every template begins and ends with a call that opens and closes the
+        # state of its render. Included templates and parents share it through
+        # the context. An expression, as parsed by compile_expression(), cannot
+        # start like a template does, and is left alone.
+        tokens = iter(stream)
+        first = next(tokens, None)
+        if first is None:
+            return
+        if first.type not in _template_starts:
+            yield first
+            for token in tokens:
+                yield token
+            return
+
+        lineno = first.lineno
+        for token in (Token(1, 'block_begin', None), Token(1, 'name', '_formpump_begin'), Token(1, 'block_end', None),
+                      first):
+            yield token
+        for token in tokens:
+            lineno = token.lineno
+            yield token
+        for token in (Token(lineno, 'block_begin', None), Token(lineno, 'name', '_formpump_end'),
+                      Token(lineno, 'block_end', None)):
+            yield token
+
+    def _begin(self, context):
+        if context.get(_state_key) is None:
+            state = context.vars[_state_key] = self.new_state()
+            state.rendering = True
+            _push_state(state)
+
+    def _end(self, context):
+        # The state is dropped, rather than kept in a module context that
+        # every later render of its macros would share. A child template ends
+        # before its parent starts, so the parent starts a state of its own.
+        state = context.vars.pop(_state_key, None)
+        if state is not None:
+            _pop_state(state)
+
+    def get_form(self, context):
+        return self.get_state(context).form
 
     def _form_vars_node(self):
         return nodes.Or(nodes.Name(self.environment.value_dict_name, 'load'), nodes.Dict([]))
@@ -51,10 +342,15 @@ class JinjaPump(Extension):
         return nodes.Or(nodes.Name(self.environment.error_dict_name, 'load'), nodes.Dict([]))
 
     def parse(self, parser):
-        tag = parser.stream.next()
+        tag = next(parser.stream)
 
-        if tag.value == 'form':
+        if tag.value in ('_formpump_begin', '_formpump_end'):
+            method = '_begin' if tag.value == '_formpump_begin' else '_end'
+            return nodes.ExprStmt(self.call_method(method, args=[nodes.ContextReference()])).set_lineno(tag.lineno)
+        elif tag.value == 'form':
             return self._form(parser, tag)
+        elif tag.value == 'formrepeat':
+            return self._form_repeat(parser, tag)
         elif tag.value == 'form_ctx':
             return self._form_ctx(parser, tag)
         elif tag.value in ( 'email', 'file', 'hidden', 'password', 'text'):
@@ -94,73 +390,286 @@ class JinjaPump(Extension):
 
         return (name, attrs)
 
+    def _split_attrs(self, attrs):
+        """Split parsed attribute nodes into a pre-serialized string of
+        constant attributes and a dict node of the ones that must be
+        evaluated at render time. Unnamed tags never touch the form state, so
+        any constant attribute of theirs is static."""
+        runtime = runtime_attrs if 'name' in attrs else ()
+        static = {}
+        dynamic = []
+        for k,v in attrs.items():
+            if isinstance(v, nodes.Const) and k not in runtime:
+                static[k] = v.value
+            else:
+                dynamic.append(nodes.Pair(nodes.Const(k), v))
+
+        return build_attrs(static, self.environment.deterministic), (nodes.Dict(dynamic) if dynamic else None)
+
+    def _partial_tag(self, tag, attrs, method_name, end, folded_end=None, args=()):
+        """Compile a tag into static template data around a minimal call that
+        renders the dynamic attributes only. Tags with no dynamic attributes
+        fold into literal output, closed with `folded_end` if given. `args`
+        are passed to the call after the dynamic attributes."""
+        static, dynamic = self._split_attrs(attrs)
+        if dynamic is None:
+            return [nodes.TemplateData(u'<{}{}{}'.format(tag, static, folded_end or end))]
+
+        return [nodes.TemplateData(u'<{}{}'.format(tag, static)),
+                self.call_method(method_name, args=[nodes.ContextReference(), dynamic] + list(args)),
+                nodes.TemplateData(end)]
+
     def _form(self, parser, tag):
+        _check_cached(parser, tag)
         form_name, attrs = self._parse_attrs(parser)
 
         form_name = form_name or nodes.Const(None)
-        
-        body = parser.parse_statements(['name:endform'], drop_needle=True)
+        cache = attrs.pop('cache', None)
+
+        manifest = getattr(_scanning, 'manifest', None)
+        if manifest is not None:
+            manifest.open_form(_const(form_name), tag.value, _is_dynamic(form_name), tag.lineno)
+        if cache is not None:
+            _scanning.cached = getattr(_scanning, 'cached', 0) + 1
+        try:
+            body = parser.parse_statements(['name:endform'], drop_needle=True)
+        finally:
+            if cache is not None:
+                _scanning.cached -= 1
+        if manifest is not None:
+            manifest.close_form()
 
         attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
 
-        return nodes.CallBlock(
-            self.call_method('_form_block', 
-                                     args=[form_name, attrs, 
-                                           self._form_vars_node(), 
-                                           self._form_errors_node()]),
-                    [], [], body).set_lineno(tag.lineno)
-
-    def _form_block(self, form_name, attrs, form_vars, form_errors, caller):
-        form = Form(form_name, 
+        # The body is compiled inline, between the calls that open and close
+        # the form, rather than as a call block. It renders (and streams, and
+        # awaits in async environments) like the rest of the template.
+        form = [nodes.Output([
+                    self.call_method('_form_start',
+                                     args=[nodes.ContextReference(), form_name, attrs,
+                                           self._form_vars_node(),
+                                           self._form_errors_node()])]).set_lineno(tag.lineno),
+                nodes.Scope(body),
+                nodes.Output([self.call_method('_form_end', args=[nodes.ContextReference()])])]
+
+        if cache is None:
+            return form
+
+        # {% set html = _cache_get(...) %}{% if html %}{{ html }}{% else %}
+        # {% set html %}...form...{% endset %}{{ _cache_set(html) }}{% endif %}
+        template_key = hashlib.sha1(repr((parser.name, tag.lineno, body)).encode('utf-8')).hexdigest()
+        html = '_formpump_html'
+        return nodes.Scope([
+                nodes.Assign(nodes.Name(html, 'store'),
+                             self.call_method('_cache_get',
+                                              args=[nodes.ContextReference(), nodes.Const(template_key),
+                                                    form_name, attrs,
+                                                    self._form_vars_node(),
+                                                    self._form_errors_node(),
+                                                    cache])).set_lineno(tag.lineno),
+                nodes.If(nodes.Name(html, 'load'),
+                         [nodes.Output([nodes.Name(html, 'load')])],
+                         [],
+                         [nodes.AssignBlock(nodes.Name(html, 'store'), None, form),
+                          nodes.Output([self.call_method('_cache_set',
+                                                         args=[nodes.ContextReference(),
+                                                               nodes.Name(html, 'load')])])])])
+
+    def _cache_get(self, context, template_key, form_name, attrs, form_vars, form_errors, cache):
+        state = self.get_state(context)
+        form_cache = self.environment.form_cache
+        if form_cache is None:
+            state.cache_keys.append(None)
+            self._hold(state)
+            return None
+
+        env = self.environment
+        strategy = render_strategy(env.html_id_strategy, env.deterministic)
+        check_strategy(strategy)
+        # The ids of the form depend on the forms before it with the same
+        # name, so they are made now, and their prefix is part of the key.
+        html_ids = state.form_ids(form_name)
+        key = form_cache.key(template_key, form_name, attrs,
+                             form_vars.get(form_name), form_errors.get(form_name), cache,
+                             (cache_settings(strategy, env.form_name_key, env.form_ctx_key,
+                                             env.default_form_action, env.error_renderers, env.deterministic),
+                              html_ids.base))
+        html = form_cache.get(key)
+        if html is not None:
+            return Markup(html)
+
+        state.cache_keys.append(key)
+        state.next_ids = html_ids
+        self._hold(state)
+        return None
+
+    def _cache_set(self, context, html):
+        state = self.get_state(context)
+        key = state.cache_keys.pop()
+        self._release(state)
+        if key is not None:
+            state.caching -= 1
+            self.environment.form_cache.set(key, html)
+        return Markup(html)
+
+    def form_class(self, cls):
+        metrics = self.environment.formpump_metrics
+        if metrics is None:
+            return cls
+        return metrics.form_class(cls)
+
+    def _form_start(self, context, form_name, attrs, form_vars, form_errors):
+        state = self.get_state(context)
+        _check_caching(state, 'form')
+        form = self.form_class(Form)(form_name, 
                     self.environment.form_name_key, 
                     self.environment.form_ctx_key,
                     attrs, 
                     self.environment.default_form_action,
                     form_vars,
-                    form_errors)
-        form, self.form = self.form, form
-        ret = caller()
-        form, self.form = self.form, form
-        return Markup(form.start_tag()) + ret + Markup(form.end_tag())
+                    form_errors,
+                    html_ids=state.next_ids or state.form_ids(form_name),
+                    sort_attrs=self.environment.deterministic)
+        if state.next_ids is not None:
+            state.caching += 1
+            state.next_ids = None
+        state.forms.append(form)
+        self._hold(state)
+        return Markup(form.start_tag())
+
+    def _form_end(self, context):
+        state = self.get_state(context)
+        form = state.forms.pop()
+        self._release(state)
+        form.close()
+        return Markup(form.end_tag())
+
+    def _form_repeat(self, parser, tag):
+        # {% formrepeat "name" for record in records ctx=record.id %}
+        _check_cached(parser, tag)
+        form_name = nodes.Const(None)
+        if parser.stream.current.test('string'):
+            form_name = parser.parse_expression(with_condexpr=False)
+        parser.stream.expect('name:for')
+        target = parser.parse_assign_target(with_tuple=False)
+        if not isinstance(target, nodes.Name):
+            parser.fail('formrepeat takes a single record name', target.lineno)
+        parser.stream.expect('name:in')
+        records = parser.parse_expression(with_condexpr=False)
+        _, attrs = self._parse_attrs(parser)
+        ctx = attrs.pop('ctx', nodes.Const(None))
+
+        manifest = getattr(_scanning, 'manifest', None)
+        if manifest is not None:
+            manifest.open_form(_const(form_name), tag.value, _is_dynamic(form_name), tag.lineno)
+            if not isinstance(ctx, nodes.Const) or ctx.value is not None:
+                manifest.add_context(_const(ctx), _is_dynamic(ctx))
+        body = parser.parse_statements(['name:endformrepeat'], drop_needle=True)
+        if manifest is not None:
+            manifest.close_form()
+
+        attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
+
+        row = [nodes.Output([self.call_method('_repeat_row',
+                                              args=[nodes.ContextReference(),
+                                                    nodes.Name(target.name, 'load'), ctx])]),
+               nodes.Scope(body),
+               nodes.Output([nodes.TemplateData(u'</form>')])]
+
+        return [nodes.ExprStmt(self.call_method('_repeat_start',
+                                                args=[nodes.ContextReference(), form_name, attrs,
+                                                      self._form_errors_node()])).set_lineno(tag.lineno),
+                nodes.For(target, records, row, [], None, False),
+                nodes.ExprStmt(self.call_method('_repeat_end', args=[nodes.ContextReference()]))]
+
+    def _repeat_start(self, context, form_name, attrs, form_errors):
+        state = self.get_state(context)
+        _check_caching(state, 'formrepeat')
+        form = self.form_class(RepeatForm)(form_name,
+                                           self.environment.form_name_key,
+                                           self.environment.form_ctx_key,
+                                           attrs,
+                                           self.environment.default_form_action,
+                                           {},
+                                           form_errors,
+                                           html_ids=state.form_ids(form_name),
+                                           sort_attrs=self.environment.deterministic)
+        state.forms.append(form)
+        self._hold(state)
+
+    def _repeat_row(self, context, record, ctx):
+        return Markup(self.get_form(context).row_tag(record, ctx))
+
+    def _repeat_end(self, context):
+        state = self.get_state(context)
+        state.forms.pop().close()
+        self._release(state)
 
     def _form_ctx(self, parser, tag):
+        _check_cached(parser, tag)
         name, attrs = self._parse_attrs(parser)
 
         if name is not None:
             attrs['name'] = name
 
+        manifest = getattr(_scanning, 'manifest', None)
+        if manifest is not None:
+            manifest.add_context(_const(attrs.get('name')), _is_dynamic(attrs.get('name')))
+
         attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
 
-        return nodes.Output([self.call_method('_switch_form_ctx', args=[attrs])])
+        return nodes.Output([self.call_method('_switch_form_ctx', args=[nodes.ContextReference(), attrs])])
 
-    def _switch_form_ctx(self, attrs):
-        return Markup(self.form.context_tag(attrs))
+    def _switch_form_ctx(self, context, attrs):
+        state = self.get_state(context)
+        _check_caching(state, 'form_ctx')
+        return Markup(state.form.context_tag(attrs))
 
-    def _input(self, parser, tag, method_name='input_tag'):
+    def _input(self, parser, tag, method_name='_input_attrs'):
         name, attrs = self._parse_attrs(parser)
         if name is not None:
             attrs['name'] = name
 
         attrs['type'] = nodes.Const(tag.value)
-        
-        attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
+        args = [attrs['type']] if method_name == '_input_attrs' else []
+        self._scan_field(tag, attrs.get('name'), tag.lineno)
 
-        return nodes.Output([self.call_method(method_name, args=[attrs])])
+        return nodes.Output(self._partial_tag('input', attrs, method_name, u' />', args=args))
 
-    def input_tag(self, attrs):
-        return Markup(self.form.input_tag(attrs))
+    def input_tag(self, context, attrs):
+        return Markup(self.get_form(context).input_tag(attrs))
+
+    def _input_attrs(self, context, attrs, input_type=None):
+        form = self.get_form(context)
+        return Markup(build_attrs(form.input_attrs(attrs, input_type), form.sort_attrs))
 
     def _check(self, parser, tag):
-        return self._input(parser, tag, method_name='checkbox_tag')
+        name, attrs = self._parse_attrs(parser)
+        if name is not None:
+            attrs['name'] = name
 
-    def checkbox_tag(self, attrs):
-        return Markup(self.form.checkbox_tag(attrs))
+        attrs['type'] = nodes.Const(tag.value)
+        attrs.setdefault('value', nodes.Const('1'))
+        self._scan_field(tag, attrs.get('name'), tag.lineno)
+
+        return nodes.Output(self._partial_tag('input', attrs, '_checkbox_attrs', u' />'))
+
+    def checkbox_tag(self, context, attrs):
+        return Markup(self.get_form(context).checkbox_tag(attrs))
+
+    def _checkbox_attrs(self, context, attrs):
+        form = self.get_form(context)
+        return Markup(build_attrs(form.checkbox_attrs(attrs), form.sort_attrs))
 
     def _radio(self, parser, tag):
-        return self._input(parser, tag, method_name='radio_tag')
+        return self._input(parser, tag, method_name='_radio_attrs')
 
-    def radio_tag(self, attrs):
-        return Markup(self.form.radio_tag(attrs))
+    def radio_tag(self, context, attrs):
+        return Markup(self.get_form(context).radio_tag(attrs))
+
+    def _radio_attrs(self, context, attrs):
+        form = self.get_form(context)
+        return Markup(build_attrs(form.radio_attrs(attrs), form.sort_attrs))
 
     def _iferror(self, parser, tag):
         name, attrs = self._parse_attrs(parser)
@@ -169,7 +678,7 @@ class JinjaPump(Extension):
             raise ValueError('First argument of iferror tag must be a string')
             
         node = nodes.If()
-        node.test = self.call_method('_iferror_block', args=[name])
+        node.test = self.call_method('_iferror_block', args=[nodes.ContextReference(), name])
         node.body = parser.parse_statements(('name:else', 'name:endiferror'))
         token = next(parser.stream)
         if token.test('name:else'):
@@ -179,8 +688,8 @@ class JinjaPump(Extension):
 
         return [node]
 
-    def _iferror_block(self, name):
-        return self.form.if_error(name)
+    def _iferror_block(self, context, name):
+        return self.get_form(context).if_error(name)
 
     def _ifnoterror(self, parser, tag):
         name, attrs = self._parse_attrs(parser)
@@ -189,7 +698,7 @@ class JinjaPump(Extension):
             raise ValueError('First argument of ifnoterror tag must be a string')
             
         node = nodes.If()
-        node.test = self.call_method('_ifnoterror_block', args=[name])
+        node.test = self.call_method('_ifnoterror_block', args=[nodes.ContextReference(), name])
         node.body = parser.parse_statements(('name:else', 'name:endifnoterror'))
         token = next(parser.stream)
         if token.test('name:else'):
@@ -199,8 +708,8 @@ class JinjaPump(Extension):
 
         return [node]
 
-    def _ifnoterror_block(self, name):
-        return self.form.if_not_error(name)
+    def _ifnoterror_block(self, context, name):
+        return self.get_form(context).if_not_error(name)
 
     def _submit(self, parser, tag):
         name, attrs = self._parse_attrs(parser)
@@ -208,10 +717,9 @@ class JinjaPump(Extension):
             attrs['value'] = name
 
         attrs['type'] = nodes.Const(tag.value)
+        self._scan_field(tag, attrs.get('name'), tag.lineno)
 
-        attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
-
-        return nodes.Output([self.call_method('input_tag', args=[attrs])])
+        return nodes.Output(self._partial_tag('input', attrs, '_input_attrs', u' />', args=[attrs['type']]))
 
     def _label(self, parser, tag):
         name, attrs = self._parse_attrs(parser)
@@ -220,39 +728,76 @@ class JinjaPump(Extension):
             attrs['name'] = name
             
         body = parser.parse_statements(['name:endlabel'], drop_needle=True)
-        attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
 
-        return nodes.CallBlock(self.call_method('_label_block', args=[attrs]),
-                               [], [], body).set_lineno(tag.lineno)
+        return [nodes.Output(self._partial_tag('label', attrs, '_label_attrs', u'>')).set_lineno(tag.lineno),
+                nodes.Scope(body),
+                nodes.Output([nodes.TemplateData(u'</label>')])]
 
-
-    def _label_block(self, attrs, caller):
-        return Markup(self.form.label_tag(attrs)) + caller() + Markup(self.form.end_label_tag())
+    def _label_attrs(self, context, attrs):
+        form = self.get_form(context)
+        return Markup(build_attrs(form.label_attrs(attrs), form.sort_attrs))
 
     def _quick_select(self, parser, tag):
         name, attrs = self._parse_attrs(parser)
         if name is not None:
             attrs['name'] = name
+        self._scan_field(tag, attrs.get('name'), tag.lineno, attrs.get('options'))
 
         attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
 
-        return nodes.Output([
-                self.call_method('quick_select_tag', args=[attrs])])
-
-    def quick_select_tag(self, attrs):
-        return Markup(self.form.quick_select_tag(attrs))
+        # {% for part in _quick_select_parts(attrs) %}{{ part }}{% endfor %}
+        # The select is written as parts, such as its runs of options, which
+        # are output as they are rather than joined first.
+        part = '_formpump_part'
+        return nodes.For(nodes.Name(part, 'store'),
+                         self.call_method('_quick_select_parts', args=[nodes.ContextReference(), attrs]),
+                         [nodes.Output([nodes.Name(part, 'load')])], [], None, False).set_lineno(tag.lineno)
+
+    def quick_select_tag(self, context, attrs):
+        return Markup(self.get_form(context).quick_select_tag(attrs, self.environment.option_cache))
+
+    def _quick_select_parts(self, context, attrs):
+        parts = []
+        self.get_form(context).quick_select_tag(attrs, self.environment.option_cache, out=parts)
+        # Without autoescaping, the parts are output as they are; with it,
+        # each has to be marked safe, which copies it.
+        if not context.eval_ctx.autoescape:
+            return parts
+        return [Markup(part) for part in parts]
 
     def _text_area(self, parser, tag):
         name, attrs = self._parse_attrs(parser)
         if name is not None:
             attrs['name'] = name
+        self._scan_field(tag, attrs.get('name'), tag.lineno)
 
-        attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
-        return nodes.Output([
-                self.call_method('text_area_tag', args=[attrs])])
-
-    def text_area_tag(self, attrs):
-        return Markup(self.form.textarea_tag(attrs))
+        name = attrs.get('name')
+        if name is None:
+            return nodes.Output(self._partial_tag('textarea', attrs, '_text_area_attrs', u'></textarea>'))
+
+        # {% set name = ... %}<textarea ...>{% for chunk in _text_area_chunks(name) %}{{ chunk }}{% endfor %}
+        # The value is output chunk by chunk, so that a large one streams
+        # rather than being escaped and copied whole.
+        attrs['name'] = nodes.Name('_formpump_name', 'load')
+        chunk = '_formpump_chunk'
+        return nodes.Scope([
+                nodes.Assign(nodes.Name('_formpump_name', 'store'), name).set_lineno(tag.lineno),
+                nodes.Output(self._partial_tag('textarea', attrs, '_text_area_attrs', u'>')),
+                nodes.For(nodes.Name(chunk, 'store'),
+                          self.call_method('_text_area_chunks', args=[nodes.ContextReference(),
+                                                                      nodes.Name('_formpump_name', 'load')]),
+                          [nodes.Output([nodes.Name(chunk, 'load')])], [], None, False),
+                nodes.Output([nodes.TemplateData(u'</textarea>')])])
+
+    def text_area_tag(self, context, attrs):
+        return Markup(self.get_form(context).textarea_tag(attrs))
+
+    def _text_area_attrs(self, context, attrs):
+        form = self.get_form(context)
+        return Markup(build_attrs(form.textarea_attrs(attrs), form.sort_attrs))
+
+    def _text_area_chunks(self, context, name):
+        return (Markup(chunk) for chunk in self.get_form(context).textarea_chunks(name))
 
     def _field_error(self, parser):
         name, attrs = self._parse_attrs(parser)
@@ -265,7 +810,7 @@ class JinjaPump(Extension):
         attrs = nodes.Dict([nodes.Pair(nodes.Const(k), v) for k,v in attrs.items()])
 
         return nodes.Output([
-                self.call_method('field_error_tag', args=[name, attrs])])
+                self.call_method('field_error_tag', args=[nodes.ContextReference(), name, attrs])])
 
-    def field_error_tag(self, name, attrs):
-        return Markup(self.form.error_tag(name, attrs, self.environment.error_renderers))
+    def field_error_tag(self, context, name, attrs):
+        return Markup(self.get_form(context).error_tag(name, attrs, self.environment.error_renderers))
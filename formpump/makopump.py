@@ -1,24 +1,79 @@
 "FormPump - It fills up forms"
 
-import cgi
-from mako.runtime import supports_caller
-from random import Random
-import string
+from mako import parsetree
+from mako.lexer import Lexer
+from mako.runtime import capture, supports_caller
+from mako.template import _get_module_info_from_callable
+import hashlib
+import operator
+import re
+import weakref
 
-from base import Form, StubForm
+from .base import (Form, RepeatForm, StubForm, build_attrs, default_id_strategy, ids_for_form, render_strategy,
+                   runtime_attrs)
+from .cache import cache_settings, check_strategy
+from .decoder import decode
+from .manifest import Manifest
 
 class MakoSettings(object):
     def __init__(self):
-        self.form = StubForm()
         self.name_key = None
         self.ctx_key = None
         self.default_form_action = None
         self.value_dict_name = 'form_vars'
         self.error_dict_name = 'form_errors'
         self.error_renderers = {}
-        
+        self.html_id_strategy = default_id_strategy
+        self.option_cache = None
+        self.metrics = None
+        self.form_cache = None
+        self.deterministic = False
+
+    def form_class(self, cls):
+        if self.metrics is None:
+            return cls
+        return self.metrics.form_class(cls)
+
+    def id_strategy(self):
+        return render_strategy(self.html_id_strategy, self.deterministic)
+
 _mako_settings = MakoSettings()
 
+# The forms open in a render, on top of a stub for the fields outside of any
+# form, and how many of them are rendered for the cache. Mako keeps one dict
+# of namespaces per render, shared by the templates it includes or inherits,
+# and looks them up by (module, name), so it can hold these too.
+_forms_key = (__name__, 'forms')
+_caching_key = (__name__, 'caching')
+
+def use_settings(lookup, settings=None):
+    """Gives templates loaded through `lookup` their own settings, instead of
+    the module-wide ones changed by the set_* functions below."""
+    if settings is None:
+        settings = MakoSettings()
+    lookup.formpump_settings = settings
+    return settings
+
+def _settings(context):
+    return getattr(context.lookup, 'formpump_settings', _mako_settings)
+
+def _forms(context):
+    forms = context.namespaces.get(_forms_key)
+    if forms is None:
+        settings = _settings(context)
+        forms = context.namespaces[_forms_key] = [StubForm(_render_ids(context, settings.id_strategy()),
+                                                           settings.deterministic)]
+    return forms
+
+def _form(context):
+    return _forms(context)[-1]
+
+def _check_cached(context, tag):
+    # A form or form context inside a cached form would render values that
+    # are not part of its key.
+    if context.namespaces.get(_caching_key):
+        raise ValueError('%s cannot be used inside a cached form' % tag)
+
 def set_form_name_key(name_key):
     _name_key = _mako_settings.name_key
     _mako_settings.name_key = name_key
@@ -35,6 +90,252 @@ def set_form_ctx_key(ctx_key):
 def get_form_ctx_key():
     return _mako_settings.ctx_key
 
+def set_html_id_strategy(strategy):
+    _strategy = _mako_settings.html_id_strategy
+    _mako_settings.html_id_strategy = strategy
+    return _strategy
+
+def get_html_id_strategy():
+    return _mako_settings.html_id_strategy
+
+def set_option_cache(option_cache):
+    _option_cache = _mako_settings.option_cache
+    _mako_settings.option_cache = option_cache
+    return _option_cache
+
+def get_option_cache():
+    return _mako_settings.option_cache
+
+def set_metrics(metrics):
+    _metrics = _mako_settings.metrics
+    _mako_settings.metrics = metrics
+    return _metrics
+
+def get_metrics():
+    return _mako_settings.metrics
+
+def set_form_cache(form_cache):
+    _form_cache = _mako_settings.form_cache
+    _mako_settings.form_cache = form_cache
+    return _form_cache
+
+def get_form_cache():
+    return _mako_settings.form_cache
+
+def set_deterministic(deterministic):
+    _deterministic = _mako_settings.deterministic
+    _mako_settings.deterministic = deterministic
+    return _deterministic
+
+def get_deterministic():
+    return _mako_settings.deterministic
+
+def decode_submission(data, lookup=None, encoding='utf-8'):
+    """Decodes a form submitted from templates rendered with the settings of
+    `lookup`, or the module-wide ones; see formpump.decoder.decode()."""
+    settings = getattr(lookup, 'formpump_settings', _mako_settings)
+    return decode(data, settings.name_key, settings.ctx_key, encoding)
+
+_FIELD_TAGS = frozenset(['checkbox', 'email', 'file', 'hidden', 'password', 'quickselect', 'radio',
+                         'submit', 'text', 'textarea'])
+_variable = re.compile(r'^\$\{\s*([A-Za-z_][\w.]*)\s*\}$')
+
+def template_manifest(template, namespaces=None):
+    """Scans `template`, a Template or its source, and returns a Manifest of
+    its forms and fields. Tags are found under the names FormPump is imported
+    as by <%namespace module="formpump.makopump" />, or else `namespaces`."""
+    source = getattr(template, 'source', template)
+    tree = Lexer(source).parse()
+    if namespaces is None:
+        namespaces = set(node.attributes.get('name') for node in _walk(tree)
+                         if isinstance(node, parsetree.NamespaceTag)
+                         and node.attributes.get('module') == __name__)
+
+    manifest = Manifest(getattr(template, 'uri', None))
+    _scan(tree, manifest, namespaces)
+    return manifest
+
+def _walk(node):
+    for child in getattr(node, 'nodes', ()):
+        yield child
+        # The nodes of a control line are also those of its parent.
+        if not isinstance(child, parsetree.ControlLine):
+            for descendant in _walk(child):
+                yield descendant
+
+def _scan(node, manifest, namespaces):
+    for child in getattr(node, 'nodes', ()):
+        if isinstance(child, parsetree.ControlLine):
+            continue
+        namespace, _, tag = getattr(child, 'keyword', '').partition(':')
+        if not isinstance(child, parsetree.CallNamespaceTag) or namespace not in namespaces:
+            _scan(child, manifest, namespaces)
+            continue
+
+        attrs = child.attributes
+        if tag in ('form', 'formrepeat'):
+            name = attrs.get('name')
+            manifest.open_form(_const(name), tag, _is_dynamic(name), child.lineno)
+            if 'ctx' in attrs:
+                # Each row's context comes from its record.
+                manifest.add_context(None, True)
+            _scan(child, manifest, namespaces)
+            manifest.close_form()
+        elif tag == 'form_ctx':
+            manifest.add_context(_const(attrs.get('name')), _is_dynamic(attrs.get('name')))
+        elif tag in _FIELD_TAGS:
+            name = attrs.get('name')
+            options = _variable.match(attrs.get('options', ''))
+            manifest.add_field(_const(name), tag, _is_dynamic(name), child.lineno,
+                               options.group(1) if options else None)
+        else:
+            _scan(child, manifest, namespaces)
+
+def _const(value):
+    return None if _is_dynamic(value) else value
+
+def _is_dynamic(value):
+    return value is not None and '${' in value
+
+# The tags that inline_tags() compiles, and the function that renders the
+# attributes each of them can only know at render time.
+_INLINE_TAGS = {'checkbox': '_inline_checkbox',
+                'email': '_inline_input',
+                'file': '_inline_input',
+                'hidden': '_inline_input',
+                'label': '_inline_label',
+                'password': '_inline_input',
+                'radio': '_inline_radio',
+                'submit': '_inline_input',
+                'text': '_inline_input',
+                'textarea': '_inline_textarea'}
+_tag = re.compile(r'<%(\w+):(\w+)((?:\s+\w+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>')
+_end_label = re.compile(r'</%(\w+):label\s*>')
+_namespace_tag = re.compile(r'<%namespace\s[^>]*>')
+_text_block = re.compile(r'(<%text(?:\s[^>]*)?>.*?</%text>)', re.S)
+_attr = re.compile(r'(\w+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_expression = re.compile(r'\$\{(.*?)\}', re.S)
+
+def inline_tags(source, namespaces=None, sort_attrs=False):
+    """A Mako preprocessor that compiles the field tags of this module into
+    the template, instead of calling them:
+
+        Template(source, preprocessor=makopump.inline_tags)
+
+    Constant attributes are serialized once, here, and the rest are rendered
+    by a single expression, as JinjaPump does. `namespaces` and `sort_attrs`
+    are as for template_manifest() and set_deterministic(); bind them with
+    functools.partial. Forms and the other tags are still called, and the
+    text of <%text> blocks is left as it is."""
+    # Every other part is outside of a <%text> block.
+    parts = _text_block.split(source)
+    if namespaces is None:
+        namespaces = set()
+        for tag in _namespace_tag.findall(u''.join(parts[::2])):
+            attrs = _attrs(tag)
+            if attrs.get('module') == __name__:
+                namespaces.add(attrs.get('name'))
+
+    def inline(match):
+        namespace, tag, attrs, close = match.groups()
+        if namespace not in namespaces or tag not in _INLINE_TAGS:
+            return match.group(0)
+        return _inline_tag(tag, _attrs(attrs), close, match.group(0).count('\n'), sort_attrs)
+
+    def end_label(match):
+        return u'</label>' if match.group(1) in namespaces else match.group(0)
+
+    parts[::2] = [_end_label.sub(end_label, _tag.sub(inline, part)) for part in parts[::2]]
+    source = u''.join(parts)
+    # The import goes last, so that no line moves. A control line or comment
+    # can't be followed on its own line, but takes its line break with it.
+    last = source[source.rfind(u'\n') + 1:].lstrip()
+    if (last.startswith(u'%') and not last.startswith(u'%%')) or last.startswith(u'##'):
+        source += u'\n'
+    return source + u'<%! from formpump import makopump as _formpump %>'
+
+def _attrs(source):
+    attrs = {}
+    for k, double, single in _attr.findall(source):
+        attrs[k] = double if double or not single else single
+    return attrs
+
+def _inline_tag(tag, attrs, close, newlines, sort_attrs):
+    html_tag = 'input'
+    args = ''
+    if tag in ('label', 'textarea'):
+        html_tag = tag
+    else:
+        attrs['type'] = tag
+        if tag == 'checkbox':
+            attrs.setdefault('value', '1')
+        elif tag != 'radio':
+            args = ', %r' % tag
+
+    runtime = runtime_attrs if 'name' in attrs else ()
+    static = {}
+    dynamic = []
+    for k, v in sorted(attrs.items()):
+        if '${' not in v and k not in runtime:
+            static[k] = v
+        else:
+            dynamic.append('%r: %s' % (k, _python(v)))
+
+    if tag == 'textarea':
+        end, folded_end = u'</textarea>', u'></textarea>'
+    elif tag == 'label':
+        end = folded_end = u'>' if not close else u'></label>'
+    else:
+        end = folded_end = u' />'
+
+    # Line breaks in the tag are kept in the expression, so that the lines of
+    # the template stay where they were.
+    breaks = u'\n' * newlines
+    start = u'<%s%s' % (html_tag, build_attrs(static, sort_attrs))
+    if not dynamic:
+        if breaks:
+            return u"%s${(%s'') | n}%s" % (start, breaks, folded_end)
+        return start + folded_end
+    return u'%s${_formpump.%s(context, {%s%s}%s) | n}%s' % (start, _INLINE_TAGS[tag], breaks, u', '.join(dynamic),
+                                                           args, end)
+
+def _python(value):
+    # A Python expression for the value of a Mako tag attribute.
+    parts = _expression.split(value)
+    if len(parts) == 3 and not parts[0] and not parts[2]:
+        return u'(%s)' % parts[1]
+    if len(parts) == 1:
+        return repr(value)
+    text = u''.join(part.replace(u'%', u'%%') if i % 2 == 0 else u'%s' for i, part in enumerate(parts))
+    return u'%r %% (%s,)' % (text, u', '.join(u'(%s)' % part for part in parts[1::2]))
+
+def _inline_input(context, attrs, input_type):
+    form = _form(context)
+    return build_attrs(form.input_attrs(attrs, input_type), form.sort_attrs)
+
+def _inline_checkbox(context, attrs):
+    form = _form(context)
+    return build_attrs(form.checkbox_attrs(attrs), form.sort_attrs)
+
+def _inline_radio(context, attrs):
+    form = _form(context)
+    return build_attrs(form.radio_attrs(attrs), form.sort_attrs)
+
+def _inline_label(context, attrs):
+    form = _form(context)
+    return build_attrs(form.label_attrs(attrs), form.sort_attrs)
+
+def _inline_textarea(context, attrs):
+    # The value is written in chunks, before the expression's own (empty)
+    # output.
+    form = _form(context)
+    attrs = form.textarea_attrs(attrs)
+    context.write(build_attrs(attrs, form.sort_attrs))
+    context.write(u'>')
+    for chunk in form.textarea_chunks(attrs.get('name', None)):
+        context.write(chunk)
+    return u''
+
 def add_error_renderer(name, callback):
     _mako_settings.error_renderers[name] = callback
 
@@ -43,81 +344,184 @@ def remove_error_renderer(name):
 
 ## Tags
 def checkbox(context, **kwargs):
-    context.write(_mako_settings.form.checkbox_tag(kwargs))
+    _form(context).checkbox_tag(kwargs, out=context)
     return ''
 
 def email(context, **kwargs):
-    context.write(_mako_settings.form.email_tag(kwargs))
+    _form(context).email_tag(kwargs, out=context)
     return ''
 
 def error(context, name, **kwargs):
-    context.write(_mako_settings.form.error_tag(name, kwargs, _mako_settings.error_renderers))
+    _form(context).error_tag(name, kwargs, _settings(context).error_renderers, out=context)
     return ''
 
 def file(context, **kwargs):
-    context.write(_mako_settings.form.file_tag(kwargs))
+    _form(context).file_tag(kwargs, out=context)
     return ''
     
+# Digests of template sources, for the keys of cached forms.
+_source_digests = weakref.WeakKeyDictionary()
+
+def _render_ids(context, strategy):
+    # The id function of the render, which numbers its forms; kept next to
+    # the render's forms.
+    key = (__name__, 'html_ids')
+    html_ids = context.namespaces.get(key)
+    if html_ids is None:
+        html_ids = context.namespaces[key] = strategy()
+    return html_ids
+
+def _template_key(context):
+    # The template that defines the cached body, which is not the one being
+    # rendered when it is included or inherited. Mako maps the functions of a
+    # compiled template back to it, as it does for its error reports.
+    body = context['caller'].body
+    info = _get_module_info_from_callable(body)
+    digest = _source_digests.get(info)
+    if digest is None:
+        digest = _source_digests[info] = hashlib.sha1(info.source.encode('utf-8')).hexdigest()
+    return '%s:%s:%d' % (info.template_uri or '', digest, body.__code__.co_firstlineno)
+
 @supports_caller
-def form(context, **kwargs):
+def form(context, cache=None, **kwargs):
+    _check_cached(context, 'form')
     name = kwargs.pop('name', None)
-    
-    form, _mako_settings.form = _mako_settings.form, Form(name,
-                                                    _mako_settings.name_key,
-                                                    _mako_settings.ctx_key,
-                                                    kwargs,
-                                                    _mako_settings.default_form_action,
-                                                    context.get(_mako_settings.value_dict_name, {}),
-                                                    context.get(_mako_settings.error_dict_name, {}))
-    context.write(_mako_settings.form.start_tag())
-    context['caller'].body()
-    context.write(_mako_settings.form.end_tag())
+    settings = _settings(context)
+    values = context.get(settings.value_dict_name, {})
+    errors = context.get(settings.error_dict_name, {})
+
+    strategy = settings.id_strategy()
+    html_ids = ids_for_form(strategy, name, _render_ids(context, strategy))
+    key = None
+    if cache is not None and settings.form_cache is not None:
+        check_strategy(strategy)
+        key = settings.form_cache.key(_template_key(context), name, kwargs,
+                                      values.get(name), errors.get(name), cache,
+                                      (cache_settings(strategy, settings.name_key,
+                                                      settings.ctx_key, settings.default_form_action,
+                                                      settings.error_renderers, settings.deterministic),
+                                       html_ids.base))
+        html = settings.form_cache.get(key)
+        if html is not None:
+            context.write(html)
+            return ''
+
+    form = settings.form_class(Form)(name,
+                                     settings.name_key,
+                                     settings.ctx_key,
+                                     kwargs,
+                                     settings.default_form_action,
+                                     values,
+                                     errors,
+                                     html_ids=html_ids,
+                                     sort_attrs=settings.deterministic)
+    forms = _forms(context)
+    forms.append(form)
+    try:
+        if key is None:
+            form.start_tag(out=context)
+            context['caller'].body()
+            form.close()
+            form.end_tag(out=context)
+        else:
+            parts = []
+            form.start_tag(out=parts)
+            context.namespaces[_caching_key] = context.namespaces.get(_caching_key, 0) + 1
+            try:
+                parts.append(capture(context, context['caller'].body))
+            finally:
+                context.namespaces[_caching_key] -= 1
+            form.close()
+            form.end_tag(out=parts)
+            html = u''.join(parts)
+            settings.form_cache.set(key, html)
+            context.write(html)
+    finally:
+        forms.pop()
+    return ''
+
+@supports_caller
+def formrepeat(context, records, ctx=None, **kwargs):
+    """Renders the body as one form per record, filled from the record. The
+    body receives the record (args="record"). `ctx` names each row's form
+    context: a key of the record, or a callable that is given the record."""
+    _check_cached(context, 'formrepeat')
+    name = kwargs.pop('name', None)
+    settings = _settings(context)
+    strategy = settings.id_strategy()
+    form = settings.form_class(RepeatForm)(name,
+                                           settings.name_key,
+                                           settings.ctx_key,
+                                           kwargs,
+                                           settings.default_form_action,
+                                           {},
+                                           context.get(settings.error_dict_name, {}),
+                                           html_ids=ids_for_form(strategy, name, _render_ids(context, strategy)),
+                                           sort_attrs=settings.deterministic)
+    if ctx is not None and not callable(ctx):
+        ctx = operator.itemgetter(ctx)
+    body = context['caller'].body
+    forms = _forms(context)
+    forms.append(form)
+    try:
+        for record in records:
+            form.row_tag(record, ctx(record) if ctx is not None else None, out=context)
+            body(record)
+            context.write(u'</form>')
+        form.close()
+    finally:
+        forms.pop()
     return ''
 
 def form_ctx(context, **kwargs):
-    context.write(_mako_settings.form.context_tag(kwargs))
+    _check_cached(context, 'form_ctx')
+    _form(context).context_tag(kwargs, out=context)
     return ''
     
 def hidden(context, **kwargs):
-    context.write(_mako_settings.form.hidden_tag(kwargs))
+    _form(context).hidden_tag(kwargs, out=context)
     return ''
 
 @supports_caller
 def iferror(context, name):
-    if _mako_settings.form.if_error(name):
+    if _form(context).if_error(name):
         context['caller'].body()
     return ''
 
 @supports_caller
 def ifnoterror(context, name):
-    if _mako_settings.form.if_not_error(name):
+    if _form(context).if_not_error(name):
         context['caller'].body()
     return ''
 
 @supports_caller
 def label(context, **kwargs):
-    context.write(_mako_settings.form.label_tag(kwargs))
+    _form(context).label_tag(kwargs, out=context)
     context['caller'].body()
-    context.write(_mako_settings.form.end_label_tag())
+    _form(context).end_label_tag(out=context)
     return ''
 
 def password(context, **kwargs):
-    context.write(_mako_settings.form.password_tag(kwargs))
+    _form(context).password_tag(kwargs, out=context)
+    return ''
+
+def quickselect(context, **kwargs):
+    _form(context).quick_select_tag(kwargs, _settings(context).option_cache, out=context)
     return ''
 
 def radio(context, **kwargs):
-    context.write(_mako_settings.form.radio_tag(kwargs))
+    _form(context).radio_tag(kwargs, out=context)
     return ''
 
 def submit(context, **kwargs):
-    context.write(_mako_settings.form.submit_tag(kwargs))
+    _form(context).submit_tag(kwargs, out=context)
     return ''
 
 def text(context, **kwargs):
-    context.write(_mako_settings.form.text_tag(kwargs))
+    _form(context).text_tag(kwargs, out=context)
     return ''
 
 def textarea(context, **kwargs):
-    context.write(_mako_settings.form.textarea_tag(kwargs))
+    _form(context).textarea_tag(kwargs, out=context)
     return ''
 
@@ -0,0 +1,80 @@
+"The forms and fields of a template, as found without rendering it."
+
+class ManifestField(object):
+    """A field tag. `name` is None where it is only known at render time, in
+    which case `dynamic` is true. `options` names the variable that the
+    options of a quickselect come from, where there is one."""
+    __slots__ = ('name', 'tag', 'dynamic', 'lineno', 'options')
+
+    def __init__(self, name, tag, dynamic, lineno, options=None):
+        self.name = name
+        self.tag = tag
+        self.dynamic = dynamic
+        self.lineno = lineno
+        self.options = options
+
+    def __repr__(self):
+        return '<ManifestField %s %r>' % (self.tag, self.name)
+
+class ManifestForm(object):
+    """A form or formrepeat tag, with the fields inside it and the form
+    contexts it switches to, as (name, dynamic) pairs."""
+    __slots__ = ('name', 'tag', 'dynamic', 'lineno', 'fields', 'contexts')
+
+    def __init__(self, name, tag, dynamic, lineno):
+        self.name = name
+        self.tag = tag
+        self.dynamic = dynamic
+        self.lineno = lineno
+        self.fields = []
+        self.contexts = []
+
+    def __repr__(self):
+        return '<ManifestForm %s %r>' % (self.tag, self.name)
+
+class Manifest(object):
+    """The forms of a template, in order. Field tags outside of any form are
+    in `fields`."""
+    def __init__(self, template=None):
+        self.template = template
+        self.forms = []
+        self.fields = []
+        self._open = []
+
+    def field_names(self, form_name):
+        "The constant field names of the forms named `form_name`."
+        return set(field.name for form in self.forms if form.name == form_name
+                   for field in form.fields if not field.dynamic)
+
+    def is_dynamic(self, form_name):
+        "Whether a form named `form_name` has a field whose name is only known at render time."
+        return any(field.dynamic for form in self.forms if form.name == form_name for field in form.fields)
+
+    def to_dict(self):
+        "The manifest as plain data, e.g. for JSON."
+        return {'template': self.template,
+                'forms': [dict(_fields(form, ManifestForm.__slots__[:4]),
+                               fields=[_fields(field, ManifestField.__slots__) for field in form.fields],
+                               contexts=[{'name': name, 'dynamic': dynamic} for name, dynamic in form.contexts])
+                          for form in self.forms],
+                'fields': [_fields(field, ManifestField.__slots__) for field in self.fields]}
+
+    # Used by the engines as they scan a template.
+    def open_form(self, name, tag, dynamic, lineno):
+        form = ManifestForm(name, tag, dynamic, lineno)
+        self.forms.append(form)
+        self._open.append(form)
+
+    def close_form(self):
+        self._open.pop()
+
+    def add_context(self, name, dynamic):
+        if self._open:
+            self._open[-1].contexts.append((name, dynamic))
+
+    def add_field(self, name, tag, dynamic, lineno, options=None):
+        fields = self._open[-1].fields if self._open else self.fields
+        fields.append(ManifestField(name, tag, dynamic, lineno, options))
+
+def _fields(obj, names):
+    return dict((name, getattr(obj, name)) for name in names)
@@ -0,0 +1,170 @@
+"Counters of what FormPump renders, for monitoring it in production."
+
+from collections import deque
+import threading
+from timeit import default_timer
+
+from .base import Form, RepeatForm, _missing
+
+# The Form methods that are timed, and the tag they are counted under. None
+# counts an input by its type: the input_type argument of input_attrs, or
+# else the type attribute. Methods that write to an output buffer are timed
+# up to their last write.
+_TAGS = (('checkbox_attrs', 'checkbox'),
+         ('checkbox_tag', 'checkbox'),
+         ('context_tag', 'form_ctx'),
+         ('email_tag', 'email'),
+         ('error_tag', 'error'),
+         ('file_tag', 'file'),
+         ('hidden_tag', 'hidden'),
+         ('input_attrs', None),
+         ('input_tag', None),
+         ('label_attrs', 'label'),
+         ('label_tag', 'label'),
+         ('password_tag', 'password'),
+         ('quick_select_tag', 'quickselect'),
+         ('radio_attrs', 'radio'),
+         ('radio_tag', 'radio'),
+         ('submit_tag', 'submit'),
+         ('text_tag', 'text'),
+         ('textarea_attrs', 'textarea'),
+         ('textarea_tag', 'textarea'),
+         ('write_textarea', 'textarea'))
+
+class RenderMetrics(object):
+    """Counts the forms, tags and ids rendered by the forms of an environment.
+
+    Nothing is counted, and nothing costs anything, unless an instance is set
+    as the environment's `formpump_metrics` (or with makopump.set_metrics()):
+    forms are then created from a counting subclass of their usual class.
+    Tags written out when the template is compiled, and forms served from the
+    form cache, never reach a form and are not counted."""
+    COUNTERS = ('forms', 'ids', 'unmatched_pairs', 'value_misses')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._classes = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+            self.tags = {}
+            self.tag_seconds = {}
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] += n
+
+    def tag(self, tag, seconds):
+        with self._lock:
+            self.tags[tag] = self.tags.get(tag, 0) + 1
+            self.tag_seconds[tag] = self.tag_seconds.get(tag, 0.0) + seconds
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = dict(self.counters)
+            snapshot['tags'] = dict(self.tags)
+            snapshot['tag_seconds'] = dict(self.tag_seconds)
+        return snapshot
+
+    def prometheus(self, prefix='formpump'):
+        "The snapshot in the Prometheus text exposition format."
+        snapshot = self.snapshot()
+        lines = []
+        for name, help, value in (('forms_rendered', 'Forms rendered.', snapshot['forms']),
+                                  ('ids_generated', 'Ids generated to pair labels and inputs.', snapshot['ids']),
+                                  ('unmatched_pairs', 'Labels or inputs left without their pair.', snapshot['unmatched_pairs']),
+                                  ('value_misses', 'Fields looked up without a value.', snapshot['value_misses'])):
+            lines.extend(_metric(prefix, name, help, [(u'', value)]))
+        lines.extend(_metric(prefix, 'tags_rendered', 'Tags rendered, by tag.',
+                             [(u'{tag="%s"}' % tag, n) for tag, n in sorted(snapshot['tags'].items())]))
+        lines.extend(_metric(prefix, 'tag_seconds', 'Time spent rendering tags, by tag.',
+                             [(u'{tag="%s"}' % tag, s) for tag, s in sorted(snapshot['tag_seconds'].items())]))
+        return u'\n'.join(lines) + u'\n'
+
+    def form_class(self, cls):
+        "Returns a subclass of the form class `cls` that counts into these metrics."
+        metered = self._classes.get(cls)
+        if metered is None:
+            base = _MeteredRepeatForm if issubclass(cls, RepeatForm) else _MeteredForm
+            metered = self._classes[cls] = type('Metered' + cls.__name__, (base, cls),
+                                                {'__slots__': (), 'metrics': self})
+        return metered
+
+def _metric(prefix, name, help, samples):
+    name = u'%s_%s_total' % (prefix, name)
+    lines = [u'# HELP %s %s' % (name, help), u'# TYPE %s counter' % name]
+    lines.extend(u'%s%s %s' % (name, labels, repr(value)) for labels, value in samples)
+    return lines
+
+class _Metered(object):
+    __slots__ = ()
+    metrics = None
+
+    def __init__(self, *args, **kwargs):
+        # Only the outermost of nested tag methods, such as text_tag calling
+        # input_tag, is counted.
+        self.metering = False
+        super(_Metered, self).__init__(*args, **kwargs)
+
+    def field_value(self, name, default=''):
+        value = Form.field_value(self, name, _missing)
+        if value is _missing:
+            self.metrics.count('value_misses')
+            return default
+        return value
+
+    def html_id(self):
+        self.metrics.count('ids')
+        return self.html_ids()
+
+    def count_unmatched(self):
+        unmatched = 0
+        for pending in (self.inputless_labels, self.labeless_inputs):
+            for ids in pending.values():
+                unmatched += len(ids) if isinstance(ids, deque) else 1
+        if unmatched:
+            self.metrics.count('unmatched_pairs', unmatched)
+
+class _MeteredForm(_Metered, Form):
+    __slots__ = ('metering',)
+
+    def close(self):
+        self.metrics.count('forms')
+        self.count_unmatched()
+
+class _MeteredRepeatForm(_Metered, RepeatForm):
+    __slots__ = ('metering',)
+
+    def row_tag(self, record, ctx=None, out=None):
+        self.count_unmatched()
+        self.metrics.count('forms')
+        return RepeatForm.row_tag(self, record, ctx, out)
+
+    def close(self):
+        self.count_unmatched()
+
+def _metered(name, tag):
+    method = getattr(Form, name)
+
+    def metered(self, *args, **kwargs):
+        if self.metering:
+            return method(self, *args, **kwargs)
+
+        self.metering = True
+        start = default_timer()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.metering = False
+            if tag is not None:
+                self.metrics.tag(tag, default_timer() - start)
+            else:
+                input_type = args[1] if name == 'input_attrs' and len(args) > 1 else None
+                self.metrics.tag(input_type or args[0].get('type', 'input'), default_timer() - start)
+    metered.__name__ = name
+    return metered
+
+for _name, _tag in _TAGS:
+    setattr(_Metered, _name, _metered(_name, _tag))
@@ -1,2 +1,5 @@
-from jinjatests import *
-from makotests import *
+from .benchtests import *
+from .buildtagtests import *
+from .formtests import *
+from .jinjatests import *
+from .makotests import *
@@ -1,9 +1,17 @@
-from HTMLParser import HTMLParser
+try:
+    from HTMLParser import HTMLParser
+except ImportError:
+    from html.parser import HTMLParser
 import logging
+import io
 import re
 import unittest
 
+from markupsafe import Markup
+
+import formpump
 from formpump import makopump
+from formpump.base import unicode
 
 def skipIfUndef(attr):
     def wrapper(func):
@@ -144,6 +152,27 @@ class FillTests(object):
         self.assertHTMLEqual(tpl, 
                          '<form action="" method="post"><input type="text" name="var" value="val" /></form>')
 
+    @skipIfUndef('text_fill')
+    def test_text_fill_escaped(self):
+        tpl = self._run_template(self.text_fill(),
+                               form_vars={'test':{'var':'a "b" <c>'}})
+        self.assertNotIn('"b"', tpl)
+        self.assertHTMLEqual(tpl,
+                         '<form action="" method="post"><input type="text" name="var" value="a &quot;b&quot; &lt;c&gt;" /></form>')
+
+        tpl = self._run_template(self.text_fill(),
+                               form_vars={'test':{'var':Markup('&amp;')}})
+        self.assertHTMLEqual(tpl,
+                         '<form action="" method="post"><input type="text" name="var" value="&amp;" /></form>')
+
+    @skipIfUndef('text_fill_nested')
+    def test_text_fill_nested(self):
+        tpl = self._run_template(self.text_fill_nested(),
+                               form_vars={'test':{'address':{'city':'Oslo'}, 'items':[{'qty':1}, {'qty':2}]}},
+                               form_errors={'test':{'items':[None, {'qty':'Too many'}]}})
+        self.assertHTMLEqual(tpl,
+                         '<form action="" method="post"><input type="text" name="address.city" value="Oslo" /><input class="error" type="text" name="items.1.qty" value="2" /></form>')
+
     @skipIfUndef('textarea_fill')
     def test_textarea_fill(self):
         tpl = self._run_template(self.textarea_fill(),
@@ -151,6 +180,16 @@ class FillTests(object):
         self.assertHTMLEqual(tpl, 
                          '<form action="" method="post"><textarea name="var">val</textarea></form>')
 
+    @skipIfUndef('textarea_fill')
+    def test_textarea_fill_large(self):
+        value = u'<a & b>\n' * 8000
+        expected = '<form action="" method="post"><textarea name="var">%s</textarea></form>' % (
+            u'&lt;a &amp; b&gt;\n' * 8000)
+        for source in (value, io.StringIO(value), io.BytesIO(value.encode('utf-8')),
+                       (line for line in value.splitlines(True))):
+            tpl = self._run_template(self.textarea_fill(), form_vars={'test': {'var': source}})
+            self.assertHTMLEqual(tpl, expected)
+
 class FormContextTests(object):
     @skipIfUndef('form_context')
     def test_form_context(self):
@@ -179,6 +218,15 @@ class FormContextTests(object):
                                           })
         self.assertHTMLEqual(tpl, '<form action="" method="post"><input type="text" name="var" value="ctx" /></form>')
 
+    @skipIfUndef('form_context_error')
+    def test_form_context_error(self):
+        tpl = self._run_template(self.form_context_error(),
+                               form_vars={'test': {'var': 'test'}},
+                               form_errors={'test': {'var': 'test'},
+                                            'ctx' : {'var': 'ctx'},
+                                            })
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><input class="error" type="text" name="var" value="test" /><span class="error">ctx</span><input class="error" type="text" name="var" value="" /></form>')
+
 class LabelTests(object):
     @skipIfUndef('label')
     def test_label(self):
@@ -299,6 +347,121 @@ class ErrorTests(object):
                                  )
         self.assertHTMLEqual(tpl, '<form action="" method="post"><span class="error">a</span>ok</form>')
 
+class QuickSelectTests(object):
+    options = [(1, 'a'), (2, 'b'), (3, '<c>')]
+
+    @skipIfUndef('quick_select')
+    def test_quick_select(self):
+        tpl = self._run_template(self.quick_select(), options=self.options)
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><select name="var"><option value="1">a</option><option value="2">b</option><option value="3">&lt;c&gt;</option></select></form>')
+
+        tpl = self._run_template(self.quick_select(), options=self.options,
+                                 form_vars={'test': {'var': 2}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><select name="var"><option value="1">a</option><option selected="selected" value="2">b</option><option value="3">&lt;c&gt;</option></select></form>')
+
+    @skipIfUndef('quick_select')
+    def test_quick_select_multi(self):
+        tpl = self._run_template(self.quick_select(), options=self.options,
+                                 form_vars={'test': {'var': ['1', 3, 4]}},
+                                 form_errors={'test': {'var': 'bad'}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><select class="error" name="var"><option selected="selected" value="1">a</option><option value="2">b</option><option selected="selected" value="3">&lt;c&gt;</option></select></form>')
+
+    @skipIfUndef('quick_select_prompt')
+    def test_quick_select_prompt(self):
+        tpl = self._run_template(self.quick_select_prompt(), options=self.options)
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><select name="var"><option value="">Pick</option><option value="1">a</option><option value="2">b</option><option value="3">&lt;c&gt;</option></select></form>')
+
+    @skipIfUndef('quick_select')
+    def test_quick_select_cached(self):
+        cache = formpump.OptionCache()
+        option_cache = self.set_option_cache(cache)
+        try:
+            first = self._run_template(self.quick_select(), options=self.options,
+                                       form_vars={'test': {'var': 2}})
+            second = self._run_template(self.quick_select(), options=self.options,
+                                        form_vars={'test': {'var': [1, 3]}})
+        finally:
+            self.set_option_cache(option_cache)
+
+        self.assertHTMLEqual(first, '<form action="" method="post"><select name="var"><option value="1">a</option><option selected="selected" value="2">b</option><option value="3">&lt;c&gt;</option></select></form>')
+        self.assertHTMLEqual(second, '<form action="" method="post"><select name="var"><option selected="selected" value="1">a</option><option value="2">b</option><option selected="selected" value="3">&lt;c&gt;</option></select></form>')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1, 'size': 128})
+
+    @skipIfUndef('quick_select_keyed')
+    def test_quick_select_cache_key(self):
+        cache = formpump.OptionCache()
+        option_cache = self.set_option_cache(cache)
+        try:
+            first = self._run_template(self.quick_select_keyed(), options=list(self.options))
+            second = self._run_template(self.quick_select_keyed(), options=list(self.options))
+        finally:
+            self.set_option_cache(option_cache)
+
+        self.assertEqual(first, second)
+        self.assertNotIn('cache_key', first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+class RepeatTests(object):
+    people = [{'id': 1, 'phone': 'a'}, {'id': 2, 'phone': 'b'}]
+
+    @skipIfUndef('form_repeat')
+    def test_form_repeat(self):
+        form_ctx_key = self.set_form_ctx_key('_')
+        try:
+            tpl = self._run_template(self.form_repeat(), strip_id=False,
+                                     people=self.people,
+                                     form_errors={2: {'phone': 'bad'}})
+        finally:
+            self.set_form_ctx_key(form_ctx_key)
+
+        self.assertHTMLEqual(self.stripID(tpl),
+                             '<form action="" method="post"><input type="hidden" name="_" value="1" /><label>a</label><input type="text" name="phone" value="a" /></form>'
+                             '<form action="" method="post"><input type="hidden" name="_" value="2" /><label>b</label><input class="error" type="text" name="phone" value="b" /></form>')
+        tags = self.get_tags(tpl)
+        self.assertEqual(tags[2]['attrs']['for'], tags[5]['attrs']['id'])
+        self.assertEqual(tags[9]['attrs']['for'], tags[12]['attrs']['id'])
+        self.assertNotEqual(tags[5]['attrs']['id'], tags[12]['attrs']['id'])
+
+    @skipIfUndef('form_repeat_plain')
+    def test_form_repeat_plain(self):
+        tpl = self._run_template(self.form_repeat_plain(), people=self.people)
+        self.assertHTMLEqual(tpl,
+                             '<form action="x" method="post"><input type="text" name="phone" value="a" /></form>'
+                             '<form action="x" method="post"><input type="text" name="phone" value="b" /></form>')
+        self.assertEqual(self._run_template(self.form_repeat_plain(), people=[]), '')
+
+class IdTests(object):
+    def ids(self, html):
+        return [tag['attrs'].get('id') or tag['attrs'].get('for') for tag in self.get_tags(html)
+                if 'id' in tag['attrs'] or 'for' in tag['attrs']]
+
+    def assertUniqueIds(self, html, pattern):
+        ids = self.ids(html)
+        # two labelled inputs, one input without a label
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 3)
+        for html_id in ids:
+            self.assertTrue(re.match(pattern, html_id), html_id)
+
+    @skipIfUndef('html_ids')
+    def test_default_ids(self):
+        tpl = self._run_template(self.html_ids(), strip_id=False)
+        self.assertUniqueIds(tpl, r'^fp-\d+-\d+$')
+
+    @skipIfUndef('html_ids')
+    def test_id_strategies(self):
+        for strategy, pattern in ((formpump.CounterIds('x'), r'^x-\d+-\d+$'),
+                                  (formpump.PooledIds(), r'^fp-[0-9a-f]{16}-\d+$'),
+                                  (formpump.RandomIds(), r'^[a-zA-Z0-9]{32}$')):
+            prev_strategy = self.set_id_strategy(strategy)
+            try:
+                first = self._run_template(self.html_ids(), strip_id=False)
+                second = self._run_template(self.html_ids(), strip_id=False)
+            finally:
+                self.set_id_strategy(prev_strategy)
+            self.assertUniqueIds(first, pattern)
+            self.assertFalse(set(self.ids(first)) & set(self.ids(second)))
+
 class HTMLQueueParser(HTMLParser):
     START_TAG    = 0
     END_TAG      = 1
@@ -337,3 +500,155 @@ class HTMLQueueParser(HTMLParser):
 
     def __ne__(self, other):
         return self.tags != other.tags
+
+class MetricsTests(object):
+    def run_metered(self, tpl, **kwargs):
+        metrics = formpump.RenderMetrics()
+        prev_metrics = self.set_metrics(metrics)
+        try:
+            html = self._run_template(tpl, **kwargs)
+        finally:
+            self.set_metrics(prev_metrics)
+        return html, metrics.snapshot()
+
+    @skipIfUndef('metrics')
+    def test_metrics(self):
+        html, snapshot = self.run_metered(self.metrics(), form_vars={'test': {'a': 'x'}})
+        self.assertHTMLEqual(html, '<form action="" method="post"><label>a</label><input type="text" name="a" value="x" /><input type="text" name="b" value="" /></form>')
+        self.assertEqual(snapshot['forms'], 1)
+        self.assertEqual(snapshot['ids'], 2)
+        self.assertEqual(snapshot['unmatched_pairs'], 1)
+        self.assertEqual(snapshot['value_misses'], 1)
+        self.assertEqual(snapshot['tags'], {'label': 1, 'text': 2})
+        self.assertEqual(sorted(snapshot['tag_seconds']), ['label', 'text'])
+
+    @skipIfUndef('form_repeat')
+    def test_metrics_repeat(self):
+        html, snapshot = self.run_metered(self.form_repeat(), people=[{'id': 1, 'phone': 'a'}, {'id': 2}])
+        self.assertEqual(snapshot['forms'], 2)
+        self.assertEqual(snapshot['value_misses'], 1)
+        self.assertEqual(snapshot['unmatched_pairs'], 0)
+        self.assertEqual(snapshot['tags'], {'label': 2, 'text': 2})
+
+    @skipIfUndef('metrics')
+    def test_metrics_disabled(self):
+        self.assertIsNone(self.set_metrics(None))
+        self._run_template(self.metrics())
+
+class FormCacheTests(object):
+    def run_cached(self, tpl, form_cache, **kwargs):
+        prev_cache = self.set_form_cache(form_cache)
+        prev_strategy = self.set_id_strategy(formpump.FormIds())
+        try:
+            return self._run_template(tpl, strip_id=False, **kwargs)
+        finally:
+            self.set_form_cache(prev_cache)
+            self.set_id_strategy(prev_strategy)
+
+    @skipIfUndef('form_cached')
+    def test_form_cached(self):
+        form_cache = formpump.FormCache()
+        html = self.run_cached(self.form_cached(), form_cache)
+        self.assertHTMLEqual(html, '<form action="" method="post"><label for="fp-test-1">a</label><input type="text" name="a" value="" id="fp-test-1" /></form>')
+        self.assertEqual(self.run_cached(self.form_cached(), form_cache), html)
+        self.assertEqual(form_cache.stats(), {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+        html = self.run_cached(self.form_cached(), form_cache, form_vars={'test': {'a': 'x'}})
+        self.assertHTMLEqual(html, '<form action="" method="post"><label for="fp-test-1">a</label><input type="text" name="a" value="x" id="fp-test-1" /></form>')
+        self.assertEqual(form_cache.stats()['misses'], 2)
+
+    @skipIfUndef('form_cached')
+    def test_form_cached_twice(self):
+        form_cache = formpump.FormCache()
+        html = self.run_cached(self.form_cached() * 2, form_cache)
+        self.assertEqual(re.findall(r' id="([^"]*)"', html), ['fp-test-1', 'fp-test.2-1'])
+        self.assertEqual(self.run_cached(self.form_cached() * 2, form_cache), html)
+        self.assertEqual(form_cache.stats(), {'hits': 2, 'misses': 2, 'hit_rate': 0.5})
+
+    @skipIfUndef('form_cached')
+    def test_form_cache_strategy(self):
+        prev_cache = self.set_form_cache(formpump.FormCache())
+        try:
+            self.assertRaises(ValueError, self._run_template, self.form_cached())
+        finally:
+            self.set_form_cache(prev_cache)
+
+    @skipIfUndef('form_cached')
+    def test_form_cache_disabled(self):
+        self.assertIsNone(self.set_form_cache(None))
+        html = self._run_template(self.form_cached())
+        self.assertHTMLEqual(html, '<form action="" method="post"><label>a</label><input type="text" name="a" value="" /></form>')
+
+class DeterministicTests(object):
+    def run_deterministic(self, tpl, **kwargs):
+        prev = self.set_deterministic(True)
+        try:
+            return self._run_template(tpl, strip_id=False, **kwargs)
+        finally:
+            self.set_deterministic(prev)
+
+    @skipIfUndef('deterministic')
+    def test_deterministic(self):
+        html = self.run_deterministic(self.deterministic(), form_vars={'ctx': {'a': 'x'}})
+        self.assertEqual(self.run_deterministic(self.deterministic(), form_vars={'ctx': {'a': 'x'}}), html)
+        self.assertEqual(self.ids(html), ['fp-test-1', 'fp-test-1', 'fp-ctx-1'])
+        self.assertHTMLEqual(self.stripID(html), '<form action="" method="post"><label>a</label><input type="text" name="a" value="" /><input type="text" name="a" value="x" /></form>')
+
+    @skipIfUndef('deterministic_repeated')
+    def test_deterministic_repeated(self):
+        html = self.run_deterministic(self.deterministic_repeated())
+        self.assertEqual(self.run_deterministic(self.deterministic_repeated()), html)
+        self.assertEqual(self.ids(html), ['fp.2-1', 'fp.2-1', 'fp.3-1', 'fp.3-1',
+                                          'fp-test-1', 'fp-test-1', 'fp-test.2-1', 'fp-test.2-1'])
+
+    @skipIfUndef('deterministic_attrs')
+    def test_deterministic_attrs(self):
+        first, second = self.deterministic_attrs()
+        self.assertEqual(self.run_deterministic(first), self.run_deterministic(second))
+
+    def ids(self, html):
+        return re.findall(r' (?:id|for)="([^"]*)"', html)
+
+class DecodeTests(object):
+    @skipIfUndef('round_trip')
+    def test_round_trip(self):
+        prev_name_key = self.set_form_name_key('__')
+        prev_ctx_key = self.set_form_ctx_key('_ctx')
+        try:
+            form_vars = {'person.2': {'phone': '555', 'tag': ['a', 'c']}}
+            html = self._run_template(self.round_trip(), form_vars=form_vars)
+            data = []
+            for tag in self.get_tags(html):
+                attrs = tag['attrs']
+                if tag['tag'] == 'input' and (attrs['type'] != 'checkbox' or 'checked' in attrs):
+                    data.append((attrs['name'], attrs['value']))
+
+            submission = self.decode(data)
+            self.assertEqual((submission.name, submission.ctx), ('person', 'person.2'))
+            self.assertEqual(submission.form_vars, form_vars)
+            self.assertEqual(self._run_template(self.round_trip(), form_vars=submission.form_vars), html)
+        finally:
+            self.set_form_name_key(prev_name_key)
+            self.set_form_ctx_key(prev_ctx_key)
+
+class ManifestTests(object):
+    @skipIfUndef('manifest_source')
+    def test_manifest(self):
+        manifest = self.manifest(self.manifest_source())
+        self.assertEqual([(form.name, form.tag, form.dynamic) for form in manifest.forms],
+                         [('login', 'form', False), ('person', 'formrepeat', False)])
+        login, person = manifest.forms
+        self.assertEqual([(field.name, field.tag, field.dynamic, field.options) for field in login.fields],
+                         [('user', 'text', False, None),
+                          ('country', 'quickselect', False, 'data.countries'),
+                          (None, 'checkbox', True, None),
+                          ('go', 'submit', False, None)])
+        self.assertEqual(login.contexts, [('login.2', False)])
+        self.assertEqual([field.name for field in person.fields], ['phone'])
+        self.assertEqual(person.contexts, [(None, True)])
+        self.assertEqual([field.name for field in manifest.fields], ['search'])
+
+        self.assertEqual(manifest.field_names('login'), set(['user', 'country', 'go']))
+        self.assertTrue(manifest.is_dynamic('login'))
+        self.assertFalse(manifest.is_dynamic('person'))
+        self.assertEqual(manifest.to_dict()['forms'][1]['fields'][0]['name'], 'phone')
@@ -0,0 +1,44 @@
+import re
+import unittest
+
+from . import base
+from formpump.bench import __main__ as bench
+from formpump.bench.scenarios import SCENARIOS
+
+class BenchScenarioTests(base.FormPumpTests):
+    def engine(self, name):
+        try:
+            return dict(bench.ENGINES)[name]()
+        except ImportError:
+            self.skipTest('%s is not installed.' % name)
+
+    def normalize(self, html):
+        # The hand-written forms have no generated ids, and Mako's control
+        # lines leave newlines between the tags.
+        return re.sub(r'>\s+<', '><', self.stripID(html)).strip()
+
+    def assertScenario(self, engine):
+        version, compile_template = self.engine(engine)
+
+        for scenario in SCENARIOS:
+            context = scenario.context()
+            pump, html = [self.normalize(compile_template(source)(**context))
+                          for source in scenario.templates[engine]]
+            self.assertHTMLEqual(pump, html)
+
+    def test_jinja(self):
+        self.assertScenario('jinja')
+
+    def test_mako(self):
+        self.assertScenario('mako')
+
+    def test_mako_inline(self):
+        self.assertScenario('mako-inline')
+
+    def test_run(self):
+        results = bench.run([('jinja', self.engine('jinja'))], SCENARIOS[:1], number=1, repeat=1)
+        self.assertEqual([r['scenario'] for r in results], ['blank'])
+        self.assertEqual(results[0]['tags'], 21)
+
+if __name__ == "__main__":
+    unittest.main()
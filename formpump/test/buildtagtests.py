@@ -0,0 +1,53 @@
+import unittest
+
+from markupsafe import Markup
+
+from formpump import base as formpump_base
+
+class EscapeTests(unittest.TestCase):
+    def test_escape(self):
+        self.assertEqual(formpump_base.escape(u'<a href="x">\'&'),
+                         u'&lt;a href=&#34;x&#34;&gt;&#39;&amp;')
+        self.assertEqual(formpump_base.escape(12), u'12')
+        self.assertEqual(formpump_base.escape(1.5), u'1.5')
+
+    def test_fast_path(self):
+        value = u'abc123'
+        self.assertIs(formpump_base.escape(value), value)
+
+    def test_markup(self):
+        escaped = formpump_base.escape(Markup(u'<b>&amp;</b>'))
+        self.assertEqual(escaped, u'<b>&amp;</b>')
+        self.assertIs(type(escaped), formpump_base.unicode)
+        self.assertEqual(u'<' + escaped, u'<<b>&amp;</b>')
+
+class BuildTagTests(unittest.TestCase):
+    def test_build_tag(self):
+        self.assertEqual(formpump_base.build_tag('input', {}, close=True), u'<input />')
+        self.assertEqual(formpump_base.build_tag('label', {'for': 'x'}), u'<label for="x">')
+        self.assertEqual(formpump_base.build_tag('input', {'class_': 'a', 'data_x': None}, close=True),
+                         u'<input class="a" data-x="" />')
+
+    def test_build_attrs(self):
+        self.assertEqual(formpump_base.build_attrs({}), u'')
+        self.assertEqual(formpump_base.build_attrs({'value': '<&>'}), u' value="&lt;&amp;&gt;"')
+
+    def test_sort(self):
+        self.assertEqual(formpump_base.build_tag('input', {'value': 1, 'name': 'a', 'id': 'b'}, close=True, sort=True),
+                         u'<input id="b" name="a" value="1" />')
+        self.assertEqual(formpump_base.build_attrs({'b': 1, 'a': 2}, sort=True), u' a="2" b="1"')
+
+    def test_plan_reuse(self):
+        formpump_base.build_tag('option', {'value': 1})
+        plan = formpump_base._plans[('option', ('value',))]
+        self.assertEqual(formpump_base.build_tag('option', {'value': '<2>'}), u'<option value="&lt;2&gt;">')
+        self.assertIs(formpump_base._plans[('option', ('value',))], plan)
+
+    def test_plan_eviction(self):
+        for i in range(formpump_base._MAX_PLANS + 1):
+            formpump_base.build_tag('input', {'data_%d' % i: i})
+        self.assertTrue(len(formpump_base._plans) <= formpump_base._MAX_PLANS)
+        self.assertEqual(formpump_base.build_tag('input', {'data_0': 0}, close=True), u'<input data-0="0" />')
+
+if __name__ == "__main__":
+    unittest.main()
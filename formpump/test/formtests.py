@@ -0,0 +1,398 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from markupsafe import Markup
+
+from formpump import base as formpump_base
+from formpump.base import (AttrValues, CallableValues, Form, FormIds, MultiDictValues, OptionCache, RepeatForm,
+                           StubForm, escape_chunks, ids_for_form, value_source, writer)
+from formpump.decoder import decode
+from formpump.cache import FileBackend, FormCache, MemoryBackend, fingerprint, form_fingerprints
+from formpump.metrics import RenderMetrics
+
+class FormObjectTests(unittest.TestCase):
+    def form(self):
+        return Form('test', None, None, {}, '', {}, {})
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.form(), '__dict__'))
+        self.assertFalse(hasattr(StubForm(), '__dict__'))
+
+    def test_pairing_order(self):
+        form = self.form()
+        label_ids = [form.label_attrs({'name': 'var'})['for'] for i in range(100)]
+        input_ids = [form.radio_attrs({'name': 'var', 'value': i})['id'] for i in range(150)]
+        self.assertEqual(input_ids[:100], label_ids)
+        self.assertEqual(len(set(input_ids)), 150)
+
+        label_ids = [form.label_attrs({'name': 'var'})['for'] for i in range(50)]
+        self.assertEqual(label_ids, input_ids[100:])
+        self.assertEqual(form.inputless_labels, {})
+        self.assertEqual(form.labeless_inputs, {})
+
+    def test_pairing_explicit_id(self):
+        form = self.form()
+        self.assertEqual(form.input_attrs({'name': 'var', 'id': 'x'})['id'], 'x')
+        self.assertEqual(form.labeless_inputs, {})
+
+class WriterTests(unittest.TestCase):
+    def form(self):
+        return Form('test', '_', '__', {}, '', {'test': {'var': 'a', 'sel': '2'}}, {'test': {'var': 'bad'}},
+                    html_ids=ids_for_form(FormIds(), 'test'))
+
+    def test_writers(self):
+        parts = []
+        writer(parts)(u'a')
+        stream = io.StringIO()
+        writer(stream)(u'b')
+        self.assertEqual(parts, [u'a'])
+        self.assertEqual(stream.getvalue(), u'b')
+        self.assertEqual(writer(parts.append), parts.append)
+        self.assertRaises(TypeError, writer, 1)
+
+    def test_same_output(self):
+        calls = [('start_tag', ()),
+                 ('text_tag', ({'name': 'var'}, )),
+                 ('checkbox_tag', ({'name': 'var', 'value': 'a'}, )),
+                 ('radio_tag', ({'name': 'var', 'value': 'b'}, )),
+                 ('label_tag', ({'name': 'var'}, )),
+                 ('end_label_tag', ()),
+                 ('quick_select_tag', ({'name': 'sel', 'options': [(1, 'a'), (2, 'b')], 'prompt': '-'}, OptionCache())),
+                 ('textarea_tag', ({'name': 'var'}, )),
+                 ('error_tag', ('var', {}, {})),
+                 ('context_tag', ({'name': 'other'}, )),
+                 ('end_tag', ())]
+        copy = lambda args: [dict(arg) if isinstance(arg, dict) else arg for arg in args]
+        returned = self.form()
+        written = self.form()
+        for method, args in calls:
+            parts = []
+            self.assertIs(getattr(written, method)(*copy(args), out=parts), None)
+            self.assertEqual(u''.join(parts), getattr(returned, method)(*copy(args)))
+
+    def test_row_tag(self):
+        form = RepeatForm('test', None, 'ctx', {}, '', {}, {})
+        parts = []
+        form.row_tag({}, 1, out=parts)
+        self.assertEqual(u''.join(parts), form.row_tag({}, 1))
+
+class EscapeChunksTests(unittest.TestCase):
+    def test_sizes(self):
+        self.assertEqual(list(escape_chunks(u'ab<cd', 2)), [u'ab', u'&lt;c', u'd'])
+        self.assertEqual(list(escape_chunks(u'', 2)), [])
+        self.assertEqual(list(escape_chunks(12, 2)), [u'12'])
+
+    def test_split_utf8(self):
+        value = u'\xe9\u20ac<'.encode('utf-8')
+        chunks = list(escape_chunks(io.BytesIO(value), 1))
+        self.assertEqual(u''.join(chunks), u'\xe9\u20ac&lt;')
+
+    def test_bytes_sliced(self):
+        value = u'\xe9<'.encode('utf-8') * 3
+        chunks = list(escape_chunks(value, 2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(u''.join(chunks), u'\xe9&lt;' * 3)
+
+    def test_iterator(self):
+        self.assertEqual(list(escape_chunks(iter([u'a<', Markup(u'<b>'), b'c']), 4)), [u'a&lt;', u'<b>', u'c'])
+
+    def test_read_once(self):
+        form = Form('test', None, None, {}, '', {'test': {'var': io.StringIO(u'a&b')}}, {})
+        written = []
+        form.write_textarea(written.append, {'name': 'var', 'id': 'x'})
+        self.assertEqual(u''.join(written), u'<textarea name="var" id="x">a&amp;b</textarea>')
+        self.assertEqual(form.textarea_value('var'), u'')
+
+class MultiDict(object):
+    "Stands in for a werkzeug MultiDict, logging the fields that are read."
+    def __init__(self, items):
+        self.items = items
+        self.read = []
+
+    def get(self, name, default=None):
+        self.read.append(name)
+        for k, v in self.items:
+            if k == name:
+                return v
+        return default
+
+    def getlist(self, name):
+        self.read.append(name)
+        return [v for k, v in self.items if k == name]
+
+    def keys(self):
+        return [k for k, v in self.items]
+
+class WebObMultiDict(MultiDict):
+    getall = MultiDict.getlist
+    getlist = property()
+
+class ValueSourceTests(unittest.TestCase):
+    def form(self, values):
+        return Form('test', None, None, {}, '', {'test': values}, {})
+
+    def test_value_source(self):
+        self.assertEqual(value_source(None), {})
+        values = {'a': 1}
+        self.assertIs(value_source(values), values)
+        self.assertIsInstance(value_source(object()), AttrValues)
+        self.assertIsInstance(value_source(lambda name: None), CallableValues)
+
+    def test_multidict(self):
+        values = MultiDict([('tags', 'a'), ('tags', 'c'), ('single', 'x'), ('unused', 'y')])
+        form = self.form(values)
+        self.assertIs(form.values, values)
+        self.assertEqual(form.checkbox_attrs({'name': 'tags', 'value': 'a'}).get('checked'), 'checked')
+        self.assertNotIn('checked', form.checkbox_attrs({'name': 'tags', 'value': 'b'}))
+        self.assertEqual(form.checkbox_attrs({'name': 'single', 'value': 'x'}).get('checked'), 'checked')
+        html = form.quick_select_tag({'name': 'tags', 'options': [('a', 'A'), ('b', 'B'), ('c', 'C')]})
+        self.assertEqual(html.count('selected="selected"'), 2)
+        self.assertEqual(form.input_attrs({'name': 'single'})['value'], 'x')
+        self.assertNotIn('unused', values.read)
+
+    def test_webob_multidict(self):
+        form = self.form(WebObMultiDict([('tags', 'a'), ('tags', 'c')]))
+        self.assertIsInstance(form.values, MultiDictValues)
+        self.assertEqual(form.checkbox_attrs({'name': 'tags', 'value': 'c'}).get('checked'), 'checked')
+
+    def test_attrs(self):
+        class Row(object):
+            name = 'bob'
+            admin = True
+        form = self.form(Row())
+        self.assertEqual(form.input_attrs({'name': 'name'})['value'], 'bob')
+        self.assertEqual(form.input_attrs({'name': 'other'})['value'], '')
+        self.assertEqual(form.checkbox_attrs({'name': 'admin'}).get('checked'), 'checked')
+
+    def test_callable(self):
+        read = []
+        form = self.form(lambda name: read.append(name) or {'a': 'x'}.get(name))
+        self.assertEqual(form.input_attrs({'name': 'a'})['value'], 'x')
+        self.assertEqual(form.input_attrs({'name': 'b', 'value': 'd'})['value'], 'd')
+        self.assertEqual(read, ['a', 'b'])
+
+    def test_repeat(self):
+        class Row(object):
+            phone = '555'
+        form = RepeatForm('test', None, None, {}, '', {}, {})
+        form.row_tag(Row())
+        self.assertEqual(form.input_attrs({'name': 'phone'})['value'], '555')
+
+class FieldLookupTests(unittest.TestCase):
+    def form(self, values, errors=None):
+        return Form('test', None, None, {}, '', {'test': values}, {'test': errors or {}})
+
+    def test_nested(self):
+        class Address(object):
+            city = 'Oslo'
+        form = self.form({'address': Address(), 'items': [{'qty': 1}, {'qty': 2}], 'a.b': 'flat', 'a': {'b': 'nested'}})
+        self.assertEqual(form.field_value('address.city'), 'Oslo')
+        self.assertEqual(form.field_value('items.1.qty'), 2)
+        self.assertEqual(form.field_value('a.b'), 'flat')
+        self.assertEqual(form.field_value('items.5.qty', 'x'), 'x')
+        self.assertEqual(form.field_value('address.zip', 'x'), 'x')
+        self.assertEqual(form.field_value('missing.zip', 'x'), 'x')
+
+    def test_nested_errors(self):
+        form = self.form({}, {'items': [None, {'qty': 'Too many'}]})
+        self.assertEqual(form.field_error('items.1.qty'), 'Too many')
+        self.assertIsNone(form.field_error('items.0.qty'))
+
+    def test_unicode_digits(self):
+        form = self.form({'a': {u'\xb2': 'squared'}})
+        self.assertEqual(form.field_value(u'a.\xb2'), 'squared')
+        self.assertIn('value="squared"', form.text_tag({'name': u'a.\xb2'}))
+
+    def test_compiled(self):
+        form = self.form({'address': {'city': 'Oslo'}})
+        form.field_value('address.city')
+        lookup = formpump_base._lookups['address.city']
+        self.assertEqual(self.form({'address': {'city': 'Bergen'}}).field_value('address.city'), 'Bergen')
+        self.assertIs(formpump_base._lookups['address.city'], lookup)
+
+class DecoderTests(unittest.TestCase):
+    def test_body(self):
+        submission = decode(b'__=person&_ctx=person.2&phone=555+123&tag=a&tag=b&&note=%C3%A9%26', '__', '_ctx')
+        self.assertEqual((submission.name, submission.ctx), ('person', 'person.2'))
+        self.assertEqual(submission.values, {'phone': u'555 123', 'tag': ['a', 'b'], 'note': u'\u00e9&'})
+        self.assertEqual(submission.form_vars, {'person.2': submission.values})
+
+    def test_multidict(self):
+        submission = decode(MultiDict([('__', 'login'), ('user', 'bob'), ('tag', 'a'), ('tag', 'b')]), '__')
+        self.assertEqual(submission.context, 'login')
+        self.assertEqual(submission.values, {'user': 'bob', 'tag': ['a', 'b']})
+
+    def test_pairs(self):
+        submission = decode([('user', 'bob'), ('empty', '')])
+        self.assertIsNone(submission.name)
+        self.assertEqual(submission.values, {'user': 'bob', 'empty': ''})
+        self.assertEqual(decode({'__': 'login', 'user': 'bob'}, '__').form_vars, {'login': {'user': 'bob'}})
+
+class OptionCacheTests(unittest.TestCase):
+    options = [(1, 'a'), (2, 'b')]
+
+    def test_lru(self):
+        cache = OptionCache(size=2)
+        a = cache.get(self.options, 'a')
+        cache.get(self.options, 'b')
+        self.assertIs(cache.get(self.options, 'a'), a)
+        cache.get(self.options, 'c')
+        self.assertIs(cache.get(self.options, 'a'), a)
+        self.assertIsNot(cache.get(self.options, 'b'), None)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4, 'entries': 2, 'size': 2})
+
+    def test_identity(self):
+        cache = OptionCache()
+        options = list(self.options)
+        entry = cache.get(options)
+        self.assertIs(cache.get(options), entry)
+        self.assertIsNot(cache.get(list(self.options)), entry)
+
+    def test_render(self):
+        entry = OptionCache().get([(1, 'a'), (None, '<b>'), (1, 'c')])
+        self.assertEqual(entry.render(set()), '<option value="1">a</option><option value="">&lt;b&gt;</option><option value="1">c</option>')
+        self.assertEqual(entry.render(set([u'1'])), '<option selected="selected" value="1">a</option><option value="">&lt;b&gt;</option><option selected="selected" value="1">c</option>')
+
+    def test_write_parts(self):
+        entry = OptionCache().get([(1, 'a'), (2, 'b'), (3, 'c'), (4, 'd')])
+        parts = []
+        entry.write(set([u'2']), parts.append)
+        self.assertEqual(parts, ['<option value="1">a</option>', '<option selected="selected" value="2">b</option>',
+                                 '<option value="3">c</option>', '<option value="4">d</option>'])
+        self.assertIs(parts[0], entry.parts[0])
+
+class FormCacheTests(unittest.TestCase):
+    def test_key(self):
+        cache = FormCache()
+        key = cache.key('t', 'test', {'a': 1, 'b': 2}, {'x': u'1'}, None, True, ())
+        self.assertEqual(key, cache.key('t', 'test', {'b': 2, 'a': 1}, {'x': 1}, None, True, ()))
+        self.assertNotEqual(key, cache.key('t', 'test', {'a': 1, 'b': 2}, {'x': u'2'}, None, True, ()))
+        self.assertNotEqual(key, cache.key('t', 'test', {'a': 1, 'b': 2}, {'x': u'1'}, None, 2, ()))
+
+    def test_memory_backend(self):
+        backend = MemoryBackend(size=2)
+        backend.set('a', u'A')
+        backend.set('b', u'B')
+        self.assertEqual(backend.get('a'), u'A')
+        backend.set('c', u'C')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), u'A')
+
+    def test_file_backend(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = FormCache(FileBackend(directory))
+            self.assertIsNone(cache.get('a'))
+            cache.set('a', u'<form>\u00e9</form>')
+            self.assertEqual(FormCache(FileBackend(directory)).get('a'), u'<form>\u00e9</form>')
+            self.assertEqual(cache.stats(), {'hits': 0, 'misses': 1, 'hit_rate': 0.0})
+            cache.backend.clear()
+            self.assertIsNone(cache.get('a'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_file_backend_newlines(self):
+        directory = tempfile.mkdtemp()
+        try:
+            backend = FileBackend(directory)
+            html = u'<form><textarea>a\r\nb\rc\n</textarea></form>'
+            backend.set('a', html)
+            self.assertEqual(backend.get('a'), html)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_file_backend_size(self):
+        directory = tempfile.mkdtemp()
+        try:
+            backend = FileBackend(directory, size=2)
+            for i, key in enumerate('ab'):
+                backend.set(key, u'<form>%s</form>' % key)
+                os.utime(os.path.join(directory, key), (i, i))
+            backend.get('a')
+            backend.set('c', u'<form>c</form>')
+            self.assertEqual(sorted(os.listdir(directory)), ['a', 'c'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_file_backend_sweeps(self):
+        directory = tempfile.mkdtemp()
+        try:
+            backend = FileBackend(directory, size=20)
+            for i in range(21):
+                backend.set('k%d' % i, u'<form></form>')
+            # Trimmed on every second write: the 21st form stays until the 22nd.
+            self.assertEqual(len(os.listdir(directory)), 21)
+            backend.set('k21', u'<form></form>')
+            self.assertEqual(len(os.listdir(directory)), 20)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_form_ids(self):
+        strategy = FormIds()
+        ids = ids_for_form(strategy, u'user login')
+        self.assertEqual([ids(), ids()], ['fp-user-login-1', 'fp-user-login-2'])
+        self.assertEqual(ids_for_form(strategy, u'user login')(), 'fp-user-login-1')
+
+    def test_form_ids_context(self):
+        form = Form('test', None, None, {}, '', {}, {}, html_ids=FormIds().form_ids('test'))
+        self.assertEqual(form.html_id(), 'fp-test-1')
+        form.context_tag({'name': 'person.2'})
+        self.assertEqual([form.html_id(), form.html_id()], ['fp-person-2-1', 'fp-person-2-2'])
+
+    def test_fingerprint(self):
+        form_vars = {'a': {'x': 1, 'y': [1, 2]}, 'b': {}}
+        self.assertEqual(fingerprint(form_vars), fingerprint({'b': {}, 'a': {'y': [1, 2], 'x': u'1'}}))
+        self.assertNotEqual(fingerprint(form_vars), fingerprint(form_vars, {'a': {'x': 'bad'}}))
+        self.assertNotEqual(fingerprint(form_vars), fingerprint(form_vars, extra='v2'))
+
+        prints = form_fingerprints(form_vars, {'c': {'x': 'bad'}})
+        self.assertEqual(sorted(prints), ['a', 'b', 'c'])
+        self.assertEqual(prints['a'], form_fingerprints({'a': {'x': 1, 'y': [1, 2]}})['a'])
+        self.assertNotEqual(prints['b'], prints['c'])
+
+    def test_fingerprint_multidict(self):
+        values = MultiDict([('a', '1'), ('a', '2')])
+        self.assertNotEqual(fingerprint({'f': values}), fingerprint({'f': MultiDict([('a', '1')])}))
+        self.assertEqual(fingerprint({'f': values}), fingerprint({'f': {'a': ['1', '2']}}))
+        self.assertRaises(TypeError, fingerprint, {'f': AttrValues(object())})
+
+class RenderMetricsTests(unittest.TestCase):
+    def form(self, metrics, cls=Form):
+        return metrics.form_class(cls)('test', None, None, {}, '', {'test': {'a': 1}}, {})
+
+    def test_form_class(self):
+        metrics = RenderMetrics()
+        self.assertIs(metrics.form_class(Form), metrics.form_class(Form))
+        self.assertTrue(issubclass(metrics.form_class(RepeatForm), RepeatForm))
+        self.assertFalse(hasattr(self.form(metrics), '__dict__'))
+
+    def test_nested_tags(self):
+        metrics = RenderMetrics()
+        form = self.form(metrics)
+        form.text_tag({'name': 'a', 'id': 'x'})
+        form.checkbox_tag({'name': 'b', 'id': 'y'})
+        form.input_attrs({'name': 'c', 'type': 'email', 'id': 'z'})
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['tags'], {'text': 1, 'checkbox': 1, 'email': 1})
+        self.assertEqual(snapshot['value_misses'], 2)
+
+    def test_prometheus(self):
+        metrics = RenderMetrics()
+        form = self.form(metrics)
+        form.text_tag({'name': 'a'})
+        form.close()
+        text = metrics.prometheus()
+        self.assertIn('# TYPE formpump_forms_rendered_total counter\nformpump_forms_rendered_total 1\n', text)
+        self.assertIn('formpump_unmatched_pairs_total 1\n', text)
+        self.assertIn('formpump_tags_rendered_total{tag="text"} 1\n', text)
+        self.assertIn('formpump_tag_seconds_total{tag="text"} ', text)
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {'forms': 0, 'ids': 0, 'unmatched_pairs': 0, 'value_misses': 0,
+                                              'tags': {}, 'tag_seconds': {}})
+
+if __name__ == "__main__":
+    unittest.main()
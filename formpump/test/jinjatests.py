@@ -1,10 +1,17 @@
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 import jinja2
 import logging
 import re
+import threading
+import time
 import unittest
 
-import base
+from . import base
 import formpump
+from formpump import jinjapump
 
 class JinjaPumpTests(base.FormPumpTests):
     def setUp(self):
@@ -21,6 +28,26 @@ class JinjaPumpTests(base.FormPumpTests):
         form_ctx_key, self.env.form_ctx_key = self.env.form_ctx_key, form_ctx_key
         return form_ctx_key
 
+    def set_id_strategy(self, strategy):
+        strategy, self.env.html_id_strategy = self.env.html_id_strategy, strategy
+        return strategy
+
+    def set_option_cache(self, option_cache):
+        option_cache, self.env.option_cache = self.env.option_cache, option_cache
+        return option_cache
+
+    def set_metrics(self, metrics):
+        metrics, self.env.formpump_metrics = self.env.formpump_metrics, metrics
+        return metrics
+
+    def set_deterministic(self, deterministic):
+        deterministic, self.env.deterministic = self.env.deterministic, deterministic
+        return deterministic
+
+    def set_form_cache(self, form_cache):
+        form_cache, self.env.form_cache = self.env.form_cache, form_cache
+        return form_cache
+
     def add_renderer(self, name, callback):
         self.env.error_renderers[name] = callback
 
@@ -73,7 +100,10 @@ class JinjaPumpFillTests(JinjaPumpTests, base.FillTests):
         return '{% form "test" %}{% radio "var" value="a" %}{% radio "var" value="b" %}{% radio "var" value="c" %}{% endform %}'
 
     def submit_fill(self):
-        return '{% form "test" %}{% submit "var" %}{% endform %}'
+        return '{% form "test" %}{% submit name="var" %}{% endform %}'
+
+    def text_fill_nested(self):
+        return '{% form "test" %}{% text "address.city" %}{% text "items.1.qty" %}{% endform %}'
 
     def text_fill(self):
         return '{% form "test" %}{% text "var" %}{% endform %}'
@@ -94,6 +124,9 @@ class JinjaPumpFormContextTests(JinjaPumpTests, base.FormContextTests):
     def form_context_fill(self):
         return '{% form "test" %}{% form_ctx "ctx" %}{% text "var" %}{% endform %}'
 
+    def form_context_error(self):
+        return '{% form "test" %}{% text "var" %}{% form_ctx "ctx" %}{% error "var" %}{% text "var" %}{% endform %}'
+
 class JinjaPumpLabelTests(JinjaPumpTests, base.LabelTests):
     def label(self):
         return '{% form %}{% label name="var" %}ok{% endlabel %}{% endform %}'
@@ -123,6 +156,373 @@ class JinjaPumpErrorTests(JinjaPumpTests, base.ErrorTests):
     def error_renderer(self):
         return '{% form "test" %}{% error "a" render="test" %}ok{% endform %}'
 
+class JinjaPumpQuickSelectTests(JinjaPumpTests, base.QuickSelectTests):
+    def quick_select(self):
+        return '{% form "test" %}{% quickselect "var" options=options %}{% endform %}'
+
+    def quick_select_prompt(self):
+        return '{% form "test" %}{% quickselect "var" options=options prompt="Pick" %}{% endform %}'
+
+    def quick_select_keyed(self):
+        return '{% form "test" %}{% quickselect "var" options=options cache_key="opts" %}{% endform %}'
+
+    def test_quick_select_autoescape(self):
+        self.env.autoescape = True
+        tpl = self._run_template('{% form "test" %}{% quickselect "var" options=options %}{% endform %}',
+                                 options=[(1, '<a>'), (2, 'b')], form_vars={'test': {'var': 2}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><select name="var"><option value="1">&lt;a&gt;</option>'
+                                  '<option selected="selected" value="2">b</option></select></form>')
+
+class JinjaPumpRepeatTests(JinjaPumpTests, base.RepeatTests):
+    def form_repeat(self):
+        return '{% formrepeat "person" for person in people ctx=person.id %}{% label "phone" %}{{ person.phone }}{% endlabel %}{% text "phone" %}{% endformrepeat %}'
+
+    def form_repeat_plain(self):
+        return '{% formrepeat "person" for person in people action="x" %}{% text "phone" %}{% endformrepeat %}'
+
+class JinjaPumpIdTests(JinjaPumpTests, base.IdTests):
+    def html_ids(self):
+        return '{% form %}{% label "a" %}a{% endlabel %}{% text "a" %}{% text "b" %}{% label "c" %}c{% endlabel %}{% checkbox "c" %}{% endform %}'
+
+class JinjaPumpMetricsTests(JinjaPumpTests, base.MetricsTests):
+    def metrics(self):
+        return '{% form "test" %}{% label "a" %}a{% endlabel %}{% text "a" %}{% text "b" %}{% endform %}'
+
+    def form_repeat(self):
+        return '{% formrepeat "person" for person in people %}{% label "phone" %}{{ person.id }}{% endlabel %}{% text "phone" %}{% endformrepeat %}'
+
+    def test_metrics_folded(self):
+        # The submit is written out when the template is compiled.
+        html, snapshot = self.run_metered('{% form "test" %}{% text "a" %}{% submit "Save" %}{% endform %}')
+        self.assertHTMLEqual(html, '<form action="" method="post"><input type="text" name="a" value="" /><input type="submit" value="Save" /></form>')
+        self.assertEqual(snapshot['forms'], 1)
+        self.assertEqual(snapshot['tags'], {'text': 1})
+
+class JinjaPumpFormCacheTests(JinjaPumpTests, base.FormCacheTests):
+    def form_cached(self):
+        return '{% form "test" cache=True %}{% label "a" %}a{% endlabel %}{% text "a" %}{% endform %}'
+
+    def test_form_ctx_refused(self):
+        for tpl in ('{% form "people" cache=True %}{% form_ctx "p1" %}{% text "nm" %}{% endform %}',
+                    '{% form "people" cache=True %}{% formrepeat "p" for p in people %}{% endformrepeat %}{% endform %}',
+                    '{% form "people" cache=True %}{% form "inner" %}{% endform %}{% endform %}'):
+            self.assertRaises(jinja2.TemplateSyntaxError, self.env.from_string, tpl)
+        self.env.from_string('{% form "people" cache=True %}{% endform %}{% form_ctx "p1" %}')
+
+        # Reached through an include or a macro, they are refused at render time.
+        self.env.loader = jinja2.DictLoader({
+            'ctx.html': '{% form_ctx "p1" %}{% text "nm" %}',
+            'repeat.html': '{% formrepeat "p" for p in people %}{% endformrepeat %}',
+            'form.html': '{% form "inner" %}{% endform %}',
+            'macros.html': '{% macro ctx() %}{% form_ctx "p1" %}{% endmacro %}'})
+        self.env.form_cache = formpump.FormCache()
+        self.env.html_id_strategy = formpump.FormIds()
+        for tpl in ('{% form "people" cache=True %}{% include "ctx.html" %}{% endform %}',
+                    '{% form "people" cache=True %}{% include "repeat.html" %}{% endform %}',
+                    '{% form "people" cache=True %}{% include "form.html" %}{% endform %}',
+                    '{% from "macros.html" import ctx %}{% form "people" cache=True %}{{ ctx() }}{% endform %}'):
+            with self.assertRaises(ValueError) as cm:
+                self.env.from_string(tpl).render(people=[1])
+            self.assertIn('cannot be used inside a cached form', str(cm.exception))
+        tpl = self.env.from_string('{% form "people" cache=True %}{% endform %}{% include "ctx.html" %}')
+        self.assertEqual(self.stripID(tpl.render()), self.stripID(tpl.render()))
+
+class JinjaPumpDeterministicTests(JinjaPumpTests, base.DeterministicTests):
+    def deterministic(self):
+        return '{% form "test" %}{% label "a" %}a{% endlabel %}{% text "a" %}{% form_ctx "ctx" %}{% text "a" %}{% endform %}'
+
+    def deterministic_repeated(self):
+        return ('{% form %}{% label "q" %}q{% endlabel %}{% text "q" %}{% endform %}' * 2 +
+                '{% form "test" %}{% label "q" %}q{% endlabel %}{% text "q" %}{% endform %}' * 2)
+
+    def deterministic_attrs(self):
+        return ('{% form "test" class="f" action="/" %}{% text "a" placeholder="p" class="x" %}{% endform %}',
+                '{% form "test" action="/" class="f" %}{% text "a" class="x" placeholder="p" %}{% endform %}')
+
+class JinjaPumpDecodeTests(JinjaPumpTests, base.DecodeTests):
+    def decode(self, data):
+        return jinjapump.find_pump(self.env).decode(data)
+
+    def round_trip(self):
+        return ('{% form "person" %}{% form_ctx "person.2" %}{% text "phone" %}'
+                '{% checkbox "tag" value="a" %}{% checkbox "tag" value="b" %}{% checkbox "tag" value="c" %}{% endform %}')
+
+class JinjaPumpManifestTests(JinjaPumpTests, base.ManifestTests):
+    def manifest(self, source):
+        return jinjapump.find_pump(self.env).manifest(source=source)
+
+    def manifest_source(self):
+        return ('{% text "search" %}'
+                '{% form "login" %}{% form_ctx "login.2" %}{% text "user" %}'
+                '{% quickselect "country" options=data.countries %}{% label "x" %}x{% endlabel %}'
+                '{% for name in names %}{% checkbox name=name %}{% endfor %}{% submit "Go" name="go" %}{% endform %}'
+                '{% formrepeat "person" for person in people ctx=person.id %}{% text "phone" %}{% endformrepeat %}')
+
+    def test_manifest_loader(self):
+        self.env.loader = jinja2.DictLoader({'login.html': '{% form "login" %}{% text "user" %}{% endform %}'})
+        manifest = jinjapump.find_pump(self.env).manifest('login.html')
+        self.assertEqual(manifest.template, 'login.html')
+        self.assertEqual(manifest.field_names('login'), set(['user']))
+
+class JinjaPumpRenderStateTests(JinjaPumpTests):
+    def test_threads(self):
+        tpl = self.env.from_string('{% form "test" %}{{ pause() }}{% text "var" %}{% endform %}')
+        results = {}
+
+        def render(n):
+            results[n] = [self.stripID(tpl.render(pause=lambda: time.sleep(0.001) or '',
+                                                  form_vars={'test': {'var': n}}))
+                          for i in range(10)]
+
+        threads = [threading.Thread(target=render, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in range(8):
+            for html in results[n]:
+                self.assertHTMLEqual(html, '<form action="" method="post"><input type="text" name="var" value="%d" /></form>' % n)
+
+    def test_include(self):
+        env = jinja2.Environment(extensions=[formpump.JinjaPump],
+                                 loader=jinja2.DictLoader({'fields': '{% text "var" %}'}))
+        tpl = env.from_string('{% form "test" %}{% include "fields" %}{% endform %}{% text "var" %}')
+        self.assertHTMLEqual(self.stripID(tpl.render(form_vars={'test': {'var': 'val'}})),
+                             '<form action="" method="post"><input type="text" name="var" value="val" /></form><input type="text" name="var" value="" />')
+
+    def test_imported_macro(self):
+        env = jinja2.Environment(extensions=[formpump.JinjaPump],
+                                 loader=jinja2.DictLoader({'macros': '{% macro field() %}{% text "var" %}{% endmacro %}'}))
+        tpl = env.from_string('{% from "macros" import field %}{% form "test" %}{{ field() }}{% endform %}'
+                              '{{ field() }}')
+        for i in range(3):
+            self.assertHTMLEqual(self.stripID(tpl.render(form_vars={'test': {'var': 'val'}})),
+                                 '<form action="" method="post"><input type="text" name="var" value="val" /></form><input type="text" name="var" value="" />')
+        self.assertEqual(jinjapump._get_active(), ())
+
+    def test_imported_macro_threads(self):
+        env = jinja2.Environment(extensions=[formpump.JinjaPump],
+                                 loader=jinja2.DictLoader({'macros': '{% macro field() %}{{ pause() }}{% text "var" %}{% endmacro %}'}))
+        env.globals['pause'] = lambda: time.sleep(0.001) or ''
+        tpl = env.from_string('{% import "macros" as m %}{% form "test" %}{{ m.field() }}{% endform %}')
+        results = {}
+
+        def render(n):
+            results[n] = [self.stripID(tpl.render(form_vars={'test': {'var': n}})) for i in range(10)]
+
+        threads = [threading.Thread(target=render, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in range(8):
+            for html in results[n]:
+                self.assertHTMLEqual(html, '<form action="" method="post"><input type="text" name="var" value="%d" /></form>' % n)
+
+    def test_macro_outside_render(self):
+        env = jinja2.Environment(extensions=[formpump.JinjaPump],
+                                 loader=jinja2.DictLoader({'macros': '{% macro login() %}{% form "login" %}{% label "user" %}{% endlabel %}'
+                                                                     '{% text "user" %}{% endform %}{% endmacro %}'}))
+        html = env.get_template('macros').module.login()
+        tags = self.get_tags(html)
+        self.assertEqual(tags[1]['attrs']['for'], tags[3]['attrs']['id'])
+        self.assertEqual(jinjapump._get_active(), ())
+
+    def test_compile_expression(self):
+        self.assertEqual(self.env.compile_expression('1 + 1')(), 2)
+        self.assertEqual(self.env.compile_expression('form_vars.test')(form_vars={'test': 'val'}), 'val')
+        self.assertEqual(self.run_template(''), '')
+        self.assertHTMLEqual(self.stripID(self.run_template('{# comment #}{% text "var" %}')),
+                             '<input type="text" name="var" value="" />')
+
+    def test_pumpwidget(self):
+        @formpump.pumpwidget
+        def widget(pump, name):
+            return pump.input_tag({'type': 'text', 'name': name})
+
+        self.env.globals['widget'] = widget
+        tpl = self._run_template('{% form "test" %}{{ widget("var") }}{% endform %}',
+                                 form_vars={'test': {'var': 'val'}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><input type="text" name="var" value="val" /></form>')
+
+    def test_pumpwidget_method(self):
+        class Widgets(object):
+            @formpump.pumpwidget
+            def widget(self, pump, name):
+                return pump.input_tag({'type': 'text', 'name': name})
+
+        tpl = self._run_template('{% form "test" %}{{ widgets.widget("var") }}{% endform %}',
+                                 widgets=Widgets(), form_vars={'test': {'var': 'val'}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><input type="text" name="var" value="val" /></form>')
+
+    def test_pumpwidget_extension_order(self):
+        self.env = jinja2.Environment(extensions=['jinja2.ext.do', formpump.JinjaPump])
+        pump = [ext for ext in self.env.extensions.values() if isinstance(ext, formpump.JinjaPump)][0]
+        self.assertIs(jinjapump.find_pump(self.env), pump)
+        self.test_pumpwidget()
+
+        with self.assertRaises(Exception):
+            jinjapump.find_pump(jinja2.Environment())
+
+    def test_pumpwidget_registry(self):
+        @formpump.pumpwidget(name='fp_test_before')
+        def before(pump, name):
+            return pump.input_tag({'type': 'text', 'name': name})
+
+        env = jinja2.Environment(extensions=[formpump.JinjaPump])
+        self.env.globals['fp_test_after'] = 'not a widget'
+
+        @formpump.pumpwidget(name='fp_test_after')
+        def after(pump, name):
+            return pump.input_tag({'type': 'hidden', 'name': name})
+
+        try:
+            for self.env in (self.env, env):
+                tpl = self._run_template('{% form "test" %}{{ fp_test_before("var") }}{% endform %}',
+                                         form_vars={'test': {'var': 'val'}})
+                self.assertHTMLEqual(tpl, '<form action="" method="post"><input type="text" name="var" value="val" /></form>')
+            self.assertIs(self.env.globals['fp_test_after'].pumpwidget, after.pumpwidget)
+        finally:
+            formpump.remove_pumpwidget('fp_test_before')
+            formpump.remove_pumpwidget('fp_test_after')
+
+        self.assertNotIn('fp_test_before', env.globals)
+        self.assertNotIn('fp_test_after', env.globals)
+
+class JinjaPumpStreamTests(JinjaPumpTests):
+    def test_generate(self):
+        chunks = []
+        seen = []
+
+        def probe():
+            seen.append(u''.join(chunks))
+            return ''
+
+        tpl = self.env.from_string('{% form "test" %}{% label "var" %}{{ probe() }}{% endlabel %}'
+                                   '{% for i in range(100) %}{% text "var" %}{% endfor %}{{ probe() }}{% endform %}')
+        for chunk in tpl.generate(probe=probe):
+            chunks.append(chunk)
+
+        self.assertTrue(seen[0].startswith('<form'))
+        self.assertTrue(seen[0].endswith('>'))
+        self.assertIn('<label', seen[0])
+        self.assertNotIn('</label>', seen[0])
+        self.assertEqual(seen[1].count('<input'), 100)
+        self.assertNotIn('</form>', seen[1])
+        self.assertTrue(u''.join(chunks).endswith('</form>'))
+        self.assertTrue(len(chunks) > 100)
+
+    def test_generate_textarea(self):
+        value = u'x' * (formpump.base.CHUNK_SIZE * 3)
+        tpl = self.env.from_string('{% form "test" %}{% textarea "var" %}{% endform %}')
+        chunks = list(tpl.generate(form_vars={'test': {'var': value}}))
+        self.assertEqual(max(len(chunk) for chunk in chunks), formpump.base.CHUNK_SIZE)
+        self.assertIn(value, u''.join(chunks))
+
+class JinjaPumpAsyncTests(JinjaPumpTests):
+    def setUp(self):
+        self.env = jinja2.Environment(extensions=[formpump.JinjaPump], enable_async=True)
+        if asyncio is None or not self.env.is_async:
+            self.skipTest('async rendering is not supported here')
+
+    def run_async(self, start):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(start())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def run_template(self, tpl, **kwargs):
+        return self.run_async(lambda: self.env.from_string(tpl).render_async(**kwargs))
+
+class JinjaPumpAsyncRenderTests(JinjaPumpAsyncTests):
+    def test_gather(self):
+        tpl = self.env.from_string('{% form "test" %}{{ pause() }}{% label "var" %}{{ pause() }}{% endlabel %}'
+                                   '{% text "var" %}{% endform %}')
+        results = self.run_async(lambda: asyncio.gather(*[
+                    tpl.render_async(pause=lambda: asyncio.sleep(0, result=''),
+                                     form_vars={'test': {'var': n}})
+                    for n in range(50)]))
+
+        for n, html in enumerate(results):
+            self.assertHTMLEqual(self.stripID(html), '<form action="" method="post"><label></label><input type="text" name="var" value="%d" /></form>' % n)
+            tags = self.get_tags(html)
+            self.assertEqual(tags[1]['attrs']['for'], tags[3]['attrs']['id'])
+
+    def test_gather_imported_macro(self):
+        self.env.loader = jinja2.DictLoader({'macros': '{% macro field() %}{{ pause() }}{% text "var" %}{% endmacro %}'})
+        self.env.globals['pause'] = lambda: asyncio.sleep(0, result='')
+        tpl = self.env.from_string('{% import "macros" as m %}{% form "test" %}{{ m.field() }}{% endform %}')
+        results = self.run_async(lambda: asyncio.gather(*[tpl.render_async(form_vars={'test': {'var': n}})
+                                                          for n in range(50)]))
+
+        for n, html in enumerate(results):
+            self.assertHTMLEqual(self.stripID(html), '<form action="" method="post"><input type="text" name="var" value="%d" /></form>' % n)
+
+class JinjaPumpAsyncFillTests(JinjaPumpAsyncTests, JinjaPumpFillTests):
+    pass
+
+class JinjaPumpAsyncFormContextTests(JinjaPumpAsyncTests, JinjaPumpFormContextTests):
+    pass
+
+class JinjaPumpAsyncLabelTests(JinjaPumpAsyncTests, JinjaPumpLabelTests):
+    pass
+
+class JinjaPumpAsyncErrorTests(JinjaPumpAsyncTests, JinjaPumpErrorTests):
+    pass
+
+class JinjaPumpAsyncRepeatTests(JinjaPumpAsyncTests, JinjaPumpRepeatTests):
+    pass
+
+class JinjaPumpCompileTests(JinjaPumpTests):
+    def compile(self, tpl):
+        # Without the calls that open and close the state of every render.
+        src = self.env.compile(tpl, raw=True)
+        return '\n'.join(line for line in src.splitlines()
+                         if not line.endswith(('._begin, context)', '._end, context)')))
+
+    def test_static_submit_folds(self):
+        src = self.compile('{% submit "Save" %}')
+        self.assertIn('value="Save"', src)
+        self.assertNotIn('context.call', src)
+        self.assertHTMLEqual(self._run_template('{% submit "Save" %}'),
+                             '<input type="submit" value="Save" />')
+
+    def test_static_label_folds(self):
+        src = self.compile('{% label class="x" %}ok{% endlabel %}')
+        self.assertNotIn('context.call', src)
+        self.assertHTMLEqual(self._run_template('{% form %}{% label class="x" %}ok{% endlabel %}{% endform %}'),
+                             '<form action="" method="post"><label class="x">ok</label></form>')
+
+    def test_static_attrs(self):
+        src = self.compile('{% text "var" title="t" data_x="1" %}')
+        self.assertIn('data-x=', src)
+        self.assertIn('title=', src)
+        tpl = self._run_template('{% form "test" %}{% text "var" title="t" data_x="1" %}{% endform %}',
+                                 form_vars={'test': {'var': 'val'}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><input type="text" name="var" value="val" title="t" data-x="1" /></form>')
+
+    def test_static_class_with_error(self):
+        tpl = self._run_template('{% form "test" %}{% text "var" class="x" %}{% endform %}',
+                                 form_errors={'test': {'var': 'bad'}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><input type="text" name="var" value="" class="error x" /></form>')
+
+    def test_dynamic_attrs(self):
+        tpl = self._run_template('{% form "test" %}{% checkbox "var" title=title %}{% textarea "area" title=title %}{% endform %}',
+                                 title='<t>',
+                                 form_vars={'test': {'var': 'on', 'area': '<a>'}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><input checked="checked" type="checkbox" name="var" value="1" title="&lt;t&gt;" /><textarea name="area" title="&lt;t&gt;">&lt;a&gt;</textarea></form>')
+
+    def test_static_textarea_folds(self):
+        src = self.compile('{% textarea rows="3" %}')
+        self.assertNotIn('context.call', src)
+        self.assertHTMLEqual(self._run_template('{% textarea rows="3" %}'),
+                             '<textarea rows="3"></textarea>')
+
 if __name__ == "__main__":
     unittest.main()
 
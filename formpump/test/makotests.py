@@ -1,14 +1,21 @@
 import logging
+from mako.lookup import TemplateLookup
+from mako.runtime import Context
 from mako.template import Template
 import re
+import threading
+import time
 import unittest
 
-import base
+from . import base
+import formpump
 from formpump import makopump
 
 
 class MakoPumpTests(base.FormPumpTests):
-    def run_template(self, tpl, **kwargs):
+    def run_template(self, tpl, template=None, **kwargs):
+        if template is not None:
+            return template.render(**kwargs)
         tpl = '<%namespace name="fp" module="formpump.makopump" />' + tpl
         return Template(tpl).render(**kwargs)
 
@@ -18,6 +25,21 @@ class MakoPumpTests(base.FormPumpTests):
     def set_form_ctx_key(self, form_ctx_key):
         return makopump.set_form_ctx_key(form_ctx_key)
 
+    def set_id_strategy(self, strategy):
+        return makopump.set_html_id_strategy(strategy)
+
+    def set_option_cache(self, option_cache):
+        return makopump.set_option_cache(option_cache)
+
+    def set_metrics(self, metrics):
+        return makopump.set_metrics(metrics)
+
+    def set_deterministic(self, deterministic):
+        return makopump.set_deterministic(deterministic)
+
+    def set_form_cache(self, form_cache):
+        return makopump.set_form_cache(form_cache)
+
     def add_renderer(self, name, callback):
         makopump.add_error_renderer(name, callback)
 
@@ -73,6 +95,9 @@ class MakoPumpFillTests(MakoPumpTests, base.FillTests):
     def submit_fill(self):
         return '<%fp:form name="test"><%fp:submit name="var" /></%fp:form>'
 
+    def text_fill_nested(self):
+        return '<%fp:form name="test"><%fp:text name="address.city" /><%fp:text name="items.1.qty" /></%fp:form>'
+
     def text_fill(self):
         return '<%fp:form name="test"><%fp:text name="var" /></%fp:form>'
 
@@ -92,6 +117,9 @@ class MakoPumpFormContextTests(MakoPumpTests, base.FormContextTests):
     def form_context_fill(self):
         return '<%fp:form name="test"><%fp:form_ctx name="ctx" /><%fp:text name="var" /></%fp:form>'
 
+    def form_context_error(self):
+        return '<%fp:form name="test"><%fp:text name="var" /><%fp:form_ctx name="ctx" /><%fp:error name="var" /><%fp:text name="var" /></%fp:form>'
+
 class MakoPumpLabelTests(MakoPumpTests, base.LabelTests):
     def label(self):
         return '<%fp:form><%fp:label name="var">ok</%fp:label></%fp:form>'
@@ -121,6 +149,235 @@ class MakoPumpErrorTests(MakoPumpTests, base.ErrorTests):
     def error_renderer(self):
         return '<%fp:form name="test"><%fp:error name="a" render="test" />ok</%fp:form>'
 
+class MakoPumpQuickSelectTests(MakoPumpTests, base.QuickSelectTests):
+    def quick_select(self):
+        return '<%fp:form name="test"><%fp:quickselect name="var" options="${options}" /></%fp:form>'
+
+    def quick_select_prompt(self):
+        return '<%fp:form name="test"><%fp:quickselect name="var" options="${options}" prompt="Pick" /></%fp:form>'
+
+    def quick_select_keyed(self):
+        return '<%fp:form name="test"><%fp:quickselect name="var" options="${options}" cache_key="opts" /></%fp:form>'
+
+class MakoPumpRepeatTests(MakoPumpTests, base.RepeatTests):
+    def form_repeat(self):
+        return '<%fp:formrepeat name="person" records="${people}" ctx="id" args="person"><%fp:label name="phone">${person[\'phone\']}</%fp:label><%fp:text name="phone" /></%fp:formrepeat>'
+
+    def form_repeat_plain(self):
+        return '<%fp:formrepeat name="person" records="${people}" action="x" args="person"><%fp:text name="phone" /></%fp:formrepeat>'
+
+class MakoPumpIdTests(MakoPumpTests, base.IdTests):
+    def html_ids(self):
+        return '<%fp:form><%fp:label name="a">a</%fp:label><%fp:text name="a" /><%fp:text name="b" /><%fp:label name="c">c</%fp:label><%fp:checkbox name="c" /></%fp:form>'
+
+class MakoPumpMetricsTests(MakoPumpTests, base.MetricsTests):
+    def metrics(self):
+        return '<%fp:form name="test"><%fp:label name="a">a</%fp:label><%fp:text name="a" /><%fp:text name="b" /></%fp:form>'
+
+    def form_repeat(self):
+        return '<%fp:formrepeat name="person" records="${people}" args="person"><%fp:label name="phone">${person[\'id\']}</%fp:label><%fp:text name="phone" /></%fp:formrepeat>'
+
+class MakoPumpFormCacheTests(MakoPumpTests, base.FormCacheTests):
+    def form_cached(self):
+        return '<%fp:form name="test" cache="1"><%fp:label name="a">a</%fp:label><%fp:text name="a" /></%fp:form>'
+
+    def test_included_templates(self):
+        lookup = TemplateLookup()
+        for name in 'ab':
+            lookup.put_string(name, '<%%namespace name="fp" module="formpump.makopump" />'
+                                    '<%%fp:form name="test" cache="1">%s</%%fp:form>' % name)
+        lookup.put_string('page', '<%include file="a" /><%include file="b" />')
+        html = self.run_cached('', formpump.FormCache(), template=lookup.get_template('page'))
+        self.assertHTMLEqual(html, '<form action="" method="post">a</form><form action="" method="post">b</form>')
+
+    def test_form_ctx_refused(self):
+        tpl = '<%fp:form name="people" cache="1"><%fp:form_ctx name="p1" /><%fp:text name="nm" /></%fp:form>'
+        self.assertRaises(ValueError, self.run_cached, tpl, formpump.FormCache())
+        tpl = '<%fp:form name="people" cache="1"><%fp:form name="inner"></%fp:form></%fp:form>'
+        self.assertRaises(ValueError, self.run_cached, tpl, formpump.FormCache())
+
+class MakoPumpDeterministicTests(MakoPumpTests, base.DeterministicTests):
+    def deterministic(self):
+        return '<%fp:form name="test"><%fp:label name="a">a</%fp:label><%fp:text name="a" /><%fp:form_ctx name="ctx" /><%fp:text name="a" /></%fp:form>'
+
+    def deterministic_repeated(self):
+        return ('<%fp:form><%fp:label name="q">q</%fp:label><%fp:text name="q" /></%fp:form>' * 2 +
+                '<%fp:form name="test"><%fp:label name="q">q</%fp:label><%fp:text name="q" /></%fp:form>' * 2)
+
+    def deterministic_attrs(self):
+        return ('<%fp:form name="test" class_="f" action="/"><%fp:text name="a" placeholder="p" class_="x" /></%fp:form>',
+                '<%fp:form name="test" action="/" class_="f"><%fp:text class_="x" placeholder="p" name="a" /></%fp:form>')
+
+class MakoPumpDecodeTests(MakoPumpTests, base.DecodeTests):
+    def decode(self, data):
+        return makopump.decode_submission(data)
+
+    def round_trip(self):
+        return ('<%fp:form name="person"><%fp:form_ctx name="person.2" /><%fp:text name="phone" />'
+                '<%fp:checkbox name="tag" value="a" /><%fp:checkbox name="tag" value="b" /><%fp:checkbox name="tag" value="c" /></%fp:form>')
+
+class MakoPumpManifestTests(MakoPumpTests, base.ManifestTests):
+    def manifest(self, source):
+        return makopump.template_manifest(Template('<%namespace name="fp" module="formpump.makopump" />' + source))
+
+    def manifest_source(self):
+        return ('<%fp:text name="search" />'
+                '<%fp:form name="login"><%fp:form_ctx name="login.2" /><%fp:text name="user" />'
+                '<%fp:quickselect name="country" options="${data.countries}" /><%fp:label name="x">x</%fp:label>\n'
+                '% for name in names:\n<%fp:checkbox name="${name}" />\n% endfor\n'
+                '<%fp:submit name="go" value="Go" /></%fp:form>'
+                '<%fp:formrepeat name="person" records="${people}" ctx="id" args="person"><%fp:text name="phone" /></%fp:formrepeat>')
+
+    def test_manifest_namespace(self):
+        manifest = makopump.template_manifest('<%f:form name="login"><%f:text name="user" /></%f:form>', namespaces=['f'])
+        self.assertEqual(manifest.field_names('login'), set(['user']))
+
+# The field tag suites again, with the tags compiled inline.
+class MakoInlineTests(object):
+    def run_template(self, tpl, **kwargs):
+        tpl = '<%namespace name="fp" module="formpump.makopump" />' + tpl
+        return Template(tpl, preprocessor=makopump.inline_tags).render(**kwargs)
+
+class MakoInlineInputTests(MakoInlineTests, MakoPumpInputTests):
+    pass
+
+class MakoInlineFillTests(MakoInlineTests, MakoPumpFillTests):
+    pass
+
+class MakoInlineFormContextTests(MakoInlineTests, MakoPumpFormContextTests):
+    pass
+
+class MakoInlineLabelTests(MakoInlineTests, MakoPumpLabelTests):
+    pass
+
+class MakoInlineErrorTests(MakoInlineTests, MakoPumpErrorTests):
+    pass
+
+class MakoInlineRepeatTests(MakoInlineTests, MakoPumpRepeatTests):
+    pass
+
+class MakoInlineMetricsTests(MakoInlineTests, MakoPumpMetricsTests):
+    pass
+
+class MakoInlineDeterministicTests(MakoInlineTests, MakoPumpDeterministicTests):
+    pass
+
+class MakoInlineTagTests(MakoPumpTests):
+    def test_lines_kept(self):
+        source = ('<%namespace name="fp" module="formpump.makopump" /><%fp:form name="test">\n'
+                  '<%fp:text\n name="${name}"\n value="${value}" />\n<%fp:label\n name="x">x</%fp:label>\n</%fp:form>')
+        self.assertEqual(makopump.inline_tags(source).count('\n'), source.count('\n'))
+        html = Template(source, preprocessor=makopump.inline_tags).render(name='a', value='b')
+        self.assertHTMLEqual(self.stripID(html), '<form action="" method="post">\n<input type="text"\n name="a"\n value="b" />\n'
+                                                 '<label\n>x</label>\n</form>')
+
+    def test_control_line_last(self):
+        tpl = Template('<%namespace name="fp" module="formpump.makopump" />\n'
+                       '% for i in range(2):\n<%fp:text name="v${i}" />\n% endfor',
+                       preprocessor=makopump.inline_tags)
+        self.assertHTMLEqual(self.stripID(tpl.render()), '\n<input type="text" name="v0" value="" />\n'
+                                                         '<input type="text" name="v1" value="" />\n')
+
+    def test_static_attrs(self):
+        inlined = makopump.inline_tags('<%fp:text name="x" size="10" />', namespaces=['fp'])
+        self.assertTrue(inlined.startswith('<input '))
+        self.assertIn('size="10"', inlined.split('${')[0])
+        self.assertIn("{'name': 'x'}", inlined)
+
+    def test_other_namespace(self):
+        source = '<%namespace name="f" module="formpump.makopump" /><%f:text name="x" /><%fp:text name="y" />'
+        inlined = makopump.inline_tags(source)
+        self.assertNotIn('<%f:text', inlined)
+        self.assertIn('<%fp:text', inlined)
+
+    def test_file_namespace(self):
+        source = '<%namespace name="fp" file="lib.html" /><%fp:text name="x" />'
+        self.assertEqual(makopump.inline_tags(source), source + '<%! from formpump import makopump as _formpump %>')
+        self.assertEqual(makopump.template_manifest(source).field_names(None), set())
+
+    def test_text_block(self):
+        source = ('<%namespace name="fp" module="formpump.makopump" />'
+                  '<%text><%fp:text name="a"/></%text><%fp:text name="b" />')
+        inlined = makopump.inline_tags(source)
+        self.assertIn('<%text><%fp:text name="a"/></%text>', inlined)
+        self.assertNotIn('<%fp:text name="b"', inlined)
+        html = Template(source, preprocessor=makopump.inline_tags).render()
+        self.assertHTMLEqual(self.stripID(html), '<%fp:text name="a"/><input type="text" name="b" value="" />')
+
+class MakoPumpStreamTests(MakoPumpTests):
+    class Writer(object):
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, chunk):
+            self.chunks.append(chunk)
+
+    def test_render_context(self):
+        writer = self.Writer()
+        seen = []
+
+        def probe():
+            seen.append(u''.join(writer.chunks))
+            return ''
+
+        tpl = Template('<%namespace name="fp" module="formpump.makopump" />'
+                       '<%fp:form name="test"><%fp:label name="var">${probe()}</%fp:label>\n'
+                       '% for i in range(100):\n<%fp:text name="var" />\n% endfor\n${probe()}</%fp:form>')
+        tpl.render_context(Context(writer, probe=probe))
+
+        self.assertTrue(seen[0].startswith('<form'))
+        self.assertIn('<label', seen[0])
+        self.assertNotIn('</label>', seen[0])
+        self.assertEqual(seen[1].count('<input'), 100)
+        self.assertNotIn('</form>', seen[1])
+        self.assertTrue(u''.join(writer.chunks).endswith('</form>'))
+
+class MakoPumpRenderStateTests(MakoPumpTests):
+    def test_threads(self):
+        tpl = Template('<%namespace name="fp" module="formpump.makopump" />'
+                       '<%fp:form name="test">${pause()}<%fp:text name="var" /></%fp:form>')
+        results = {}
+
+        def render(n):
+            results[n] = [self.stripID(tpl.render(pause=lambda: time.sleep(0.001) or '',
+                                                  form_vars={'test': {'var': n}}))
+                          for i in range(10)]
+
+        threads = [threading.Thread(target=render, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for n in range(8):
+            for html in results[n]:
+                self.assertHTMLEqual(html, '<form action="" method="post"><input type="text" name="var" value="%d" /></form>' % n)
+
+    def test_nested_form_restored(self):
+        tpl = self._run_template('<%fp:form name="a"><%fp:form name="b"></%fp:form><%fp:text name="var" /></%fp:form>',
+                                 form_vars={'a': {'var': 'a'}, 'b': {'var': 'b'}})
+        self.assertHTMLEqual(tpl, '<form action="" method="post"><form action="" method="post"></form><input type="text" name="var" value="a" /></form>')
+
+    def test_stub_per_render(self):
+        # Fields outside of any form pair up within one render, not across.
+        inputs = Template('<%namespace name="fp" module="formpump.makopump" /><%fp:text name="q" />')
+        for i in range(3):
+            inputs.render()
+        html = self._run_template('<%fp:label name="q">q</%fp:label><%fp:text name="q" />', strip_id=False)
+        tags = self.get_tags(html)
+        self.assertEqual(tags[0]['attrs']['for'], tags[3]['attrs']['id'])
+
+    def test_lookup_settings(self):
+        lookup = TemplateLookup()
+        settings = makopump.use_settings(lookup)
+        settings.name_key = '_'
+        lookup.put_string('tpl', '<%namespace name="fp" module="formpump.makopump" /><%fp:form name="test">ok</%fp:form>')
+
+        self.assertHTMLEqual(lookup.get_template('tpl').render(),
+                             '<form action="" method="post"><input type="hidden" name="_" value="test" />ok</form>')
+        self.assertHTMLEqual(self._run_template('<%fp:form name="test">ok</%fp:form>'),
+                             '<form action="" method="post">ok</form>')
+
 if __name__ == "__main__":
     unittest.main()
 